@@ -6,6 +6,7 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 from bot.interfaces import IHandler, ILogger, IStateManager
+from bot.utils.io_executor import AsyncLogger
 
 
 class BaseHandler(IHandler):
@@ -13,6 +14,7 @@ class BaseHandler(IHandler):
     
     def __init__(self, logger: ILogger, state_manager: IStateManager):
         self.logger = logger
+        self.async_logger = AsyncLogger(logger)
         self.state_manager = state_manager
     
     async def handle(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -21,8 +23,8 @@ class BaseHandler(IHandler):
         if not user:
             return
         
-        # Логируем активность
-        self.logger.log_activity(
+        # Логируем активность (вне цикла событий)
+        await self.async_logger.log_activity(
             user.id, 
             user.username, 
             self.__class__.__name__.lower().replace('handler', ''),
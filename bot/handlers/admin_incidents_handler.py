@@ -0,0 +1,104 @@
+"""
+Обработчик админ-команд просмотра инцидентов
+"""
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from bot.base.base_handler import BaseHandler
+from bot.interfaces import IStateManager
+from bot.services.incident_query_service import IncidentQueryService, QUERY_KINDS
+from bot.utils.keyboard_factory import KeyboardFactory
+
+USAGE_TEXT = (
+    "Использование:\n"
+    "/incidents today - инциденты за сегодня\n"
+    "/incidents user <id> - инциденты пользователя\n"
+    "/incidents near <корпус> - инциденты в корпусе\n"
+    "/incident <номер> - карточка инцидента"
+)
+
+
+class AdminIncidentsHandler(BaseHandler):
+    """Обработчик /incidents, /incident и кнопок листания выборок"""
+
+    def __init__(self, logger, state_manager: IStateManager,
+                 keyboard_factory: KeyboardFactory, query_service: IncidentQueryService):
+        super().__init__(logger, state_manager)
+        self.keyboard_factory = keyboard_factory
+        self.query_service = query_service
+
+    async def _handle_impl(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Разобрать команду или нажатие кнопки"""
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        if not self.query_service.is_admin(update.effective_user.id, chat_id):
+            if update.callback_query:
+                await update.callback_query.answer("⛔ Только для администраторов", show_alert=True)
+            else:
+                await update.message.reply_text("⛔ Команда доступна только администраторам.")
+            return
+
+        if update.callback_query:
+            await self._handle_page_button(update, context)
+        elif update.message.text.split()[0].split('@')[0] == '/incident':
+            await self._show_incident(update, context)
+        else:
+            await self._show_first_page(update, context)
+
+    async def _show_first_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Первая страница выборки /incidents"""
+        args = context.args or []
+        kind = args[0].lower() if args else ''
+        if kind not in QUERY_KINDS:
+            await update.message.reply_text(USAGE_TEXT)
+            return
+
+        arg = self.query_service.normalize_arg(kind, ' '.join(args[1:]))
+        if arg is None:
+            await update.message.reply_text(USAGE_TEXT)
+            return
+
+        text, markup = await self._render_page(kind, arg)
+        await update.message.reply_text(text, reply_markup=markup)
+
+    async def _handle_page_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Листание выборки: callback_data = inc|<вид>|<аргумент>|<n|p><id>"""
+        query = update.callback_query
+        await query.answer()
+        try:
+            _, kind, arg, cursor = query.data.split('|')
+            boundary = int(cursor[1:])
+        except ValueError:
+            return
+        if kind not in QUERY_KINDS:
+            return
+
+        if cursor.startswith('p'):
+            text, markup = await self._render_page(kind, arg, after_id=boundary)
+        else:
+            text, markup = await self._render_page(kind, arg, before_id=boundary)
+        await query.edit_message_text(text, reply_markup=markup)
+
+    async def _render_page(self, kind: str, arg: str, before_id=None, after_id=None):
+        """Текст страницы и кнопки листания"""
+        incidents, has_prev, has_next = await self.query_service.get_page_async(
+            kind, arg, before_id=before_id, after_id=after_id
+        )
+        text = self.query_service.format_page(self.query_service.page_title(kind, arg), incidents)
+        markup = None
+        if incidents:
+            markup = self.keyboard_factory.create_incident_pagination(
+                kind, arg, incidents[0]['id'], incidents[-1]['id'], has_prev, has_next
+            )
+        return text, markup
+
+    async def _show_incident(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Карточка инцидента /incident <номер>"""
+        if not context.args:
+            await update.message.reply_text(USAGE_TEXT)
+            return
+
+        incident = await self.query_service.get_incident_async(context.args[0])
+        if not incident:
+            await update.message.reply_text("❌ Инцидент не найден.")
+            return
+        await update.message.reply_text(self.query_service.format_incident(incident))
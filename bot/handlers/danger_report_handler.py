@@ -9,7 +9,14 @@ from bot.base.base_handler import BaseHandler
 from bot.interfaces import IStateManager, IKeyboardFactory
 from bot.services.danger_report_service import DangerReportService
 from bot.models.user_state import DangerReportData
+from bot.utils.rate_limiter import PRIORITY_HIGH, with_priority
 
+# Ответ, если инцидент не удалось зафиксировать (политика ACK_DURABLE)
+SAVE_FAILED_TEXT = (
+    "⚠️ **Сообщение передано, но пока не сохранено**\n\n"
+    "Служба безопасности уведомлена, но запись в журнал инцидентов не удалась.\n"
+    "Если опасность сохраняется, свяжитесь с соответствующими службами:"
+)
 
 class DangerReportHandler(BaseHandler):
     """Обработчик сообщений об опасности"""
@@ -173,6 +180,7 @@ class DangerReportHandler(BaseHandler):
             parse_mode='Markdown'
         )
     
+    @with_priority(PRIORITY_HIGH)
     async def _send_incident(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: dict) -> None:
         """Отправить инцидент"""
         user_id = update.effective_user.id
@@ -184,20 +192,35 @@ class DangerReportHandler(BaseHandler):
             media_files=data.get('media_files', [])
         )
         
-        # Сохраняем инцидент
-        await self.danger_service.save_incident(update, context, danger_data)
+        # Сохраняем инцидент; ждем фиксации, только если этого требует политика
+        durable = await self.danger_service.save_incident(update, context, danger_data)
+        saved = True
+        if self.danger_service.incident_writer.durable_ack:
+            try:
+                await durable
+            except Exception as e:
+                # Инцидент остался в журнале и будет зафиксирован повтором - админа уведомляем
+                print(f"Ошибка фиксации инцидента пользователя {user_id}: {e}")
+                saved = False
         
         # Отправляем админу
         await self.danger_service.send_to_admin(update, context, danger_data)
         
-        # Показываем успех
-        await update.message.reply_text(
-            "✅ **Сообщение отправлено!**\n\n"
-            "Ваше сообщение об опасности передано службе безопасности.\n"
-            "При необходимости вы можете связаться с соответствующими службами:",
-            reply_markup=self.keyboard_factory.create_success_buttons(),
-            parse_mode='Markdown'
-        )
+        if saved:
+            # Показываем успех
+            await update.message.reply_text(
+                "✅ **Сообщение отправлено!**\n\n"
+                "Ваше сообщение об опасности передано службе безопасности.\n"
+                "При необходимости вы можете связаться с соответствующими службами:",
+                reply_markup=self.keyboard_factory.create_success_buttons(),
+                parse_mode='Markdown'
+            )
+        else:
+            await update.message.reply_text(
+                SAVE_FAILED_TEXT,
+                reply_markup=self.keyboard_factory.create_success_buttons(),
+                parse_mode='Markdown'
+            )
         
         # Очищаем состояние
         self.state_manager.clear_user_state(user_id)
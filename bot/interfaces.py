@@ -2,7 +2,8 @@
 Интерфейсы для соблюдения принципов SOLID
 """
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Optional
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 
@@ -63,6 +64,40 @@ class IFileManager(ABC):
         pass
 
 
+class IIncidentStore(ABC):
+    """Интерфейс для хранилища инцидентов"""
+    
+    @abstractmethod
+    def append(self, incident: Dict[str, Any]) -> None:
+        """Сохранить инцидент"""
+        pass
+    
+    @abstractmethod
+    def append_many(self, incidents: Iterable[Dict[str, Any]]) -> None:
+        """Сохранить пачку инцидентов"""
+        pass
+    
+    @abstractmethod
+    def get(self, incident_id: str) -> Optional[Dict[str, Any]]:
+        """Получить инцидент по идентификатору"""
+        pass
+    
+    @abstractmethod
+    def query_by_time(self, start: datetime, end: datetime, limit: int = 100) -> List[Dict[str, Any]]:
+        """Получить инциденты за период [start, end)"""
+        pass
+    
+    @abstractmethod
+    def query_by_user(self, user_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Получить последние инциденты пользователя"""
+        pass
+    
+    @abstractmethod
+    def close(self) -> None:
+        """Закрыть хранилище"""
+        pass
+
+
 class IKeyboardFactory(ABC):
     """Интерфейс для создания клавиатур"""
     
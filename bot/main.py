@@ -1,11 +1,36 @@
 import os
+import sys
 import logging
 import json
 import csv
+import uuid
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes
+
+# Добавляем путь к модулям
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.handlers.admin_incidents_handler import AdminIncidentsHandler
+from bot.handlers.danger_report_handler import SAVE_FAILED_TEXT
+from bot.services.incident_query_service import IncidentQueryService
+from bot.utils.activity_logger import ActivityLogger
+from bot.utils.admin_digest import ADMIN_DIGEST, AdminDigest
+from bot.utils.admin_routing import AdminRouter
+from bot.utils.app_logging import SampledLog, setup_logging
+from bot.utils.cluster_cards import ClusterCardEditor, format_cluster_text
+from bot.services.history_service import HISTORY_PAGE_PREFIX, HistoryService
+from bot.utils.incident_dedup import IncidentDeduplicator
+from bot.utils.incident_store import create_incident_store
+from bot.utils.incident_writer import GroupCommitWriter
+from bot.utils.io_executor import run_io, read_file_bytes
+from bot.utils.file_manager import FileManager
+from bot.utils.keyboard_factory import KeyboardFactory
+from bot.utils.media_album import send_report_with_media
+from bot.utils.outbox import Outbox, OutboxDispatcher
+from bot.utils.rate_limiter import PRIORITY_HIGH, PRIORITY_LOW, PriorityRateLimiter, with_priority
+from bot.utils.ttl_store import TTLDict
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -13,16 +38,11 @@ load_dotenv()
 # Создаем директорию для логов перед настройкой логирования
 os.makedirs('logs', exist_ok=True)
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('logs/app.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: запись в файл и консоль идет в отдельном потоке
+setup_logging('logs/app.log')
 logger = logging.getLogger(__name__)
+# Строки на каждое сообщение пользователя: не больше LOG_HOT_PER_SEC в секунду
+hot_log = SampledLog(logger)
 
 # Загружаем данные-заглушки
 def load_placeholder_data():
@@ -33,35 +53,40 @@ def load_placeholder_data():
         logger.error("Файл data_placeholders.json не найден")
         return {}
 
-# Словарь для хранения состояния пользователей
-user_states = {}
+# Брошенный черновик сообщения об опасности сохраняется в логе активности
+def on_dialog_expired(user_id, state):
+    description = state.get('data', {}).get('description')
+    if state.get('state', '').startswith('danger_') and description:
+        log_activity(user_id, None, "danger_report_abandoned", description[:50])
+
+# Состояния пользователей: удаляются через DIALOG_STATE_TTL_MIN после последнего обращения
+user_states = TTLDict(float(os.getenv('DIALOG_STATE_TTL_MIN', '30')) * 60, on_dialog_expired)
+
+# Хранилище инцидентов (SQLite WAL или журнал JSON Lines)
+incident_store = create_incident_store()
+
+# Очередь групповой записи инцидентов
+incident_writer = GroupCommitWriter(incident_store)
+
+# Персистентная очередь уведомлений для админ-чата
+outbox = Outbox()
+
+# Маршрутизация сообщений по дежурным чатам (configs/admin_routing.json)
+admin_router = AdminRouter.from_file()
+
+# Группировка похожих сообщений: повтор обновляет карточку события (INCIDENT_DEDUP=0 - отключить)
+incident_deduplicator = IncidentDeduplicator() if os.getenv('INCIDENT_DEDUP', '1') == '1' else None
+cluster_cards = ClusterCardEditor(
+    lambda cluster, limit: format_cluster_text(cluster, cluster.first['text'], limit)
+)
+
+# Лог активности: запись только ставится в очередь, в файл пишет фоновый поток
+activity_logger = ActivityLogger(os.path.abspath('logs/activity.csv'))
 
 # Функция логирования активности
 def log_activity(user_id, username, action, payload_summary="", response_ref=""):
     """Логирует активность пользователя в CSV файл"""
-    try:
-        activity_file = 'logs/activity.csv'
-        file_exists = os.path.exists(activity_file)
-        
-        with open(activity_file, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            
-            # Записываем заголовки, если файл новый
-            if not file_exists:
-                writer.writerow(['timestamp', 'user_id', 'username', 'action', 'payload_summary', 'response_ref'])
-            
-            # Записываем данные
-            writer.writerow([
-                datetime.now().isoformat(),
-                user_id,
-                username or 'Unknown',
-                action,
-                payload_summary[:100],  # Ограничиваем длину
-                response_ref
-            ])
-            
-    except Exception as e:
-        logger.error(f"Ошибка логирования активности: {e}")
+    activity_logger.log_activity(user_id, username, action, payload_summary, response_ref)
 
 # Функция защиты от спама
 def check_spam_protection(user_id):
@@ -98,10 +123,18 @@ def get_main_menu():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+# Inline-кнопки (листание истории и выборок инцидентов)
+keyboard_factory = KeyboardFactory()
+
+# Админ-команды /incidents и /incident (состояния диалога им не нужны)
+admin_incidents_handler = AdminIncidentsHandler(
+    activity_logger, None, keyboard_factory, IncidentQueryService(incident_store)
+)
+
 # Обработчик команды /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    logger.info(f"Пользователь {user.id} ({user.username}) запустил бота")
+    hot_log.info("start", "Пользователь %s запустил бота", user.id, username=user.username)
     
     # Логируем активность
     log_activity(user.id, user.username, "start_command")
@@ -116,7 +149,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_menu()
     )
 
+# История пользователя: чтение лога, страницы и их кэш - общий HistoryService
+history_service = HistoryService(FileManager(), activity_logger)
+
+def history_navigation(page, total):
+    return keyboard_factory.create_page_navigation(HISTORY_PAGE_PREFIX, page, total)
+
 # Обработчик команды /my_history
+@with_priority(PRIORITY_LOW)
 async def my_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
@@ -125,109 +165,15 @@ async def my_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_activity(user_id, user.username, "history_requested")
     
     try:
-        # Читаем логи активности
-        activity_file = 'logs/activity.csv'
-        if not os.path.exists(activity_file):
-            await update.message.reply_text(
-                "📊 **Ваша история**\n\n"
-                "История активности пока пуста.",
-                reply_markup=get_main_menu()
-            )
-            return
-        
-        user_activities = []
-        with open(activity_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if int(row['user_id']) == user_id:
-                    user_activities.append(row)
-        
-        if not user_activities:
-            await update.message.reply_text(
-                "📊 **Ваша история**\n\n"
-                "История активности пока пуста.",
-                reply_markup=get_main_menu()
-            )
-            return
-        
-        # Формируем сообщение с историей
-        text = "📊 **Ваша история активности**\n\n"
-        
-        # Показываем последние 10 записей
-        recent_activities = user_activities[-10:]
-        
-        for activity in recent_activities:
-            timestamp = datetime.fromisoformat(activity['timestamp'])
-            time_str = timestamp.strftime('%d.%m.%Y %H:%M')
-            
-            action_name = {
-                'start_command': '🚀 Запуск бота',
-                'text_message': '💬 Сообщение',
-                'danger_report_started': '🚨 Сообщение об опасности',
-                'incident_saved': '✅ Инцидент сохранен',
-                'shelter_finder_started': '🏠 Поиск убежищ',
-                'safety_consultant_started': '🧑‍🏫 Консультант',
-                'question_asked': '❓ Вопрос задан',
-                'history_requested': '📊 Запрос истории'
-            }.get(activity['action'], activity['action'])
-            
-            text += f"• {time_str} - {action_name}\n"
-            if activity['payload_summary']:
-                text += f"  {activity['payload_summary']}\n"
-            text += "\n"
-        
-        # Добавляем статистику
-        total_actions = len(user_activities)
-        text += f"📈 **Всего действий:** {total_actions}\n"
-        
-        # Подсчитываем типы действий
-        action_counts = {}
-        for activity in user_activities:
-            action = activity['action']
-            action_counts[action] = action_counts.get(action, 0) + 1
+        # Повторный запрос - из кэша, иначе читаем лог вне цикла событий
+        pages = await history_service.get_history_pages_async(user_id)
         
-        text += "\n📊 **Статистика:**\n"
-        for action, count in action_counts.items():
-            action_name = {
-                'start_command': 'Запуски бота',
-                'text_message': 'Сообщения',
-                'danger_report_started': 'Сообщения об опасности',
-                'incident_saved': 'Сохраненные инциденты',
-                'shelter_finder_started': 'Поиски убежищ',
-                'safety_consultant_started': 'Обращения к консультанту',
-                'question_asked': 'Заданные вопросы',
-                'history_requested': 'Запросы истории'
-            }.get(action, action)
-            text += f"• {action_name}: {count}\n"
-        
-        # Разбиваем на части, если сообщение слишком длинное
-        if len(text) > 4000:
-            parts = text.split('\n\n')
-            current_part = ""
-            
-            for part in parts:
-                if len(current_part + part) > 4000:
-                    await update.message.reply_text(
-                        current_part,
-                        reply_markup=get_main_menu(),
-                        parse_mode='Markdown'
-                    )
-                    current_part = part + "\n\n"
-                else:
-                    current_part += part + "\n\n"
-            
-            if current_part.strip():
-                await update.message.reply_text(
-                    current_part,
-                    reply_markup=get_main_menu(),
-                    parse_mode='Markdown'
-                )
-        else:
-            await update.message.reply_text(
-                text,
-                reply_markup=get_main_menu(),
-                parse_mode='Markdown'
-            )
+        # Длинная история - одно сообщение с кнопками листания
+        await update.message.reply_text(
+            pages[0],
+            reply_markup=history_navigation(0, len(pages)) or get_main_menu(),
+            parse_mode='Markdown'
+        )
             
     except Exception as e:
         logger.error(f"Ошибка получения истории пользователя {user_id}: {e}")
@@ -236,21 +182,41 @@ async def my_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_main_menu()
         )
 
+# Листание истории: callback_data = hist|<страница>
+@with_priority(PRIORITY_LOW)
+async def my_history_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    try:
+        page = int(query.data.split('|')[1])
+    except (IndexError, ValueError):
+        return
+    
+    pages = await history_service.get_history_pages_async(update.effective_user.id)
+    page = min(max(page, 0), len(pages) - 1)
+    await query.edit_message_text(
+        pages[page],
+        reply_markup=history_navigation(page, len(pages)),
+        parse_mode='Markdown'
+    )
+
 # Обработчик текстовых сообщений
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     text = update.message.text
     user_id = user.id
+    admin_digest.record_message(user_id)
     
     # Проверяем защиту от спама
     if not check_spam_protection(user_id):
+        admin_digest.record_spam_block(user_id, user.username)
         await update.message.reply_text(
             "⚠️ Слишком много сообщений. Подождите минуту и попробуйте снова.",
             reply_markup=get_main_menu()
         )
         return
     
-    logger.info(f"Пользователь {user_id} отправил сообщение: {text}")
+    hot_log.info("message", "Пользователь %s отправил сообщение", user_id, chars=len(text))
     
     # Логируем активность
     log_activity(user_id, user.username, "text_message", text[:50])
@@ -577,25 +543,36 @@ async def handle_danger_confirm(update: Update, context: ContextTypes.DEFAULT_TY
     if user_id not in user_states or user_states[user_id]['state'] != 'danger_confirm':
         return
     
-    # Сохраняем инцидент
-    await save_incident(update, context)
+    # Сохраняем инцидент; ждем фиксации, только если этого требует политика
+    durable = await save_incident(update, context)
+    saved = durable is not None
+    if saved and incident_writer.durable_ack:
+        try:
+            await durable
+        except Exception as e:
+            logger.error(f"Ошибка фиксации инцидента: {e}")
+            saved = False
     
     # Отправляем в админ-чат
     await send_to_admin(update, context)
     
-    # Показываем подтверждение пользователю
-    await show_danger_success(update, context)
+    # Показываем пользователю подтверждение или сообщение о сбое записи
+    if saved:
+        await show_danger_success(update, context)
+    else:
+        await show_danger_save_failed(update, context)
     
     # Очищаем состояние
     if user_id in user_states:
         del user_states[user_id]
 
-# Сохранение инцидента в лог
+# Сохранение инцидента в лог (возвращает future фиксации в хранилище)
 async def save_incident(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     data = user_states[user_id]['data']
     
     incident = {
+        'incident_id': uuid.uuid4().hex,
         'timestamp': datetime.now().isoformat(),
         'user_id': user_id,
         'username': update.effective_user.username,
@@ -604,23 +581,9 @@ async def save_incident(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'media_files': data.get('media_files', [])
     }
     
-    # Сохраняем в JSON файл
+    # Ставим в очередь групповой записи (журнал пишется сразу)
     try:
-        incidents_file = 'logs/incidents.json'
-        incidents = []
-        
-        # Читаем существующие инциденты
-        try:
-            with open(incidents_file, 'r', encoding='utf-8') as f:
-                incidents = json.load(f)
-        except FileNotFoundError:
-            pass
-        
-        incidents.append(incident)
-        
-        # Записываем обновленный список
-        with open(incidents_file, 'w', encoding='utf-8') as f:
-            json.dump(incidents, f, ensure_ascii=False, indent=2)
+        durable = await incident_writer.submit(incident)
         
         logger.info(f"Инцидент сохранен для пользователя {user_id}")
         
@@ -628,16 +591,23 @@ async def save_incident(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log_activity(user_id, update.effective_user.username, "incident_saved", 
                     f"Description: {data['description'][:30]}...")
         
+        return durable
+        
     except Exception as e:
         logger.error(f"Ошибка сохранения инцидента: {e}")
+        return None
 
 # Отправка в админ-чат
 async def send_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     data = user_states[user_id]['data']
-    admin_chat_id = os.getenv('ADMIN_CHAT_ID')
+    categories = admin_router.classify(f"{data['description']} {data['location']}")
+    recipients = admin_router.route(
+        {'categories': categories, 'location': data['location']},
+        fallback_chat_id=os.getenv('ADMIN_CHAT_ID')
+    )
     
-    if not admin_chat_id or admin_chat_id == 'ADMIN_ID_PLACEHOLDER':
+    if not recipients:
         logger.warning("ADMIN_CHAT_ID не настроен")
         return
     
@@ -648,42 +618,63 @@ async def send_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         admin_text += f"🕐 **Время:** {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
         admin_text += f"📝 **Описание:** {data['description']}\n\n"
         admin_text += f"📍 **Местоположение:** {data['location']}\n\n"
+        if categories:
+            admin_text += f"🏷 **Категория:** {', '.join(admin_router.category_titles(categories))}\n\n"
         
         if 'media_files' in data and data['media_files']:
             admin_text += f"📎 **Медиафайлы:** {len(data['media_files'])} файлов\n\n"
         
-        # Отправляем текстовое сообщение
-        await context.bot.send_message(
-            chat_id=admin_chat_id,
-            text=admin_text,
-            parse_mode='Markdown'
-        )
+        payload = {
+            'user_id': user_id,
+            'text': admin_text,
+            'media_files': data.get('media_files') or []
+        }
         
-        # Отправляем медиафайлы
-        if 'media_files' in data and data['media_files']:
-            for media in data['media_files']:
-                try:
-                    if media['file_type'] == 'photo':
-                        await context.bot.send_photo(
-                            chat_id=admin_chat_id,
-                            photo=media['file_id'],
-                            caption=f"Фото от @{update.effective_user.username}"
-                        )
-                    else:  # video
-                        await context.bot.send_video(
-                            chat_id=admin_chat_id,
-                            video=media['file_id'],
-                            caption=f"Видео от @{update.effective_user.username}"
-                        )
-                except Exception as e:
-                    logger.error(f"Ошибка отправки медиафайла: {e}")
+        if incident_deduplicator is not None:
+            report = dict(payload, timestamp=datetime.now().isoformat(), username=update.effective_user.username,
+                          description=data['description'], location=data['location'])
+            cluster, is_new = incident_deduplicator.add(report)
+            if not is_new:
+                # Повтор уже известного события - обновляем карточки вместо новой рассылки
+                cluster_cards.schedule(context.bot, cluster)
+                log_activity(user_id, update.effective_user.username, "admin_notification_grouped",
+                             f"Cluster: {cluster.cluster_id}, count: {cluster.count}")
+                return
+            payload['cluster_id'] = cluster.cluster_id
+        
+        # Доставкой занимается диспетчер outbox - по записи на каждый дежурный чат
+        await run_io(outbox.enqueue_many, 'admin_report',
+                     [(chat_id, dict(payload, recipient=name)) for name, chat_id in recipients])
+        outbox_dispatcher.wake()
         
-        logger.info(f"Сообщение отправлено админу для инцидента пользователя {user_id}")
+        logger.info(f"Сообщение для админа поставлено в очередь для инцидента пользователя {user_id}")
         
     except Exception as e:
-        logger.error(f"Ошибка отправки в админ-чат: {e}")
+        logger.error(f"Ошибка постановки сообщения в очередь админ-чата: {e}")
+
+# Доставка сообщения из outbox в админ-чат (вызывается диспетчером)
+@with_priority(PRIORITY_HIGH)
+async def deliver_admin_report(bot, entry):
+    payload = entry['payload']
+    # Текст и медиафайлы уходят альбомами по 10, текст - подписью первого файла
+    message, is_caption = await send_report_with_media(bot, entry['chat_id'], payload['text'],
+                                                       payload['media_files'])
+    cluster = incident_deduplicator.get(payload.get('cluster_id')) if incident_deduplicator else None
+    if cluster is not None:
+        cluster.admin_messages[entry['chat_id']] = (message.message_id, is_caption)
+        if cluster.count > 1:
+            # Похожие сообщения пришли, пока карточка ждала в outbox
+            cluster_cards.schedule(bot, cluster)
+    logger.info(f"Сообщение отправлено админу для инцидента пользователя {payload['user_id']}")
+
+outbox_dispatcher = OutboxDispatcher(outbox, {'admin_report': deliver_admin_report})
+
+# Сводка для админов: вопросы без ответа, блокировки спама, всплески активности
+admin_digest = AdminDigest(outbox=outbox, dispatcher=outbox_dispatcher, router=admin_router)
+outbox_dispatcher.handlers[ADMIN_DIGEST] = admin_digest.deliver
 
 # Показать успешное завершение
+@with_priority(PRIORITY_HIGH)
 async def show_danger_success(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         ['📞 Позвонить в службу безопасности'],
@@ -700,6 +691,20 @@ async def show_danger_success(update: Update, context: ContextTypes.DEFAULT_TYPE
         parse_mode='Markdown'
     )
 
+async def show_danger_save_failed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [
+        ['📞 Позвонить в службу безопасности'],
+        ['📞 Позвонить в охрану труда'],
+        ['⬅️ Главное меню']
+    ]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await update.message.reply_text(
+        SAVE_FAILED_TEXT,
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
 # Обработчики кнопок после отправки
 async def handle_security_call(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -720,6 +725,7 @@ async def handle_safety_call(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # Обработчик медиафайлов
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    admin_digest.record_message(user_id)
     
     # Проверяем, находится ли пользователь в состоянии ожидания медиафайлов
     if user_id in user_states and user_states[user_id]['state'] == 'danger_media':
@@ -779,7 +785,7 @@ async def show_shelters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Загружаем данные убежищ
-    data = load_placeholder_data()
+    data = await run_io(load_placeholder_data)
     shelters = data.get('shelters', [])
     
     if not shelters:
@@ -803,13 +809,13 @@ async def show_shelters(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Отправляем изображение убежища (заглушка)
         try:
-            with open(shelter['photo_path'], 'rb') as photo:
-                await update.message.reply_photo(
-                    photo=photo,
-                    caption=text,
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
+            photo = await run_io(read_file_bytes, shelter['photo_path'])
+            await update.message.reply_photo(
+                photo=photo,
+                caption=text,
+                reply_markup=reply_markup,
+                parse_mode='Markdown'
+            )
         except FileNotFoundError:
             # Если файл не найден, отправляем только текст
             await update.message.reply_text(
@@ -883,6 +889,7 @@ async def handle_safety_consultant(update: Update, context: ContextTypes.DEFAULT
     )
 
 # Обработчик списка документов
+@with_priority(PRIORITY_LOW)
 async def handle_documents_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -890,7 +897,7 @@ async def handle_documents_list(update: Update, context: ContextTypes.DEFAULT_TY
         return
     
     # Загружаем данные документов
-    data = load_placeholder_data()
+    data = await run_io(load_placeholder_data)
     documents = data.get('documents', [])
     
     if not documents:
@@ -920,6 +927,7 @@ async def handle_documents_list(update: Update, context: ContextTypes.DEFAULT_TY
     )
 
 # Обработчик открытия документа
+@with_priority(PRIORITY_LOW)
 async def handle_open_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     
@@ -928,7 +936,7 @@ async def handle_open_document(update: Update, context: ContextTypes.DEFAULT_TYP
     
     try:
         doc_num = int(text.split()[-1]) - 1
-        data = load_placeholder_data()
+        data = await run_io(load_placeholder_data)
         documents = data.get('documents', [])
         
         if 0 <= doc_num < len(documents):
@@ -936,12 +944,12 @@ async def handle_open_document(update: Update, context: ContextTypes.DEFAULT_TYP
             
             # Отправляем PDF файл
             try:
-                with open(doc['file_path'], 'rb') as pdf_file:
-                    await update.message.reply_document(
-                        document=pdf_file,
-                        filename=f"{doc['title']}.pdf",
-                        caption=f"📄 **{doc['title']}**\n\n{doc['description']}"
-                    )
+                pdf_data = await run_io(read_file_bytes, doc['file_path'])
+                await update.message.reply_document(
+                    document=pdf_data,
+                    filename=f"{doc['title']}.pdf",
+                    caption=f"📄 **{doc['title']}**\n\n{doc['description']}"
+                )
             except FileNotFoundError:
                 await update.message.reply_text(
                     f"❌ Файл документа '{doc['title']}' не найден.",
@@ -995,9 +1003,12 @@ async def handle_question_response(update: Update, context: ContextTypes.DEFAULT
     log_activity(user_id, update.effective_user.username, "question_asked", question[:50])
     
     # Загружаем шаблоны ответов
-    data = load_placeholder_data()
+    data = await run_io(load_placeholder_data)
     responses = data.get('suggestions_responses', {})
     
+    # Базы ответов пока нет - на любой вопрос отвечает заглушка, такие вопросы попадают в сводку
+    admin_digest.record_unanswered(user_id, update.effective_user.username, question)
+    
     # Формируем ответ
     answer_text = f"❓ **Ваш вопрос:** {question}\n\n"
     answer_text += f"💡 **Ответ:** {responses.get('default_answer', 'Заглушка-ответ по вашему вопросу.')}\n\n"
@@ -1025,7 +1036,7 @@ async def handle_detailed_answer(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     # Загружаем детальные ответы
-    data = load_placeholder_data()
+    data = await run_io(load_placeholder_data)
     responses = data.get('suggestions_responses', {})
     detailed = responses.get('detailed_responses', {})
     
@@ -1054,12 +1065,12 @@ async def handle_open_question_pdf(update: Update, context: ContextTypes.DEFAULT
     
     # Отправляем заглушку PDF
     try:
-        with open('assets/pdfs/dummy.pdf', 'rb') as pdf_file:
-            await update.message.reply_document(
-                document=pdf_file,
-                filename="Документ_по_безопасности.pdf",
-                caption="📄 **Документ по безопасности**\n\nСправочный материал по вашему вопросу."
-            )
+        pdf_data = await run_io(read_file_bytes, 'assets/pdfs/dummy.pdf')
+        await update.message.reply_document(
+            document=pdf_data,
+            filename="Документ_по_безопасности.pdf",
+            caption="📄 **Документ по безопасности**\n\nСправочный материал по вашему вопросу."
+        )
     except FileNotFoundError:
         await update.message.reply_text(
             "❌ Документ временно недоступен.",
@@ -1085,6 +1096,24 @@ async def handle_another_question(update: Update, context: ContextTypes.DEFAULT_
         parse_mode='Markdown'
     )
 
+# Запуск фоновых задач после инициализации приложения
+async def post_init(application: Application):
+    replayed = await incident_writer.start()
+    if replayed:
+        logger.info(f"Из журнала восстановлено инцидентов: {replayed}")
+    pending = await outbox_dispatcher.start(application.bot)
+    if pending:
+        logger.info(f"Недоставленных уведомлений в outbox: {pending}")
+
+# Остановка фоновых задач (в том числе по SIGTERM)
+async def post_shutdown(application: Application):
+    await outbox_dispatcher.close()
+    await cluster_cards.flush()
+    await incident_writer.close()
+    incident_store.close()
+    outbox.close()
+    activity_logger.close()
+
 def main():
     # Получаем токен бота
     bot_token = os.getenv('BOT_TOKEN')
@@ -1093,15 +1122,29 @@ def main():
         return
     
     # Создаем приложение
-    application = Application.builder().token(bot_token).build()
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .rate_limiter(PriorityRateLimiter())
+        .build()
+    )
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("my_history", my_history))
+    application.add_handler(CommandHandler("incidents", admin_incidents_handler.handle))
+    application.add_handler(CommandHandler("incident", admin_incidents_handler.handle))
+    application.add_handler(CallbackQueryHandler(admin_incidents_handler.handle, pattern=r'^inc\|'))
+    application.add_handler(CallbackQueryHandler(my_history_page, pattern=rf'^{HISTORY_PAGE_PREFIX}\|'))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO, handle_media))
     application.add_handler(MessageHandler(filters.LOCATION, handle_location))
     
+    # Периодическая сводка для админов
+    admin_digest.schedule(application)
+    
     # Запускаем бота
     logger.info("Запуск бота...")
     application.run_polling()
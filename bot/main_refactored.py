@@ -5,10 +5,11 @@ import os
 import sys
 import logging
 from datetime import datetime, time
+from typing import Any, Dict
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes
 
 # Добавляем путь к модулям
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -16,18 +17,24 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Импорты интерфейсов и утилит
 from bot.interfaces import ILogger, IStateManager, IFileManager, IKeyboardFactory
 from bot.utils.activity_logger import ActivityLogger
+from bot.utils.app_logging import SampledLog, setup_logging
 from bot.utils.state_manager import StateManager
 from bot.utils.file_manager import FileManager
 from bot.utils.keyboard_factory import KeyboardFactory
+from bot.utils.admin_digest import ADMIN_DIGEST, AdminDigest
+from bot.utils.io_executor import AsyncLogger
+from bot.utils.rate_limiter import PRIORITY_LOW, PriorityRateLimiter, with_priority
 
 # Импорты сервисов
 from bot.services.danger_report_service import DangerReportService
 from bot.services.shelter_service import ShelterService
 from bot.services.consultant_service import ConsultantService
-from bot.services.history_service import HistoryService
+from bot.services.history_service import HISTORY_PAGE_PREFIX, HistoryService
+from bot.services.incident_query_service import IncidentQueryService
 
 # Импорты обработчиков
 from bot.handlers.danger_report_handler import DangerReportHandler
+from bot.handlers.admin_incidents_handler import AdminIncidentsHandler
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -35,16 +42,11 @@ load_dotenv()
 # Создаем директорию для логов перед настройкой логирования
 os.makedirs('logs', exist_ok=True)
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('logs/app.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: запись в файл и консоль идет в отдельном потоке
+setup_logging('logs/app.log')
 logger = logging.getLogger(__name__)
+# Строки на каждое сообщение пользователя: не больше LOG_HOT_PER_SEC в секунду
+hot_log = SampledLog(logger)
 
 
 class BotApplication:
@@ -53,7 +55,9 @@ class BotApplication:
     def __init__(self):
         # Инициализируем зависимости
         self.logger = ActivityLogger()
-        self.state_manager = StateManager()
+        self.async_logger = AsyncLogger(self.logger)
+        # Брошенные диалоги удаляются через DIALOG_STATE_TTL_MIN; черновики сообщений об опасности - в лог
+        self.state_manager = StateManager(on_expire=self._on_dialog_expired)
         self.file_manager = FileManager()
         self.keyboard_factory = KeyboardFactory()
         
@@ -62,19 +66,35 @@ class BotApplication:
         self.shelter_service = ShelterService(self.file_manager, self.logger)
         self.consultant_service = ConsultantService(self.file_manager, self.logger)
         self.history_service = HistoryService(self.file_manager, self.logger)
+        self.incident_query_service = IncidentQueryService(self.danger_service.incident_store)
+        
+        # Сводка для админов по событиям низкого приоритета (доставляется через outbox)
+        self.admin_digest = AdminDigest(outbox=self.danger_service.outbox,
+                                        dispatcher=self.danger_service.dispatcher,
+                                        router=self.danger_service.router)
+        self.danger_service.dispatcher.handlers[ADMIN_DIGEST] = self.admin_digest.deliver
         
         # Инициализируем обработчики
         self.danger_handler = DangerReportHandler(
             self.logger, self.state_manager, self.keyboard_factory, self.danger_service
         )
+        self.admin_incidents_handler = AdminIncidentsHandler(
+            self.logger, self.state_manager, self.keyboard_factory, self.incident_query_service
+        )
+    
+    def _on_dialog_expired(self, user_id: int, state: Dict[str, Any]) -> None:
+        """Брошенный черновик сообщения об опасности сохраняется в логе активности"""
+        description = state.get('data', {}).get('description')
+        if state.get('state', '').startswith('danger_') and description:
+            self.logger.log_activity(user_id, None, "danger_report_abandoned", description[:50])
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик команды /start"""
         user = update.effective_user
-        logger.info(f"Пользователь {user.id} ({user.username}) запустил бота")
+        hot_log.info("start", "Пользователь %s запустил бота", user.id, username=user.username)
         
         # Логируем активность
-        self.logger.log_activity(user.id, user.username, "start_command")
+        await self.async_logger.log_activity(user.id, user.username, "start_command")
         
         welcome_text = (
             "🛡️ Добро пожаловать в систему безопасности РПРЗ!\n\n"
@@ -96,62 +116,37 @@ class BotApplication:
             input_field_placeholder="Выберите функцию"
         )
         
-        logger.info(f"Создана клавиатура напрямую: {reply_markup}")
+        logger.debug("Создана клавиатура: %r", reply_markup)
         
         try:
             await update.message.reply_text(
                 welcome_text,
                 reply_markup=reply_markup
             )
-            logger.info("✅ Команда /start обработана, клавиатура отправлена успешно")
+            logger.debug("✅ Команда /start обработана, клавиатура отправлена")
         except Exception as e:
             logger.error(f"❌ Ошибка отправки клавиатуры: {e}")
             # Отправляем без клавиатуры
             await update.message.reply_text(welcome_text)
     
+    @with_priority(PRIORITY_LOW)
     async def my_history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик команды /my_history"""
         user = update.effective_user
         user_id = user.id
         
         # Логируем активность
-        self.logger.log_activity(user_id, user.username, "history_requested")
+        await self.async_logger.log_activity(user_id, user.username, "history_requested")
         
         try:
-            # Получаем активность пользователя
-            activities = self.history_service.get_user_activities(user_id)
-            
-            # Форматируем историю
-            history_text = self.history_service.format_activity_history(activities)
-            
-            # Разбиваем на части, если сообщение слишком длинное
-            if len(history_text) > 4000:
-                parts = history_text.split('\n\n')
-                current_part = ""
-                
-                for part in parts:
-                    if len(current_part + part) > 4000:
-                        await update.message.reply_text(
-                            current_part,
-                            reply_markup=self.keyboard_factory.create_main_menu(),
-                            parse_mode='Markdown'
-                        )
-                        current_part = part + "\n\n"
-                    else:
-                        current_part += part + "\n\n"
-                
-                if current_part.strip():
-                    await update.message.reply_text(
-                        current_part,
-                        reply_markup=self.keyboard_factory.create_main_menu(),
-                        parse_mode='Markdown'
-                    )
-            else:
-                await update.message.reply_text(
-                    history_text,
-                    reply_markup=self.keyboard_factory.create_main_menu(),
-                    parse_mode='Markdown'
-                )
+            # Страницы истории (из кэша, если новых записей не было)
+            pages = await self.history_service.get_history_pages_async(user_id)
+            markup = self.keyboard_factory.create_page_navigation(HISTORY_PAGE_PREFIX, 0, len(pages))
+            await update.message.reply_text(
+                pages[0],
+                reply_markup=markup or self.keyboard_factory.create_main_menu(),
+                parse_mode='Markdown'
+            )
                 
         except Exception as e:
             logger.error(f"Ошибка получения истории пользователя {user_id}: {e}")
@@ -160,24 +155,44 @@ class BotApplication:
                 reply_markup=self.keyboard_factory.create_main_menu()
             )
     
+    @with_priority(PRIORITY_LOW)
+    async def history_page_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Листание истории: callback_data = hist|<страница>, сообщение редактируется"""
+        query = update.callback_query
+        await query.answer()
+        try:
+            page = int(query.data.split('|')[1])
+        except (IndexError, ValueError):
+            return
+        
+        pages = await self.history_service.get_history_pages_async(update.effective_user.id)
+        page = min(max(page, 0), len(pages) - 1)
+        await query.edit_message_text(
+            pages[page],
+            reply_markup=self.keyboard_factory.create_page_navigation(HISTORY_PAGE_PREFIX, page, len(pages)),
+            parse_mode='Markdown'
+        )
+    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик текстовых сообщений"""
         user = update.effective_user
         text = update.message.text
         user_id = user.id
+        self.admin_digest.record_message(user_id)
         
         # Проверяем защиту от спама
         if not self.state_manager.check_spam_protection(user_id):
+            self.admin_digest.record_spam_block(user_id, user.username)
             await update.message.reply_text(
                 "⚠️ Слишком много сообщений. Подождите минуту и попробуйте снова.",
                 reply_markup=self.keyboard_factory.create_main_menu()
             )
             return
         
-        logger.info(f"Пользователь {user_id} отправил сообщение: {text}")
+        hot_log.info("message", "Пользователь %s отправил сообщение", user_id, chars=len(text))
         
         # Логируем активность
-        self.logger.log_activity(user_id, user.username, "text_message", text[:50])
+        await self.async_logger.log_activity(user_id, user.username, "text_message", text[:50])
         
         # Обработка кнопок навигации
         if text in ["⬅️🔙 Назад", "🏠⬅️ Главное меню", "⬅️ Назад", "⬅️ Главное меню"]:
@@ -206,7 +221,7 @@ class BotApplication:
         user_id = update.effective_user.id
         
         # Логируем активность
-        self.logger.log_activity(user_id, update.effective_user.username, "shelter_finder_started")
+        await self.async_logger.log_activity(user_id, update.effective_user.username, "shelter_finder_started")
         
         await update.message.reply_text(
             "🏠 **Ближайшее укрытие**\n\n"
@@ -221,7 +236,7 @@ class BotApplication:
         user_id = update.effective_user.id
         
         # Логируем активность
-        self.logger.log_activity(user_id, update.effective_user.username, "safety_consultant_started")
+        await self.async_logger.log_activity(user_id, update.effective_user.username, "safety_consultant_started")
         
         await update.message.reply_text(
             "🧑‍🏫 **Консультант по безопасности РПРЗ**\n\n"
@@ -234,6 +249,7 @@ class BotApplication:
     async def handle_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик медиафайлов"""
         user_id = update.effective_user.id
+        self.admin_digest.record_message(user_id)
         
         # Проверяем, находится ли пользователь в состоянии ожидания медиафайлов
         user_state = self.state_manager.get_user_state(user_id)
@@ -289,6 +305,7 @@ class BotApplication:
             'file_type': file_type,
             'file_size': file_size
         })
+        self.state_manager.set_user_state(user_id, user_state)
         
         await update.message.reply_text(
             f"✅ {file_type == 'photo' and 'Фото' or 'Видео'} добавлено. Можете прикрепить еще файлы или продолжить.",
@@ -333,6 +350,24 @@ class BotApplication:
             except:
                 pass
     
+    async def post_init(self, application: Application) -> None:
+        """Запустить фоновые задачи после инициализации приложения"""
+        replayed = await self.danger_service.incident_writer.start()
+        if replayed:
+            logger.info(f"Из журнала восстановлено инцидентов: {replayed}")
+        pending = await self.danger_service.dispatcher.start(application.bot)
+        if pending:
+            logger.info(f"Недоставленных уведомлений в outbox: {pending}")
+    
+    async def post_shutdown(self, application: Application) -> None:
+        """Остановить фоновые задачи (в том числе по SIGTERM), дождавшись записи очереди"""
+        await self.danger_service.dispatcher.close()
+        await self.danger_service.flush_admin_updates()
+        await self.danger_service.incident_writer.close()
+        self.danger_service.incident_store.close()
+        self.danger_service.outbox.close()
+        self.logger.close()
+    
     def run(self):
         """Запустить бота"""
         # Получаем токен бота
@@ -361,11 +396,22 @@ class BotApplication:
                 logger.error(f"Ошибка проверки рабочего времени: {e}. Продолжаем запуск по умолчанию.")
         
         # Создаем приложение
-        application = Application.builder().token(bot_token).build()
+        application = (
+            Application.builder()
+            .token(bot_token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .rate_limiter(PriorityRateLimiter())
+            .build()
+        )
         
         # Добавляем обработчики
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("my_history", self.my_history_command))
+        application.add_handler(CommandHandler("incidents", self.admin_incidents_handler.handle))
+        application.add_handler(CommandHandler("incident", self.admin_incidents_handler.handle))
+        application.add_handler(CallbackQueryHandler(self.admin_incidents_handler.handle, pattern=r'^inc\|'))
+        application.add_handler(CallbackQueryHandler(self.history_page_callback, pattern=rf'^{HISTORY_PAGE_PREFIX}\|'))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO, self.handle_media))
         application.add_handler(MessageHandler(filters.LOCATION, self.handle_location))
@@ -373,6 +419,9 @@ class BotApplication:
         # Добавляем обработчик ошибок
         application.add_error_handler(self.error_handler)
         
+        # Периодическая сводка для админов
+        self.admin_digest.schedule(application)
+        
         # Запускаем бота
         logger.info("Запуск рефакторенного бота...")
         application.run_polling()
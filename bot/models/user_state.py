@@ -1,8 +1,10 @@
 """
 Модели состояний пользователей
 """
-from dataclasses import dataclass
-from typing import Optional, List, Dict, Any
+import uuid
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Optional, List, Dict, Any, Union
 from datetime import datetime
 
 
@@ -18,6 +20,66 @@ class UserState:
             self.created_at = datetime.now()
 
 
+class DialogState(IntEnum):
+    """Коды состояний диалога (имя в нижнем регистре - строковое состояние обработчиков)"""
+    IDLE = 0
+    DANGER_DESCRIPTION = 1
+    DANGER_LOCATION = 2
+    DANGER_MEDIA = 3
+    DANGER_CONFIRM = 4
+    SHELTER_LOCATION = 5
+    CONSULTANT_MENU = 6
+    WAITING_QUESTION = 7
+    QUESTION_ANSWERED = 8
+
+    @property
+    def key(self) -> str:
+        return self.name.lower()
+
+    @classmethod
+    def parse(cls, name: str) -> Union['DialogState', str]:
+        """Код состояния; неизвестное состояние остается строкой"""
+        try:
+            return cls[name.upper()]
+        except KeyError:
+            return name
+
+
+# Поля черновика, которые хранятся в отдельных слотах (остальные - в extra)
+DRAFT_FIELDS = ('description', 'location', 'media_files')
+
+
+@dataclass(slots=True)
+class CompactUserState:
+    """Состояние диалога пользователя без словарей: код состояния и поля черновика.
+
+    Снаружи (IStateManager) состояние по-прежнему выглядит как
+    {'state': 'danger_location', 'data': {...}}: from_dict/to_dict
+    переводят его в слоты и обратно.
+    """
+    state: Union[DialogState, str] = DialogState.IDLE
+    description: Optional[str] = None
+    location: Optional[str] = None
+    media_files: Optional[List[Dict[str, Any]]] = None
+    extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> 'CompactUserState':
+        data = state.get('data') or {}
+        extra = {key: value for key, value in data.items() if key not in DRAFT_FIELDS}
+        return cls(DialogState.parse(state.get('state', 'idle')), data.get('description'),
+                   data.get('location'), data.get('media_files'), extra or None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = dict(self.extra) if self.extra else {}
+        for name in DRAFT_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        state = self.state.key if isinstance(self.state, DialogState) else self.state
+        return {'state': state, 'data': data}
+
+
 @dataclass
 class DangerReportData:
     """Данные сообщения об опасности"""
@@ -61,3 +123,4 @@ class IncidentData:
     description: str
     location: str
     media_files: List[Dict[str, Any]]
+    incident_id: str = field(default_factory=lambda: uuid.uuid4().hex)
@@ -7,6 +7,7 @@ from telegram.ext import ContextTypes
 
 from bot.interfaces import IFileManager, ILogger
 from bot.models.user_state import DocumentData
+from bot.utils.io_executor import AsyncFileManager
 
 
 class ConsultantService:
@@ -14,11 +15,12 @@ class ConsultantService:
     
     def __init__(self, file_manager: IFileManager, logger: ILogger):
         self.file_manager = file_manager
+        self.async_file_manager = AsyncFileManager(file_manager)
         self.logger = logger
     
-    def get_documents(self) -> List[DocumentData]:
-        """Получить список документов"""
-        data = self.file_manager.load_json('configs/data_placeholders.json')
+    async def get_documents(self) -> List[DocumentData]:
+        """Получить список документов (файл читается вне цикла событий)"""
+        data = await self.async_file_manager.load_json('configs/data_placeholders.json')
         documents_data = data.get('documents', [])
         
         documents = []
@@ -34,17 +36,17 @@ class ConsultantService:
         
         return documents
     
-    def get_document_by_id(self, doc_id: int) -> Optional[DocumentData]:
+    async def get_document_by_id(self, doc_id: int) -> Optional[DocumentData]:
         """Получить документ по ID"""
-        documents = self.get_documents()
+        documents = await self.get_documents()
         for doc in documents:
             if doc.id == doc_id:
                 return doc
         return None
     
-    def get_document_by_index(self, index: int) -> Optional[DocumentData]:
+    async def get_document_by_index(self, index: int) -> Optional[DocumentData]:
         """Получить документ по индексу (0-based)"""
-        documents = self.get_documents()
+        documents = await self.get_documents()
         if 0 <= index < len(documents):
             return documents[index]
         return None
@@ -53,20 +55,21 @@ class ConsultantService:
                           document: DocumentData) -> None:
         """Отправить документ пользователю"""
         try:
-            with open(document.file_path, 'rb') as pdf_file:
-                await update.message.reply_document(
-                    document=pdf_file,
-                    filename=f"{document.title}.pdf",
-                    caption=f"📄 **{document.title}**\n\n{document.description}"
-                )
+            # Читаем PDF вне цикла событий
+            pdf_data = await self.async_file_manager.read_bytes(document.file_path)
+            await update.message.reply_document(
+                document=pdf_data,
+                filename=f"{document.title}.pdf",
+                caption=f"📄 **{document.title}**\n\n{document.description}"
+            )
         except FileNotFoundError:
             await update.message.reply_text(
                 f"❌ Файл документа '{document.title}' не найден."
             )
     
-    def get_answer_template(self, question: str) -> dict:
+    async def get_answer_template(self, question: str) -> dict:
         """Получить шаблон ответа на вопрос"""
-        data = self.file_manager.load_json('configs/data_placeholders.json')
+        data = await self.async_file_manager.load_json('configs/data_placeholders.json')
         responses = data.get('suggestions_responses', {})
         
         return {
@@ -1,25 +1,60 @@
 """
 Сервис для обработки сообщений об опасности
 """
+import asyncio
+import os
 from datetime import datetime
-from typing import Optional
+from typing import Any, Dict, Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from bot.interfaces import IFileManager, ILogger
+from bot.interfaces import IFileManager, IIncidentStore, ILogger
 from bot.models.user_state import DangerReportData, IncidentData
+from bot.utils.admin_routing import AdminRouter
+from bot.utils.cluster_cards import ClusterCardEditor, format_cluster_text
+from bot.utils.incident_dedup import IncidentCluster, IncidentDeduplicator
+from bot.utils.incident_store import create_incident_store
+from bot.utils.incident_writer import GroupCommitWriter
+from bot.utils.io_executor import AsyncLogger, run_io
+from bot.utils.media_album import send_report_with_media
+from bot.utils.outbox import Outbox, OutboxDispatcher
+from bot.utils.rate_limiter import PRIORITY_HIGH, with_priority
+
+# Вид записи outbox: сообщение об опасности для админ-чата
+ADMIN_REPORT = 'admin_report'
 
 
 class DangerReportService:
     """Сервис для обработки сообщений об опасности"""
     
-    def __init__(self, file_manager: IFileManager, logger: ILogger):
+    def __init__(self, file_manager: IFileManager, logger: ILogger,
+                 incident_store: Optional[IIncidentStore] = None,
+                 incident_writer: Optional[GroupCommitWriter] = None,
+                 deduplicator: Optional[IncidentDeduplicator] = None,
+                 outbox: Optional[Outbox] = None,
+                 router: Optional[AdminRouter] = None):
         self.file_manager = file_manager
         self.logger = logger
+        self.async_logger = AsyncLogger(logger)
+        self.incident_store = incident_store or create_incident_store()
+        self.incident_writer = incident_writer or GroupCommitWriter(self.incident_store)
+        
+        # Группировка похожих сообщений для админ-чата (INCIDENT_DEDUP=0 - отключить)
+        if deduplicator is None and os.getenv('INCIDENT_DEDUP', '1') == '1':
+            deduplicator = IncidentDeduplicator()
+        self.deduplicator = deduplicator
+        self.cluster_cards = ClusterCardEditor(self._format_cluster_text)
+        
+        # Выбор дежурных чатов по категории и корпусу
+        self.router = router or AdminRouter.from_file()
+        
+        # Уведомления админам доставляются через персистентную очередь
+        self.outbox = outbox or Outbox()
+        self.dispatcher = OutboxDispatcher(self.outbox, {ADMIN_REPORT: self.deliver_admin_report})
     
     async def save_incident(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                          data: DangerReportData) -> None:
-        """Сохранить инцидент"""
+                          data: DangerReportData) -> asyncio.Future:
+        """Сохранить инцидент; возвращает future фиксации в хранилище"""
         incident = IncidentData(
             timestamp=datetime.now().isoformat(),
             user_id=update.effective_user.id,
@@ -29,74 +64,114 @@ class DangerReportService:
             media_files=data.media_files
         )
         
-        # Сохраняем в JSON файл
-        self.file_manager.append_json_array('logs/incidents.json', incident.__dict__)
+        # Ставим в очередь групповой записи (журнал пишется сразу)
+        durable = await self.incident_writer.submit(incident.__dict__)
         
         # Логируем активность
-        self.logger.log_activity(
+        await self.async_logger.log_activity(
             update.effective_user.id,
             update.effective_user.username,
             "incident_saved",
             f"Description: {data.description[:30]}..."
         )
+        return durable
     
     async def send_to_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
                           data: DangerReportData) -> None:
-        """Отправить сообщение админу"""
-        admin_chat_id = context.bot_data.get('admin_chat_id')
+        """Поставить сообщение в outbox для каждого дежурного чата (похожие обновляют одну карточку)"""
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'user_id': update.effective_user.id,
+            'username': update.effective_user.username,
+            'description': data.description,
+            'location': data.location,
+            'media_files': data.media_files
+        }
+        report['categories'] = self.router.classify(f"{data.description} {data.location}")
+        report['category_titles'] = self.router.category_titles(report['categories'])
+        recipients = self.router.route(report, fallback_chat_id=context.bot_data.get('admin_chat_id'))
         
-        if not admin_chat_id or admin_chat_id == 'ADMIN_ID_PLACEHOLDER':
-            self.logger.log_activity(
+        if not recipients:
+            await self.async_logger.log_activity(
                 update.effective_user.id,
                 update.effective_user.username,
                 "admin_not_configured"
             )
             return
         
-        try:
-            # Формируем сообщение для админа
-            admin_text = f"🚨 **НОВОЕ СООБЩЕНИЕ ОБ ОПАСНОСТИ**\n\n"
-            admin_text += f"👤 **Пользователь:** @{update.effective_user.username} (ID: {update.effective_user.id})\n"
-            admin_text += f"🕐 **Время:** {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
-            admin_text += f"📝 **Описание:** {data.description}\n\n"
-            admin_text += f"📍 **Местоположение:** {data.location}\n\n"
-            
-            if data.media_files:
-                admin_text += f"📎 **Медиафайлы:** {len(data.media_files)} файлов\n\n"
-            
-            # Отправляем текстовое сообщение
-            await context.bot.send_message(
-                chat_id=admin_chat_id,
-                text=admin_text,
-                parse_mode='Markdown'
-            )
-            
-            # Отправляем медиафайлы
-            for media in data.media_files:
-                try:
-                    if media['file_type'] == 'photo':
-                        await context.bot.send_photo(
-                            chat_id=admin_chat_id,
-                            photo=media['file_id'],
-                            caption=f"Фото от @{update.effective_user.username}"
-                        )
-                    else:  # video
-                        await context.bot.send_video(
-                            chat_id=admin_chat_id,
-                            video=media['file_id'],
-                            caption=f"Видео от @{update.effective_user.username}"
-                        )
-                except Exception as e:
-                    print(f"Ошибка отправки медиафайла: {e}")
-            
-            self.logger.log_activity(
-                update.effective_user.id,
-                update.effective_user.username,
-                "admin_notification_sent"
-            )
-            
-        except Exception as e:
-            print(f"Ошибка отправки в админ-чат: {e}")
+        if self.deduplicator is not None:
+            cluster, is_new = self.deduplicator.add(report)
+            if not is_new:
+                # Повтор уже известного события - обновляем карточки вместо новой рассылки
+                self.cluster_cards.schedule(context.bot, cluster)
+                await self.async_logger.log_activity(
+                    update.effective_user.id,
+                    update.effective_user.username,
+                    "admin_notification_grouped",
+                    f"Cluster: {cluster.cluster_id}, count: {cluster.count}"
+                )
+                return
+            report['cluster_id'] = cluster.cluster_id
+        
+        # Доставкой занимается диспетчер outbox - пользователь не ждет админ-чаты;
+        # у каждого получателя своя запись и свое расписание повторов
+        await run_io(self.outbox.enqueue_many, ADMIN_REPORT,
+                     [(chat_id, dict(report, recipient=name)) for name, chat_id in recipients])
+        self.dispatcher.wake()
+        
+        await self.async_logger.log_activity(
+            update.effective_user.id,
+            update.effective_user.username,
+            "admin_notification_queued",
+            f"Recipients: {', '.join(name for name, _ in recipients)}"
+        )
+    
+    @with_priority(PRIORITY_HIGH)
+    async def deliver_admin_report(self, bot, entry: Dict[str, Any]) -> None:
+        """Доставить сообщение из outbox в дежурный чат (вызывается диспетчером)"""
+        report = entry['payload']
+        # Текст и медиафайлы уходят альбомами по 10, текст - подписью первого файла
+        message, is_caption = await send_report_with_media(
+            bot, entry['chat_id'], self._format_admin_text(report), report['media_files']
+        )
+        
+        cluster = self.deduplicator.get(report.get('cluster_id')) if self.deduplicator else None
+        if cluster is not None:
+            cluster.admin_messages[entry['chat_id']] = (message.message_id, is_caption)
+            if cluster.count > 1:
+                # Похожие сообщения пришли, пока карточка ждала в outbox
+                self.cluster_cards.schedule(bot, cluster)
+        
+        await self.async_logger.log_activity(
+            report['user_id'],
+            report['username'],
+            "admin_notification_sent",
+            f"Recipient: {report.get('recipient', 'admin')}"
+        )
+    
+    @staticmethod
+    def _format_admin_text(report: Dict[str, Any]) -> str:
+        """Текст сообщения для админа"""
+        timestamp = datetime.fromisoformat(report['timestamp'])
+        admin_text = f"🚨 **НОВОЕ СООБЩЕНИЕ ОБ ОПАСНОСТИ**\n\n"
+        admin_text += f"👤 **Пользователь:** @{report['username']} (ID: {report['user_id']})\n"
+        admin_text += f"🕐 **Время:** {timestamp.strftime('%d.%m.%Y %H:%M')}\n\n"
+        admin_text += f"📝 **Описание:** {report['description']}\n\n"
+        admin_text += f"📍 **Местоположение:** {report['location']}\n\n"
+        if report.get('category_titles'):
+            admin_text += f"🏷 **Категория:** {', '.join(report['category_titles'])}\n\n"
+        
+        if report['media_files']:
+            admin_text += f"📎 **Медиафайлы:** {len(report['media_files'])} файлов\n\n"
+        return admin_text
+    
+    def _format_cluster_text(self, cluster: IncidentCluster, limit: Optional[int] = None) -> str:
+        """Карточка события: первое сообщение, счетчик и последние подробности"""
+        return format_cluster_text(cluster, self._format_admin_text(cluster.first), limit)
+    
+    async def flush_admin_updates(self) -> None:
+        """Дождаться отложенных обновлений карточек (при остановке бота)"""
+        await self.cluster_cards.flush()
     
     def validate_media_file(self, file_size: int, file_type: str) -> bool:
         """Валидировать размер медиафайла"""
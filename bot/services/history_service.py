@@ -2,22 +2,51 @@
 Сервис для работы с историей пользователей
 """
 import csv
+import os
+from collections import Counter
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 from bot.interfaces import IFileManager, ILogger
+from bot.utils.activity_archive import CSV_HEADER
+from bot.utils.activity_index import iter_csv_rows_reversed, row_user_id
+from bot.utils.activity_logger import UNVERSIONED_ACTIONS
+from bot.utils.incident_log import resolve_log_path
+from bot.utils.io_executor import run_io
+from bot.utils.paginator import PageCache, paginate
+
+# Префикс callback_data кнопок листания истории
+HISTORY_PAGE_PREFIX = 'hist'
+HISTORY_TITLE = "📊 **Ваша история активности**\n\n"
+EMPTY_HISTORY_TEXT = "📊 **Ваша история**\n\nИстория активности пока пуста."
+# Лог активности, если логгер не сообщает свой путь
+DEFAULT_ACTIVITY_FILE = 'logs/activity.csv'
 
 
 class HistoryService:
     """Сервис для работы с историей пользователей"""
     
-    def __init__(self, file_manager: IFileManager, logger: ILogger):
+    def __init__(self, file_manager: IFileManager, logger: ILogger, max_entries: Optional[int] = None,
+                 page_entries: int = 10):
         self.file_manager = file_manager
         self.logger = logger
+        # Сколько последних записей показывать в /my_history и сколько на одной странице
+        self.max_entries = max_entries or int(os.getenv('HISTORY_MAX_ENTRIES', '50'))
+        self.page_entries = page_entries
+        self.page_cache = PageCache()
     
     def get_user_activities(self, user_id: int) -> List[Dict[str, Any]]:
         """Получить активность пользователя"""
-        activity_file = 'logs/activity.csv'
+        iter_user_activities = getattr(self.logger, 'iter_user_activities', None)
+        if iter_user_activities is not None:
+            # Логгер сам знает, где лежат записи (сегменты по дням, еще не записанная очередь)
+            try:
+                return list(iter_user_activities(user_id))
+            except Exception as e:
+                print(f"Ошибка чтения истории пользователя {user_id}: {e}")
+                return []
+        
+        activity_file = self._activity_file()
         if not self.file_manager.file_exists(activity_file):
             return []
         
@@ -33,42 +62,152 @@ class HistoryService:
         
         return user_activities
     
-    def format_activity_history(self, activities: List[Dict[str, Any]], limit: int = 10) -> str:
-        """Форматировать историю активности"""
+    async def get_user_activities_async(self, user_id: int) -> List[Dict[str, Any]]:
+        """Получить активность пользователя, читая лог вне цикла событий"""
+        return await run_io(self.get_user_activities, user_id)
+    
+    def _activity_file(self) -> str:
+        """CSV лог активности логгера (относительный путь - от корня проекта)"""
+        return resolve_log_path(getattr(self.logger, 'log_file', DEFAULT_ACTIVITY_FILE))
+    
+    def get_user_history(self, user_id: int, limit: int = 10) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, int]]]:
+        """Последние limit записей и счетчики действий пользователя.
+        
+        Если логгер ведет индекс, читаются только последние записи, а
+        статистика берется из счетчиков - память не зависит от длины истории.
+        Без индекса читается только хвост лога; счетчики тогда берутся у
+        логгера (user_action_counts), а если он их не ведет - возвращается
+        None, и статистика строится по прочитанным записям (неполная).
+        """
+        recent_user_activities = getattr(self.logger, 'recent_user_activities', None)
+        user_action_counts = getattr(self.logger, 'user_action_counts', None)
+        if recent_user_activities is not None and user_action_counts is not None:
+            try:
+                return recent_user_activities(user_id, limit), user_action_counts(user_id)
+            except Exception as e:
+                print(f"Ошибка чтения истории пользователя {user_id}: {e}")
+                return [], {}
+        
+        # Лог без индекса: последние записи читаются с конца файла, весь лог не просматривается
+        activity_file = self._activity_file()
+        if not self.file_manager.file_exists(activity_file):
+            return [], {}
+        recent: List[Dict[str, Any]] = []
+        try:
+            with open(activity_file, 'rb') as f:
+                for row in iter_csv_rows_reversed(f):
+                    if row_user_id(row) == user_id:
+                        recent.append(dict(zip(CSV_HEADER, row)))
+                        if len(recent) >= limit:
+                            break
+            counts = user_action_counts(user_id) if user_action_counts is not None else None
+        except Exception as e:
+            print(f"Ошибка чтения истории пользователя {user_id}: {e}")
+            return [], {}
+        recent.reverse()
+        return recent, counts
+    
+    async def get_user_history_async(self, user_id: int, limit: int = 10) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, int]]]:
+        """get_user_history вне цикла событий"""
+        return await run_io(self.get_user_history, user_id, limit)
+    
+    def format_activity_history(self, activities: List[Dict[str, Any]], limit: int = 10,
+                                action_counts: Optional[Dict[str, int]] = None) -> str:
+        """Форматировать историю активности (action_counts - готовые счетчики вместо подсчета по activities)"""
         if not activities:
-            return "📊 **Ваша история**\n\nИстория активности пока пуста."
+            return EMPTY_HISTORY_TEXT
         
-        text = "📊 **Ваша история активности**\n\n"
+        # Подсчитываем типы действий
+        if action_counts is None:
+            action_counts = Counter(activity['action'] for activity in activities)
         
-        # Показываем последние записи
-        recent_activities = activities[-limit:]
+        # Последние записи, затем статистика
+        parts = [HISTORY_TITLE]
+        parts.extend(self._format_entry(activity) for activity in activities[-limit:])
+        parts.append(self._format_stats(action_counts))
+        return ''.join(parts)
+    
+    def render_history_pages(self, activities: List[Dict[str, Any]],
+                             action_counts: Optional[Dict[str, int]]) -> List[str]:
+        """Страницы /my_history: статистика и записи от новых к старым (не длиннее лимита Telegram).
         
-        for activity in recent_activities:
-            timestamp = datetime.fromisoformat(activity['timestamp'])
-            time_str = timestamp.strftime('%d.%m.%Y %H:%M')
-            
-            action_name = self._get_action_name(activity['action'])
-            
-            text += f"• {time_str} - {action_name}\n"
-            if activity['payload_summary']:
-                text += f"  {activity['payload_summary']}\n"
-            text += "\n"
+        action_counts=None - счетчиков нет, статистика по показанным записям с пометкой.
+        """
+        if not activities:
+            return [EMPTY_HISTORY_TEXT]
+        partial = action_counts is None
+        if partial:
+            action_counts = Counter(activity['action'] for activity in activities)
         
-        # Добавляем статистику
-        text += f"📈 **Всего действий:** {len(activities)}\n"
+        def entries():
+            yield self._format_stats(action_counts, partial) + "\n"
+            for activity in reversed(activities):
+                yield self._format_entry(activity)
         
-        # Подсчитываем типы действий
-        action_counts = {}
-        for activity in activities:
-            action = activity['action']
-            action_counts[action] = action_counts.get(action, 0) + 1
+        return paginate(entries(), header=HISTORY_TITLE, max_entries=self.page_entries + 1)
+    
+    def _history_version(self, user_id: int) -> Optional[int]:
+        """Версия истории пользователя от логгера (None - логгер версий не ведет, без кэша)"""
+        user_version = getattr(self.logger, 'user_version', None)
+        return user_version(user_id) if user_version is not None else None
+    
+    def get_cached_history_pages(self, user_id: int) -> Optional[List[str]]:
+        """Страницы из кэша, если у пользователя не было новых записей (без чтения лога)"""
+        version = self._history_version(user_id)
+        return self.page_cache.get(user_id, version) if version is not None else None
+    
+    def _build_history_pages(self, user_id: int, version: Optional[int]) -> List[str]:
+        """Прочитать и отрисовать историю; страницы кэшируются для версии, прочитанной до чтения лога.
         
-        text += "\n📊 **Статистика:**\n"
-        for action, count in action_counts.items():
-            action_name = self._get_action_name(action)
-            text += f"• {action_name}: {count}\n"
+        Действия, не меняющие версию (UNVERSIONED_ACTIONS - просмотр самой
+        истории), на страницы не попадают: иначе страница из кэша показывала
+        бы устаревший счетчик и список запросов истории.
+        """
+        activities, action_counts = self.get_user_history(user_id, self.max_entries)
+        activities = [activity for activity in activities if activity['action'] not in UNVERSIONED_ACTIONS]
+        if action_counts is not None:
+            action_counts = {action: count for action, count in action_counts.items()
+                             if action not in UNVERSIONED_ACTIONS}
+        pages = self.render_history_pages(activities, action_counts)
+        if version is not None:
+            self.page_cache.put(user_id, version, pages)
+        return pages
+    
+    def get_history_pages(self, user_id: int) -> List[str]:
+        """Страницы истории пользователя; повторный запрос и листание берут их из кэша.
         
-        return text
+        Кэш действителен, пока логгер не сообщит о новой записи
+        пользователя (user_version) - тогда история перечитывается.
+        """
+        pages = self.get_cached_history_pages(user_id)
+        if pages is not None:
+            return pages
+        return self._build_history_pages(user_id, self._history_version(user_id))
+    
+    async def get_history_pages_async(self, user_id: int) -> List[str]:
+        """Страницы истории: из кэша - сразу, иначе чтение лога вне цикла событий"""
+        pages = self.get_cached_history_pages(user_id)
+        if pages is not None:
+            return pages
+        return await run_io(self._build_history_pages, user_id, self._history_version(user_id))
+    
+    def _format_entry(self, activity: Dict[str, Any]) -> str:
+        """Одна запись истории"""
+        timestamp = datetime.fromisoformat(activity['timestamp'])
+        text = f"• {timestamp.strftime('%d.%m.%Y %H:%M')} - {self._get_action_name(activity['action'])}\n"
+        if activity['payload_summary']:
+            text += f"  {activity['payload_summary']}\n"
+        return text + "\n"
+    
+    def _format_stats(self, action_counts: Dict[str, int], partial: bool = False) -> str:
+        """Всего действий и счетчики по типам (partial - только по последним записям)"""
+        if partial:
+            lines = [f"📈 **Последних действий:** {sum(action_counts.values())}\n",
+                     "\n📊 **Статистика по последним действиям:**\n"]
+        else:
+            lines = [f"📈 **Всего действий:** {sum(action_counts.values())}\n", "\n📊 **Статистика:**\n"]
+        lines.extend(f"• {self._get_action_name(action)}: {count}\n" for action, count in action_counts.items())
+        return ''.join(lines)
     
     def _get_action_name(self, action: str) -> str:
         """Получить читаемое название действия"""
@@ -76,6 +215,7 @@ class HistoryService:
             'start_command': '🚀 Запуск бота',
             'text_message': '💬 Сообщение',
             'danger_report_started': '🚨 Сообщение об опасности',
+            'danger_report_abandoned': '📝 Черновик не отправлен',
             'incident_saved': '✅ Инцидент сохранен',
             'shelter_finder_started': '🏠 Поиск убежищ',
             'safety_consultant_started': '🧑‍🏫 Консультант',
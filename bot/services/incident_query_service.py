@@ -0,0 +1,131 @@
+"""
+Сервис выборок инцидентов для администраторов
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot.interfaces import IIncidentStore
+from bot.utils.incident_store import extract_building, get_incident_index
+from bot.utils.io_executor import run_io
+
+# Виды выборок /incidents
+KIND_TODAY = 'today'
+KIND_USER = 'user'
+KIND_NEAR = 'near'
+
+QUERY_KINDS = (KIND_TODAY, KIND_USER, KIND_NEAR)
+
+
+class IncidentQueryService:
+    """Постраничные выборки инцидентов из индекса SQLite.
+
+    Каждая страница - один запрос по индексу с пагинацией по id,
+    поэтому ее стоимость не зависит ни от номера страницы,
+    ни от общего числа инцидентов (выборка за день - от числа
+    инцидентов этого дня).
+    """
+
+    def __init__(self, incident_store: IIncidentStore, page_size: int = 5):
+        self.index = get_incident_index(incident_store)
+        self.page_size = page_size
+
+    @staticmethod
+    def is_admin(user_id: int, chat_id: Optional[int] = None) -> bool:
+        """Проверить права администратора (ADMIN_USER_IDS или админ-чат)"""
+        admin_ids = {
+            item.strip() for item in os.getenv('ADMIN_USER_IDS', '').split(',') if item.strip()
+        }
+        if str(user_id) in admin_ids:
+            return True
+        admin_chat_id = os.getenv('ADMIN_CHAT_ID')
+        return chat_id is not None and admin_chat_id is not None and str(chat_id) == admin_chat_id
+
+    @staticmethod
+    def normalize_arg(kind: str, arg: str) -> Optional[str]:
+        """Проверить и нормализовать аргумент выборки (None - аргумент неверный)"""
+        if kind == KIND_TODAY:
+            return arg or datetime.now().strftime('%Y%m%d')
+        if kind == KIND_USER:
+            return arg if arg.isdigit() else None
+        if kind == KIND_NEAR:
+            return extract_building(arg) if arg else None
+        return None
+
+    @staticmethod
+    def _filters(kind: str, arg: str) -> Dict[str, Any]:
+        """Фильтры выборки для SQLiteIncidentStore.page"""
+        if kind == KIND_TODAY:
+            day = datetime.strptime(arg, '%Y%m%d')
+            return {'since': day, 'until': day + timedelta(days=1)}
+        if kind == KIND_USER:
+            return {'user_id': int(arg)}
+        return {'building': arg}
+
+    def get_page(self, kind: str, arg: str, before_id: Optional[int] = None,
+                 after_id: Optional[int] = None) -> Tuple[List[Dict[str, Any]], bool, bool]:
+        """Страница выборки от новых к старым: (инциденты, есть новее, есть старше)"""
+        # Запрашиваем на одну запись больше, чтобы узнать, есть ли продолжение
+        rows = self.index.page(**self._filters(kind, arg), before_id=before_id, after_id=after_id,
+                               limit=self.page_size + 1)
+        has_more = len(rows) > self.page_size
+        if after_id is not None:
+            return rows[-self.page_size:], has_more, True
+        return rows[:self.page_size], before_id is not None, has_more
+
+    async def get_page_async(self, kind: str, arg: str, before_id: Optional[int] = None,
+                             after_id: Optional[int] = None) -> Tuple[List[Dict[str, Any]], bool, bool]:
+        """Получить страницу выборки вне цикла событий"""
+        return await run_io(self.get_page, kind, arg, before_id, after_id)
+
+    def get_incident(self, reference: str) -> Optional[Dict[str, Any]]:
+        """Найти инцидент по номеру (#id) или полному идентификатору"""
+        reference = reference.lstrip('#')
+        if reference.isdigit():
+            return self.index.get_by_rowid(int(reference))
+        return self.index.get(reference)
+
+    async def get_incident_async(self, reference: str) -> Optional[Dict[str, Any]]:
+        """Найти инцидент вне цикла событий"""
+        return await run_io(self.get_incident, reference)
+
+    @staticmethod
+    def page_title(kind: str, arg: str) -> str:
+        """Заголовок выборки"""
+        if kind == KIND_TODAY:
+            return f"📋 Инциденты за {datetime.strptime(arg, '%Y%m%d').strftime('%d.%m.%Y')}"
+        if kind == KIND_USER:
+            return f"📋 Инциденты пользователя {arg}"
+        return f"📋 Инциденты в корпусе {arg}"
+
+    @staticmethod
+    def format_page(title: str, incidents: List[Dict[str, Any]]) -> str:
+        """Краткий список инцидентов страницы"""
+        if not incidents:
+            return f"{title}\n\nИнцидентов не найдено."
+
+        lines = [title, ""]
+        for incident in incidents:
+            timestamp = datetime.fromisoformat(incident['timestamp']).strftime('%d.%m.%Y %H:%M')
+            description = incident['description']
+            if len(description) > 60:
+                description = description[:60] + "..."
+            lines.append(f"#{incident['id']} {timestamp} · @{incident['username'] or incident['user_id']}")
+            lines.append(f"   {description}")
+        lines.append("")
+        lines.append("Подробнее: /incident <номер>")
+        return "\n".join(lines)
+
+    @staticmethod
+    def format_incident(incident: Dict[str, Any]) -> str:
+        """Полная карточка инцидента"""
+        timestamp = datetime.fromisoformat(incident['timestamp']).strftime('%d.%m.%Y %H:%M')
+        text = f"🚨 Инцидент #{incident['id']}\n\n"
+        text += f"👤 Пользователь: @{incident['username']} (ID: {incident['user_id']})\n"
+        text += f"🕐 Время: {timestamp}\n\n"
+        text += f"📝 Описание: {incident['description']}\n\n"
+        text += f"📍 Местоположение: {incident['location']}\n"
+        if incident['media_files']:
+            text += f"\n📎 Медиафайлы: {len(incident['media_files'])} файлов\n"
+        text += f"\n🆔 {incident['incident_id']}"
+        return text
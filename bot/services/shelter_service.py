@@ -7,6 +7,7 @@ from telegram.ext import ContextTypes
 
 from bot.interfaces import IFileManager, ILogger
 from bot.models.user_state import ShelterData
+from bot.utils.io_executor import AsyncFileManager
 
 
 class ShelterService:
@@ -14,11 +15,12 @@ class ShelterService:
     
     def __init__(self, file_manager: IFileManager, logger: ILogger):
         self.file_manager = file_manager
+        self.async_file_manager = AsyncFileManager(file_manager)
         self.logger = logger
     
-    def get_shelters(self) -> List[ShelterData]:
-        """Получить список убежищ"""
-        data = self.file_manager.load_json('configs/data_placeholders.json')
+    async def get_shelters(self) -> List[ShelterData]:
+        """Получить список убежищ (файл читается вне цикла событий)"""
+        data = await self.async_file_manager.load_json('configs/data_placeholders.json')
         shelters_data = data.get('shelters', [])
         
         shelters = []
@@ -36,10 +38,10 @@ class ShelterService:
         
         return shelters
     
-    def get_nearby_shelters(self, user_lat: float, user_lon: float, radius_km: float = 1.0) -> List[ShelterData]:
+    async def get_nearby_shelters(self, user_lat: float, user_lon: float, radius_km: float = 1.0) -> List[ShelterData]:
         """Получить ближайшие убежища (заглушка - возвращает все)"""
         # В реальной версии здесь будет расчет расстояния
-        return self.get_shelters()[:3]  # Возвращаем первые 3
+        return (await self.get_shelters())[:3]  # Возвращаем первые 3
     
     async def send_shelter_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
                               shelter: ShelterData) -> None:
@@ -48,14 +50,14 @@ class ShelterService:
         text += f"{shelter.description}\n\n"
         text += f"📍 Координаты: {shelter.lat}, {shelter.lon}"
         
-        # Отправляем изображение убежища (заглушка)
+        # Отправляем изображение убежища (заглушка), читая файл вне цикла событий
         try:
-            with open(shelter.photo_path, 'rb') as photo:
-                await update.message.reply_photo(
-                    photo=photo,
-                    caption=text,
-                    parse_mode='Markdown'
-                )
+            photo = await self.async_file_manager.read_bytes(shelter.photo_path)
+            await update.message.reply_photo(
+                photo=photo,
+                caption=text,
+                parse_mode='Markdown'
+            )
         except FileNotFoundError:
             # Если файл не найден, отправляем только текст
             await update.message.reply_text(
@@ -0,0 +1,279 @@
+"""
+Аналитика лога активности: DAU, воронка сообщений об опасности, использование по часам
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+
+from bot.utils.activity_archive import CSV_HEADER, list_partitions
+from bot.utils.activity_binary import RECORD, load_symbols
+from bot.utils.activity_index import row_user_id, row_weight
+from bot.utils.block_gzip import BlockGzipReader
+
+DEFAULT_CHUNK_ROWS = 65536
+
+FUNNEL_START = 'danger_report_started'
+FUNNEL_END = 'incident_saved'
+CONSULTANT_SESSION = 'safety_consultant_started'
+CONSULTANT_QUESTION = 'question_asked'
+
+# Запись двоичного лога (RECORD) как структурный тип NumPy
+RECORD_DTYPE = np.dtype([('millis', '<i8'), ('user_id', '<i8'), ('action', '<u2'),
+                         ('username', '<u4'), ('payload', '<u4')])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+
+class ActivityChunk(NamedTuple):
+    """Пачка строк лога по столбцам"""
+    timestamps: np.ndarray   # datetime64[ms], местное время
+    user_ids: np.ndarray     # int64
+    actions: List[str]       # различные действия пачки
+    action_index: np.ndarray # номер действия строки в actions
+    weights: np.ndarray      # int64, событий в строке (агрегированные строки - больше 1)
+
+
+def _csv_chunk(rows: List[List[str]]) -> Optional[ActivityChunk]:
+    try:
+        user_ids = np.fromiter(map(int, [row[1] for row in rows]), dtype=np.int64, count=len(rows))
+        actions = [row[3] for row in rows]
+        refs = [row[5] for row in rows]
+    except (ValueError, IndexError):
+        # Битые строки (заголовок посреди файла и т.п.) - отбираем построчно
+        rows = [row for row in rows if len(row) >= len(CSV_HEADER) and row_user_id(row) is not None]
+        if not rows:
+            return None
+        return _csv_chunk(rows)
+    codes: Dict[str, int] = {}
+    code = codes.setdefault
+    action_index = np.array([code(action, len(codes)) for action in actions], dtype=np.int64)
+    weights = np.ones(len(rows), dtype=np.int64)
+    for position in [position for position, ref in enumerate(refs) if ref]:
+        weights[position] = row_weight(rows[position])
+    return ActivityChunk(np.array([row[0] for row in rows], dtype='datetime64[ms]'), user_ids,
+                         list(codes), action_index, weights)
+
+
+def iter_csv_chunks(lines: Iterable[str], chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Iterator[ActivityChunk]:
+    """Пачки строк CSV лога активности (первая строка - заголовок)"""
+    reader = csv.reader(lines)
+    next(reader, None)
+    while True:
+        rows = list(itertools.islice(reader, chunk_rows))
+        if not rows:
+            return
+        chunk = _csv_chunk(rows)
+        if chunk is not None:
+            yield chunk
+
+
+def _gzip_lines(path: str) -> Iterator[str]:
+    """Строки блочного gzip: распаковывается по блоку за раз"""
+    with BlockGzipReader(path) as reader:
+        for index in range(len(reader.footer['blocks'])):
+            yield from io.StringIO(reader.read_block(index).decode('utf-8'), newline='')
+
+
+def iter_archive_chunks(archive_dir: str, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Iterator[ActivityChunk]:
+    """Пачки строк сегментов по дням (ActivityArchive), по порядку сегментов"""
+    for name, compressed in list_partitions(archive_dir):
+        path = os.path.join(archive_dir, name)
+        if compressed or not os.path.exists(path):
+            yield from iter_csv_chunks(_gzip_lines(path + '.gz'), chunk_rows)
+        else:
+            with open(path, 'r', newline='', encoding='utf-8') as f:
+                yield from iter_csv_chunks(f, chunk_rows)
+
+
+def _local_offset(millis: int) -> np.timedelta64:
+    """Смещение местного времени от UTC (в двоичном логе время хранится от эпохи)"""
+    seconds = millis / 1000
+    offset = datetime.fromtimestamp(seconds) - datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+    return np.timedelta64(round(offset.total_seconds() * 1000), 'ms')
+
+
+def iter_binary_chunks(base_path: str, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Iterator[ActivityChunk]:
+    """Пачки записей двоичного лога (BinaryActivityLog) прямо из отображения файла"""
+    records_path = base_path + '.bin'
+    count = os.path.getsize(records_path) // RECORD.size if os.path.exists(records_path) else 0
+    if not count:
+        return
+    actions, _ = load_symbols(base_path + '.sym')
+    records = np.memmap(records_path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+    for start in range(0, count, chunk_rows):
+        chunk = records[start:start + chunk_rows]
+        millis = chunk['millis']
+        codes, action_index = np.unique(chunk['action'], return_inverse=True)
+        yield ActivityChunk(millis.astype('datetime64[ms]') + _local_offset(int(millis[0])),
+                            chunk['user_id'].astype(np.int64), [actions[code] for code in codes],
+                            action_index.reshape(-1), np.ones(len(chunk), dtype=np.int64))
+
+
+def iter_chunks(source: str, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Iterator[ActivityChunk]:
+    """Пачки строк лога любой раскладки: каталог по дням, CSV файл или база двоичного лога"""
+    if os.path.isdir(source):
+        yield from iter_archive_chunks(source, chunk_rows)
+    elif source.endswith('.bin') or os.path.exists(source + '.bin'):
+        yield from iter_binary_chunks(source[:-4] if source.endswith('.bin') else source, chunk_rows)
+    else:
+        with open(source, 'r', newline='', encoding='utf-8') as f:
+            yield from iter_csv_chunks(f, chunk_rows)
+
+
+class ActivityStats:
+    """Метрики по пачкам строк: память зависит от числа пользователей и дней, не от длины лога.
+
+    Уникальные пользователи каждого дня хранятся до конца прохода (report):
+    пачки не обязаны идти строго по времени (запоздавшие строки, сегменты
+    не по порядку), и пользователь дня, встреченный в разных пачках,
+    считается один раз.
+    """
+
+    def __init__(self, start: Optional[str] = None, end: Optional[str] = None):
+        self.start = np.datetime64(start, 'D') if start else None
+        self.end = np.datetime64(end, 'D') if end else None
+        self.actions: List[str] = []
+        self._codes: Dict[str, int] = {}
+        self.by_hour = np.zeros((0, 24), dtype=np.int64)  # действие x час
+        self.rows = 0
+        self.events = 0
+        self.first_day: Optional[np.datetime64] = None
+        self.last_day: Optional[np.datetime64] = None
+        self._day_users: Dict[np.datetime64, np.ndarray] = {}
+        self._users = {name: np.empty(0, dtype=np.int64) for name in (FUNNEL_START, FUNNEL_END, CONSULTANT_QUESTION)}
+
+    def _code(self, action: str) -> int:
+        code = self._codes.get(action)
+        if code is None:
+            code = self._codes[action] = len(self.actions)
+            self.actions.append(action)
+        return code
+
+    def add(self, chunk: ActivityChunk) -> None:
+        days = chunk.timestamps.astype('datetime64[D]')
+        mask = None
+        if self.start is not None:
+            mask = days >= self.start
+        if self.end is not None:
+            mask = (days < self.end) if mask is None else mask & (days < self.end)
+        lookup = np.array([self._code(action) for action in chunk.actions], dtype=np.int64)
+        codes = lookup[chunk.action_index]
+        timestamps, user_ids, weights = chunk.timestamps, chunk.user_ids, chunk.weights
+        if mask is not None:
+            days, codes, timestamps, user_ids, weights = (days[mask], codes[mask], timestamps[mask],
+                                                          user_ids[mask], weights[mask])
+        if not len(days):
+            return
+        self.rows += len(days)
+        self.events += int(weights.sum())
+
+        # Использование по часам: bincount по (действие, час)
+        hours = (timestamps - days).astype('timedelta64[h]').astype(np.int64)
+        counts = np.bincount(codes * 24 + hours, weights=weights, minlength=len(self.actions) * 24)
+        if self.by_hour.shape[0] < len(self.actions):
+            self.by_hour = np.vstack([self.by_hour, np.zeros((len(self.actions) - self.by_hour.shape[0], 24),
+                                                            dtype=np.int64)])
+        self.by_hour += counts.astype(np.int64).reshape(-1, 24)
+
+        # DAU: уникальные пользователи каждого дня пачки
+        for day in np.unique(days):
+            users = np.unique(user_ids[days == day])
+            known = self._day_users.get(day)
+            self._day_users[day] = users if known is None else np.union1d(known, users)
+        chunk_last = days.max()
+        self.first_day = min(self.first_day, days.min()) if self.first_day is not None else days.min()
+        self.last_day = max(self.last_day, chunk_last) if self.last_day is not None else chunk_last
+
+        # Воронка и вопросы консультанту: уникальные пользователи этапов
+        for action, users in self._users.items():
+            code = self._codes.get(action)
+            if code is not None:
+                self._users[action] = np.union1d(users, user_ids[codes == code])
+
+    def action_total(self, action: str) -> int:
+        code = self._codes.get(action)
+        return int(self.by_hour[code].sum()) if code is not None else 0
+
+    def report(self) -> Dict[str, Any]:
+        """Метрики в виде словаря (для --json и форматирования)"""
+        dau = {str(day): len(users) for day, users in sorted(self._day_users.items())}
+        started, saved = self.action_total(FUNNEL_START), self.action_total(FUNNEL_END)
+        started_users = self._users[FUNNEL_START]
+        saved_users = np.intersect1d(started_users, self._users[FUNNEL_END])
+        sessions, questions = self.action_total(CONSULTANT_SESSION), self.action_total(CONSULTANT_QUESTION)
+        return {
+            'rows': self.rows,
+            'events': self.events,
+            'period': [str(self.first_day), str(self.last_day)] if self.first_day is not None else None,
+            'dau': dau,
+            'dau_avg': round(sum(dau.values()) / len(dau), 2) if dau else 0.0,
+            'funnel': {
+                'started': started,
+                'saved': saved,
+                'started_users': len(started_users),
+                'saved_users': len(saved_users),
+                'conversion': round(len(saved_users) / len(started_users), 4) if len(started_users) else 0.0,
+            },
+            'consultant': {
+                'sessions': sessions,
+                'questions': questions,
+                'users': len(self._users[CONSULTANT_QUESTION]),
+                'questions_per_session': round(questions / sessions, 4) if sessions else 0.0,
+                'questions_per_day': round(questions / len(dau), 2) if dau else 0.0,
+            },
+            'usage_by_hour': {action: self.by_hour[code].tolist() for code, action in enumerate(self.actions)},
+        }
+
+
+def analyze(source: str, start: Optional[str] = None, end: Optional[str] = None,
+            chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Dict[str, Any]:
+    """Метрики лога активности за период [start, end) (даты YYYY-MM-DD)"""
+    stats = ActivityStats(start, end)
+    for chunk in iter_chunks(source, chunk_rows):
+        stats.add(chunk)
+    return stats.report()
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """Отчет для вывода в консоль"""
+    if not report['period']:
+        return "Нет записей за выбранный период"
+    funnel, consultant = report['funnel'], report['consultant']
+    lines = [
+        f"Период: {report['period'][0]} - {report['period'][1]}, событий: {report['events']} (строк: {report['rows']})",
+        f"DAU: в среднем {report['dau_avg']}, максимум {max(report['dau'].values())}",
+        f"Воронка {FUNNEL_START} -> {FUNNEL_END}: {funnel['started']} -> {funnel['saved']} событий, "
+        f"{funnel['started_users']} -> {funnel['saved_users']} пользователей ({funnel['conversion']:.1%})",
+        f"Консультант: сессий {consultant['sessions']}, вопросов {consultant['questions']} "
+        f"({consultant['questions_per_session']} на сессию, {consultant['questions_per_day']} в день), "
+        f"спросивших {consultant['users']}",
+        "Использование по часам (0-23):",
+    ]
+    for action, hours in sorted(report['usage_by_hour'].items(), key=lambda item: -sum(item[1])):
+        lines.append(f"  {action}: {sum(hours)} | {' '.join(str(count) for count in hours)}")
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Аналитика лога активности")
+    parser.add_argument('source', nargs='?', default='logs/activity',
+                        help="каталог по дням, CSV файл или база двоичного лога (без .bin)")
+    parser.add_argument('--start', help="с даты YYYY-MM-DD")
+    parser.add_argument('--end', help="до даты YYYY-MM-DD (не включая)")
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS, help="строк в пачке")
+    parser.add_argument('--json', action='store_true', help="вывести метрики в JSON")
+    args = parser.parse_args(argv)
+    report = analyze(args.source, args.start, args.end, args.chunk_rows)
+    print(json.dumps(report, ensure_ascii=False, indent=1) if args.json else format_report(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,529 @@
+"""
+Лог активности по дням: logs/activity/YYYY-MM-DD[.N].csv[.gz] с манифестом
+"""
+import csv
+import io
+import itertools
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from bot.utils.activity_index import (AGGREGATE_PREFIX, ActivityIndex, IndexEntry, csv_entries,
+                                      iter_csv_rows, iter_file_lines, read_csv_row, row_user_id,
+                                      row_weight)
+from bot.utils.block_gzip import BlockGzipReader, compress_file, write_blocks
+from bot.utils.file_lock import file_lock
+from bot.utils.incident_log import resolve_log_path
+
+CSV_HEADER = ['timestamp', 'user_id', 'username', 'action', 'payload_summary', 'response_ref']
+PARTITION_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})(?:\.(\d+))?\.csv(\.gz)?$')
+MANIFEST_FILE = 'manifest.json'
+INDEX_FILE = 'index.db'
+# Переписанный при сжатии сегмент до подмены: <сегмент>.gz.compact
+COMPACT_SUFFIX = '.gz.compact'
+
+
+def partition_name(day: str, part: int) -> str:
+    return f"{day}.csv" if part == 0 else f"{day}.{part}.csv"
+
+
+def _partition_key(name: str) -> Tuple[str, int]:
+    """Порядок сегментов: по дню, затем по номеру части (2 раньше 10)"""
+    match = PARTITION_PATTERN.match(name)
+    return match.group(1), int(match.group(2) or 0)
+
+
+def list_partitions(archive_dir: str) -> List[Tuple[str, bool]]:
+    """Сегменты каталога лога по порядку: (имя без .gz, сжат ли)"""
+    partitions: Dict[str, bool] = {}
+    for name in os.listdir(archive_dir):
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            base = name[:-3] if match.group(3) else name
+            partitions[base] = partitions.get(base, False) or bool(match.group(3))
+    return sorted(partitions.items(), key=lambda item: _partition_key(item[0]))
+
+
+def _encode_rows(rows: Iterable[list], header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(CSV_HEADER)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def encode_rows_with_offsets(rows: List[list], position: int) -> Tuple[bytes, List[IndexEntry]]:
+    """CSV данные для дозаписи в файл длиной position и записи индекса [(user_id, offset, action, weight)]"""
+    header = _encode_rows([], header=True) if position == 0 else b''
+    chunks, entries = [header], []
+    offset = position + len(header)
+    for row in rows:
+        data = _encode_rows([row], header=False)
+        entries.append((int(row[1]), offset, row[3], row_weight(row)))
+        chunks.append(data)
+        offset += len(data)
+    return b''.join(chunks), entries
+
+
+class ActivityArchive:
+    """Лог активности, разбитый на сегменты по дням.
+
+    Сегмент дня дописывается, пока не превысит max_bytes, затем открывается
+    следующая часть (YYYY-MM-DD.1.csv). Сегменты прошлых дней и заполненные
+    части закрываются и в фоне сжимаются в блочный gzip (block_gzip), так что
+    по несжатому смещению строку можно прочитать, распаковав один блок.
+
+    manifest.json хранит для каждого сегмента число строк, диапазон user_id
+    и времени; читатель пропускает сегменты, в которых не может быть нужного
+    пользователя или периода. Запись и обновление манифеста идут под
+    блокировкой манифеста, поэтому в каталог могут писать несколько процессов.
+
+    index.db (ActivityIndex) хранит смещения строк каждого пользователя:
+    история пользователя читается по смещениям, без просмотра сегментов
+    целиком (у сжатых сегментов смещения несжатые - распаковывается
+    только нужный блок).
+
+    Сегменты старше retention_days (ACTIVITY_RETENTION_DAYS) в фоне
+    переписываются без действий compact_actions (ACTIVITY_COMPACT_ACTIONS):
+    вместо них остается по одной агрегированной строке на пользователя
+    и действие с числом событий (см. compact).
+    """
+
+    def __init__(self, archive_dir: str = 'logs/activity', max_bytes: Optional[int] = None,
+                 import_log: Optional[str] = None, retention_days: Optional[int] = None,
+                 compact_actions: Optional[Iterable[str]] = None):
+        self.archive_dir = resolve_log_path(archive_dir)
+        self.max_bytes = max_bytes or int(float(os.getenv('ACTIVITY_LOG_MAX_MB', '50')) * 1024 * 1024)
+        self.retention_days = (retention_days if retention_days is not None
+                               else int(os.getenv('ACTIVITY_RETENTION_DAYS', '90')))
+        if compact_actions is None:
+            compact_actions = os.getenv('ACTIVITY_COMPACT_ACTIONS', 'text_message').split(',')
+        self.compact_actions = frozenset(action.strip() for action in compact_actions if action.strip())
+        self._compact_lock = threading.Lock()
+        self.manifest_path = os.path.join(self.archive_dir, MANIFEST_FILE)
+        self.max_chunk_rows = 1000  # размер сегмента проверяется не реже, чем раз в столько строк
+        self._file = None
+        self._file_name: Optional[str] = None
+        self._compress_threads: List[threading.Thread] = []
+
+        is_new = not os.path.isdir(self.archive_dir)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.index = ActivityIndex(os.path.join(self.archive_dir, INDEX_FILE))
+        if is_new and import_log and os.path.exists(resolve_log_path(import_log)):
+            self._import_csv(resolve_log_path(import_log))
+        self._finish_compaction()
+        self._compress_pending()
+        self._sync_index()
+        self._start_compaction()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.archive_dir, name)
+
+    def load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """Сегмент -> статистика (для сегментов, записанных этим классом)"""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Ошибка чтения манифеста лога активности: {e}")
+            return {}
+
+    def _save_manifest(self, manifest: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _list_partitions(self) -> Dict[str, bool]:
+        """Сегмент (имя без .gz) -> сжат ли"""
+        return dict(list_partitions(self.archive_dir))
+
+    # --- запись ---
+
+    def _open_partition(self, manifest: Dict[str, Dict[str, Any]], day: str,
+                        closing: List[str]) -> str:
+        """Сегмент для дозаписи строк дня: закрывает прошлые дни и заполненные части"""
+        def close(name: str) -> None:
+            manifest[name]['closed'] = True
+            closing.append(name)
+
+        open_names = sorted((name for name, entry in manifest.items() if not entry.get('closed')),
+                            key=_partition_key)
+        for name in open_names[:-1]:
+            close(name)
+        current = open_names[-1] if open_names else None
+        if current is not None:
+            current_day = _partition_key(current)[0]
+            if current_day < day:
+                close(current)
+                current = None
+            else:
+                # Запоздавшие строки прошлого дня дописываются в текущий сегмент
+                day = current_day
+        if current is not None and manifest[current].get('size', 0) >= self.max_bytes:
+            close(current)
+            current = None
+        if current is None:
+            part = 0
+            while (partition_name(day, part) in manifest
+                   or os.path.exists(self._path(partition_name(day, part)))
+                   or os.path.exists(self._path(partition_name(day, part)) + '.gz')):
+                part += 1
+            current = partition_name(day, part)
+            manifest[current] = {'rows': 0, 'size': 0, 'min_user': None, 'max_user': None,
+                                 'min_ts': None, 'max_ts': None, 'closed': False, 'compressed': False}
+        return current
+
+    def write_rows(self, rows: List[list]) -> None:
+        """Дописать строки [timestamp, user_id, ...] в сегменты их дней"""
+        if not rows:
+            return
+        closing: List[str] = []
+        with file_lock(self.manifest_path):
+            manifest = self.load_manifest()
+            start = 0
+            while start < len(rows):
+                name = self._open_partition(manifest, rows[start][0][:10], closing)
+                entry = manifest[name]
+                # Строки одного дня (и запоздавшие) уходят в сегмент одним вызовом write
+                end = start + 1
+                while end < len(rows) and end - start < self.max_chunk_rows \
+                        and rows[end][0][:10] <= _partition_key(name)[0]:
+                    end += 1
+                chunk = rows[start:end]
+                self._append(name, entry, chunk)
+                start = end
+            self._save_manifest(manifest)
+        for name in closing:
+            self._start_compression(name)
+
+    def _append(self, name: str, entry: Dict[str, Any], rows: List[list]) -> None:
+        if self._file_name != name:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self._path(name), 'ab', buffering=0)
+            self._file_name = name
+        position = self._file.seek(0, os.SEEK_END)
+        data, offsets = encode_rows_with_offsets(rows, position)
+        self._file.write(data)
+        self.index.add(name, offsets, position + len(data))
+
+        user_ids = [int(row[1]) for row in rows]
+        timestamps = [row[0] for row in rows]
+        entry['rows'] += len(rows)
+        entry['size'] = entry.get('size', 0) + len(data)
+        entry['min_user'] = min(user_ids + ([entry['min_user']] if entry['min_user'] is not None else []))
+        entry['max_user'] = max(user_ids + ([entry['max_user']] if entry['max_user'] is not None else []))
+        entry['min_ts'] = min(timestamps + ([entry['min_ts']] if entry['min_ts'] else []))
+        entry['max_ts'] = max(timestamps + ([entry['max_ts']] if entry['max_ts'] else []))
+
+    def _import_csv(self, log_file: str, chunk_size: int = 10000) -> None:
+        """Перенести строки старого logs/activity.csv в сегменты по дням"""
+        with open(log_file, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            next(reader, None)  # заголовок
+            chunk: List[list] = []
+            for row in reader:
+                if len(row) < len(CSV_HEADER) or not row[1].lstrip('-').isdigit():
+                    continue
+                chunk.append(row[:len(CSV_HEADER)])
+                if len(chunk) >= chunk_size:
+                    self.write_rows(chunk)
+                    chunk = []
+            self.write_rows(chunk)
+
+    # --- сжатие ---
+
+    def _finish_compaction(self) -> None:
+        """Завершить подмену сегментов, прерванную сбоем (см. compact).
+
+        Если индекс уже указывает на новый файл (размер совпадает), файл
+        подменяется; иначе индекс старый и новый файл просто удаляется.
+        """
+        with file_lock(self.manifest_path):
+            manifest = self.load_manifest()
+            for file_name in os.listdir(self.archive_dir):
+                if not file_name.endswith(COMPACT_SUFFIX):
+                    continue
+                name = file_name[:-len(COMPACT_SUFFIX)]
+                compact_path = self._path(file_name)
+                try:
+                    with BlockGzipReader(compact_path) as reader:
+                        size = reader.footer['uncompressed_size']
+                        rows = sum(1 for _ in csv_entries(reader.iter_lines()))
+                    if self.index.sizes().get(name) != size or name not in manifest:
+                        os.remove(compact_path)
+                        continue
+                    os.replace(compact_path, self._path(name) + '.gz')
+                    manifest[name].update(rows=rows, size=size, compacted=True)
+                    self._save_manifest(manifest)
+                except Exception as e:
+                    print(f"Ошибка восстановления сегмента лога активности {name}: {e}")
+
+    def _compress_pending(self) -> None:
+        """Сжать закрытые, но несжатые сегменты (после перезапуска) и закрыть прошлые дни"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        closing = []
+        with file_lock(self.manifest_path):
+            manifest = self.load_manifest()
+            for name, entry in manifest.items():
+                if not entry.get('closed') and _partition_key(name)[0] < today:
+                    entry['closed'] = True
+                if entry.get('closed') and not entry.get('compressed'):
+                    closing.append(name)
+            self._save_manifest(manifest)
+        for name in closing:
+            self._start_compression(name)
+
+    def _start_compression(self, name: str) -> None:
+        if self._file_name == name:
+            self._file.close()
+            self._file = self._file_name = None
+        thread = threading.Thread(target=self._compress_partition, args=(name,),
+                                  name=f"compress-activity-{name}", daemon=True)
+        thread.start()
+        self._compress_threads = [t for t in self._compress_threads if t.is_alive()] + [thread]
+
+    def _compress_partition(self, name: str) -> None:
+        """Сжать закрытый сегмент в блочный gzip и отметить это в манифесте"""
+        src = self._path(name)
+        try:
+            if os.path.exists(src):
+                compress_file(src, src + '.gz', {'partition': name})
+            with file_lock(self.manifest_path):
+                manifest = self.load_manifest()
+                if name in manifest:
+                    manifest[name]['compressed'] = True
+                    self._save_manifest(manifest)
+                if os.path.exists(src + '.gz') and os.path.exists(src):
+                    os.remove(src)
+        except Exception as e:
+            print(f"Ошибка сжатия сегмента лога активности {name}: {e}")
+        # Закрылся день - заодно проверяем срок хранения старых сегментов
+        self.compact()
+
+    # --- срок хранения ---
+
+    def _start_compaction(self) -> None:
+        if not self.retention_days or not self.compact_actions:
+            return
+        thread = threading.Thread(target=self.compact, name="compact-activity", daemon=True)
+        thread.start()
+        self._compress_threads = [t for t in self._compress_threads if t.is_alive()] + [thread]
+
+    def compact(self, now: Optional[datetime] = None) -> int:
+        """Переписать сжатые сегменты старше срока хранения; возвращает число переписанных.
+
+        Строки действий compact_actions заменяются агрегированными строками
+        [время последнего события, user_id, имя, действие, "Всего за день: N",
+        "aggregate:N"] в конце сегмента. Сегмент пишется рядом
+        (<сегмент>.gz.compact), затем одной транзакцией заменяются его
+        смещения в индексе, файл подменяется (os.replace) и обновляется
+        манифест; прерванная подмена завершается при следующем открытии.
+        """
+        if not self.retention_days or not self.compact_actions:
+            return 0
+        cutoff = ((now or datetime.now()) - timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+        compacted = 0
+        with self._compact_lock:
+            for name, entry in sorted(self.load_manifest().items(), key=lambda item: _partition_key(item[0])):
+                if _partition_key(name)[0] >= cutoff:
+                    break
+                if not entry.get('compressed') or entry.get('compacted'):
+                    continue
+                try:
+                    compacted += self._compact_partition(name)
+                except Exception as e:
+                    print(f"Ошибка сжатия старого сегмента лога активности {name}: {e}")
+        return compacted
+
+    def _compact_partition(self, name: str) -> bool:
+        src = self._path(name) + '.gz'
+        compact_path = self._path(name) + COMPACT_SUFFIX
+        entries: List[IndexEntry] = []
+        # (user_id, действие) -> [число событий, имя, время последнего]
+        aggregates: Dict[Tuple[int, str], list] = {}
+        stats = {'rows': 0, 'dropped': 0}
+
+        def lines() -> Iterator[bytes]:
+            header = _encode_rows([], header=True)
+            position = len(header)
+
+            def emit(row: list) -> bytes:
+                nonlocal position
+                data = _encode_rows([row], header=False)
+                entries.append((int(row[1]), position, row[3], row_weight(row)))
+                stats['rows'] += 1
+                position += len(data)
+                return data
+
+            yield header
+            with BlockGzipReader(src) as reader:
+                for _, row in iter_csv_rows(reader.iter_lines()):
+                    user_id = row_user_id(row)
+                    if user_id is None:
+                        continue
+                    if row[3] in self.compact_actions:
+                        aggregate = aggregates.setdefault((user_id, row[3]), [0, row[2], row[0]])
+                        aggregate[0] += row_weight(row)
+                        aggregate[1] = row[2] or aggregate[1]
+                        aggregate[2] = max(aggregate[2], row[0])
+                        stats['dropped'] += 1
+                        continue
+                    yield emit(row)
+            for (user_id, action), (count, username, timestamp) in aggregates.items():
+                yield emit([timestamp, str(user_id), username, action,
+                            f"Всего за день: {count}", f"{AGGREGATE_PREFIX}{count}"])
+
+        footer = write_blocks(lines(), compact_path, {'partition': name, 'compacted': True})
+        with file_lock(self.manifest_path):
+            manifest = self.load_manifest()
+            entry = manifest.get(name)
+            indexed = self.index.sizes().get(name)
+            # Сегмент уже переписан другим процессом или еще не проиндексирован (счетчики не учтены)
+            if entry is None or entry.get('compacted') or indexed != entry.get('size'):
+                os.remove(compact_path)
+                return False
+            # Нечего отбрасывать; при совпавшем размере прерванную подмену нельзя было бы распознать
+            if not stats['dropped'] or footer['uncompressed_size'] == indexed:
+                os.remove(compact_path)
+                entry['compacted'] = True
+                self._save_manifest(manifest)
+                return False
+            self.index.replace_segment(name, entries, footer['uncompressed_size'])
+            os.replace(compact_path, src)
+            entry.update(rows=stats['rows'], size=footer['uncompressed_size'],
+                         dropped=stats['dropped'], compacted=True)
+            self._save_manifest(manifest)
+        return True
+
+    def wait_for_compression(self) -> None:
+        """Дождаться фонового сжатия закрытых сегментов"""
+        for thread in self._compress_threads:
+            thread.join()
+        self._compress_threads = []
+
+    def close(self) -> None:
+        self.wait_for_compression()
+        if self._file is not None:
+            self._file.close()
+            self._file = self._file_name = None
+        self.index.close()
+
+    # --- индекс ---
+
+    def _segment_size(self, name: str, compressed: bool, manifest: Dict[str, Dict[str, Any]]) -> int:
+        """Несжатый размер сегмента"""
+        if name in manifest:
+            return manifest[name].get('size', 0)
+        if not compressed:
+            return os.path.getsize(self._path(name))
+        with BlockGzipReader(self._path(name) + '.gz') as reader:
+            return reader.footer['uncompressed_size']
+
+    def _segment_lines(self, name: str, offset: int) -> Iterator[Tuple[int, bytes]]:
+        """Строки сегмента (сжатого или нет) начиная с несжатого смещения"""
+        try:
+            f = open(self._path(name), 'rb')
+        except FileNotFoundError:
+            with BlockGzipReader(self._path(name) + '.gz') as reader:
+                yield from reader.iter_lines(offset)
+            return
+        with f:
+            yield from iter_file_lines(f, offset)
+
+    def _sync_index(self) -> None:
+        """Дочитать в индекс строки, которых в нем нет (новый индекс или сбой между записями)"""
+        with file_lock(self.manifest_path):
+            manifest = self.load_manifest()
+            for name, compressed in self._list_partitions().items():
+                try:
+                    size = self._segment_size(name, compressed, manifest)
+                    self.index.sync(name, size,
+                                    lambda offset, name=name: csv_entries(self._segment_lines(name, offset)))
+                except Exception as e:
+                    print(f"Ошибка индексации сегмента лога активности {name}: {e}")
+
+    def _read_rows_at(self, name: str, offsets: Iterable[int]) -> Iterator[List[str]]:
+        """Строки сегмента по смещениям из индекса"""
+        try:
+            f = open(self._path(name), 'rb')
+        except FileNotFoundError:
+            with BlockGzipReader(self._path(name) + '.gz') as reader:
+                for offset in offsets:
+                    yield read_csv_row(reader.iter_lines(offset))
+            return
+        with f:
+            for offset in offsets:
+                yield read_csv_row(iter_file_lines(f, offset))
+
+    # --- чтение ---
+
+    def partitions(self, user_id: Optional[int] = None, start: Optional[str] = None,
+                   end: Optional[str] = None) -> List[Tuple[str, bool]]:
+        """Сегменты, которые могут содержать пользователя и период [start, end): (имя, сжат ли)"""
+        manifest = self.load_manifest()
+        result = []
+        for name, compressed in list_partitions(self.archive_dir):
+            entry = manifest.get(name)
+            if entry is not None and entry.get('rows'):
+                if user_id is not None and not entry['min_user'] <= user_id <= entry['max_user']:
+                    continue
+                if start is not None and entry['max_ts'] < start:
+                    continue
+                if end is not None and entry['min_ts'] >= end:
+                    continue
+            elif entry is not None:
+                continue  # пустой сегмент
+            result.append((name, compressed))
+        return result
+
+    def _iter_lines(self, name: str, compressed: bool) -> Iterator[str]:
+        if not compressed and not os.path.exists(self._path(name)):
+            # Сегмент успели сжать, пока шел запрос
+            compressed = True
+        if compressed:
+            with BlockGzipReader(self._path(name) + '.gz') as reader:
+                for _, line in reader.iter_lines():
+                    yield line.decode('utf-8')
+        else:
+            with open(self._path(name), 'r', newline='', encoding='utf-8') as f:
+                yield from f
+
+    def iter_user_rows(self, user_id: int, newest_first: bool = False) -> Iterator[Dict[str, str]]:
+        """Строки пользователя по индексу: читаются только они (время зависит от их числа).
+
+        newest_first - с конца лога: последние N записей читаются без
+        чтения остальных (сегменты и блоки gzip идут от последних к первым).
+        """
+        offsets = self.index.iter_offsets(user_id, newest_first)
+        # Подряд идущие смещения одного сегмента читаются через один открытый файл
+        for name, group in itertools.groupby(offsets, key=lambda item: item[0]):
+            for row in self._read_rows_at(name, (offset for _, offset in group)):
+                if row is not None and row_user_id(row) == user_id:
+                    yield dict(zip(CSV_HEADER, row))
+
+    def iter_rows(self, user_id: Optional[int] = None, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None) -> Iterator[Dict[str, str]]:
+        """Строки активности (по возрастанию времени) с фильтром по пользователю и периоду"""
+        start_str = start.isoformat() if start else None
+        end_str = end.isoformat() if end else None
+        if user_id is not None:
+            for row in self.iter_user_rows(user_id):
+                if (start_str is None or row['timestamp'] >= start_str) and \
+                        (end_str is None or row['timestamp'] < end_str):
+                    yield row
+            return
+        for name, compressed in self.partitions(user_id, start_str, end_str):
+            for row in csv.DictReader(self._iter_lines(name, compressed)):
+                if start_str is not None and row['timestamp'] < start_str:
+                    continue
+                if end_str is not None and row['timestamp'] >= end_str:
+                    continue
+                yield row
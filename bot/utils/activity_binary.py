@@ -0,0 +1,304 @@
+"""
+Компактный двоичный формат лога активности (записи фиксированной длины + куча строк)
+"""
+import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bot.utils.activity_archive import CSV_HEADER
+from bot.utils.activity_index import ActivityIndex, IndexEntry
+from bot.utils.incident_log import resolve_log_path
+
+# Запись: время (мс от эпохи), user_id, id действия, id имени пользователя, смещение payload в куче
+RECORD = struct.Struct('<qqHII')
+NO_PAYLOAD = 0xFFFFFFFF
+# Длина строки в куче
+HEAP_LENGTH = struct.Struct('<H')
+
+# Реестр действий: постоянные id известных действий (новые получают id по порядку появления)
+KNOWN_ACTIONS = (
+    'start_command', 'text_message', 'history_requested', 'danger_report_started',
+    'incident_saved', 'shelter_finder_started', 'safety_consultant_started', 'question_asked',
+    'admin_notification_queued', 'admin_notification_sent', 'admin_notification_grouped',
+    'admin_not_configured', 'log_overflow',
+)
+
+
+def _to_millis(timestamp: str) -> int:
+    return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+def _from_millis(millis: int) -> str:
+    return datetime.fromtimestamp(millis / 1000).isoformat(timespec='milliseconds')
+
+
+def load_symbols(symbols_path: str) -> Tuple[List[str], List[str]]:
+    """Реестр действий и имен пользователей: id - позиция в списке"""
+    actions, usernames = list(KNOWN_ACTIONS), []
+    if os.path.exists(symbols_path):
+        with open(symbols_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    kind, value = json.loads(line)
+                except ValueError:
+                    continue  # недописанная строка
+                (actions if kind == 'a' else usernames).append(value)
+    return actions, usernames
+
+
+class BinaryActivityLog:
+    """Лог активности в двоичном виде: <base>.bin, <base>.heap, <base>.sym.
+
+    .bin - записи RECORD по 26 байт, .heap - строки payload (uint16 длина +
+    UTF-8), .sym - реестр действий и имен пользователей (JSON Lines).
+    Имена и действия хранятся один раз, повторяющиеся payload (кнопки
+    меню) - тоже: кэш последних payload_cache значений указывает на уже
+    записанную строку. Время хранится с точностью до миллисекунды,
+    response_ref не хранится (не используется).
+
+    Файлы дописываются в порядке куча -> реестр -> записи, поэтому
+    запись никогда не ссылается на недописанную строку; неполная запись
+    в хвосте .bin при чтении отбрасывается. Писатель у лога один.
+
+    <base>.idx.db (ActivityIndex) хранит смещения записей каждого
+    пользователя и счетчики его действий.
+    """
+
+    def __init__(self, base_path: str = 'logs/activity', payload_cache: int = 4096):
+        self.base_path = resolve_log_path(base_path)
+        self.records_path = self.base_path + '.bin'
+        self.heap_path = self.base_path + '.heap'
+        self.symbols_path = self.base_path + '.sym'
+        self.payload_cache = payload_cache
+        base_dir = os.path.dirname(self.base_path)
+        if base_dir:
+            os.makedirs(base_dir, exist_ok=True)
+
+        self.actions, self.usernames = load_symbols(self.symbols_path)
+        self._action_ids = {name: index for index, name in enumerate(self.actions)}
+        self._username_ids = {name: index for index, name in enumerate(self.usernames)}
+        self._payloads: 'OrderedDict[str, int]' = OrderedDict()
+        self._files = None
+        self.segment = os.path.basename(self.records_path)
+        self.index = ActivityIndex(self.base_path + '.idx.db')
+        if os.path.exists(self.records_path):
+            self.index.sync(self.segment, os.path.getsize(self.records_path) // RECORD.size * RECORD.size,
+                            self._index_entries)
+
+    def _index_entries(self, offset: int) -> Iterator[IndexEntry]:
+        """Записи индекса для записей лога начиная со смещения (пересборка индекса)"""
+        with self.reader() as reader:
+            for index, record in enumerate(RECORD.iter_unpack(reader.records[offset:])):
+                yield record[1], offset + index * RECORD.size, reader.actions[record[2]], 1
+
+    def _open(self):
+        if self._files is None:
+            self._files = tuple(open(path, 'ab') for path in (self.heap_path, self.symbols_path, self.records_path))
+        return self._files
+
+    def _symbol(self, ids: Dict[str, int], values: List[str], kind: str, value: str,
+                new_symbols: List[str]) -> int:
+        symbol_id = ids.get(value)
+        if symbol_id is None:
+            symbol_id = ids[value] = len(values)
+            values.append(value)
+            new_symbols.append(json.dumps([kind, value], ensure_ascii=False) + '\n')
+        return symbol_id
+
+    def _payload_offset(self, payload: str, heap_chunks: List[bytes], heap_size: int) -> Tuple[int, int]:
+        """Смещение строки payload в куче (повторы берутся из кэша); возвращает (смещение, новый размер)"""
+        if not payload:
+            return NO_PAYLOAD, heap_size
+        offset = self._payloads.get(payload)
+        if offset is not None:
+            self._payloads.move_to_end(payload)
+            return offset, heap_size
+        data = payload.encode('utf-8')[:0xFFFF]
+        heap_chunks.append(HEAP_LENGTH.pack(len(data)) + data)
+        offset = heap_size
+        self._payloads[payload] = offset
+        if len(self._payloads) > self.payload_cache:
+            self._payloads.popitem(last=False)
+        return offset, heap_size + HEAP_LENGTH.size + len(data)
+
+    def write_rows(self, rows: List[list]) -> None:
+        """Дописать строки [timestamp, user_id, username, action, payload, response_ref]"""
+        if not rows:
+            return
+        heap, symbols, records = self._open()
+        heap_size = heap.seek(0, os.SEEK_END)
+        position = records.seek(0, os.SEEK_END)
+        heap_chunks: List[bytes] = []
+        new_symbols: List[str] = []
+        entries: List[IndexEntry] = []
+        packed = bytearray()
+        for row in rows:
+            timestamp, user_id, username, action, payload = row[:5]
+            action_id = self._symbol(self._action_ids, self.actions, 'a', action, new_symbols)
+            username_id = self._symbol(self._username_ids, self.usernames, 'u', username, new_symbols)
+            offset, heap_size = self._payload_offset(payload, heap_chunks, heap_size)
+            entries.append((int(user_id), position + len(packed), action, 1))
+            packed += RECORD.pack(_to_millis(timestamp), int(user_id), action_id, username_id, offset)
+
+        if heap_chunks:
+            heap.write(b''.join(heap_chunks))
+            heap.flush()
+        if new_symbols:
+            symbols.write(''.join(new_symbols).encode('utf-8'))
+            symbols.flush()
+        records.write(packed)
+        records.flush()
+        self.index.add(self.segment, entries, position + len(packed))
+
+    def close(self) -> None:
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+        self.index.close()
+
+    def reader(self) -> 'BinaryActivityReader':
+        return BinaryActivityReader(self.base_path)
+
+    def iter_rows(self, user_id: Optional[int] = None, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None) -> Iterator[Dict[str, str]]:
+        """Строки активности в виде словарей, как у csv.DictReader"""
+        with self.reader() as reader:
+            yield from reader.iter_rows(user_id, start, end)
+
+    def iter_user_rows(self, user_id: int, newest_first: bool = False) -> Iterator[Dict[str, str]]:
+        """Записи пользователя по индексу (newest_first - с конца лога)"""
+        with self.reader() as reader:
+            for _, offset in self.index.iter_offsets(user_id, newest_first):
+                if offset + RECORD.size <= len(reader.records):
+                    yield reader.to_row(RECORD.unpack_from(reader.records, offset))
+
+
+class BinaryActivityReader:
+    """Чтение двоичного лога через mmap без копирования записей.
+
+    Записи разбираются struct.iter_unpack прямо из отображения файла;
+    строки из кучи декодируются только для отобранных записей.
+    """
+
+    def __init__(self, base_path: str):
+        self.base_path = resolve_log_path(base_path)
+        self.actions, self.usernames = load_symbols(self.base_path + '.sym')
+        self._records = self._map(self.base_path + '.bin')
+        self._heap = self._map(self.base_path + '.heap')
+        count = len(self._records) // RECORD.size if self._records is not None else 0
+        self.records = memoryview(self._records)[:count * RECORD.size] if count else memoryview(b'')
+
+    @staticmethod
+    def _map(path: str) -> Optional[mmap.mmap]:
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.records) // RECORD.size
+
+    def payload(self, offset: int) -> str:
+        if offset == NO_PAYLOAD or self._heap is None:
+            return ""
+        length, = HEAP_LENGTH.unpack_from(self._heap, offset)
+        start = offset + HEAP_LENGTH.size
+        return self._heap[start:start + length].decode('utf-8')
+
+    def iter_records(self) -> Iterator[Tuple[int, int, int, int, int]]:
+        """Сырые записи (мс, user_id, id действия, id имени, смещение payload)"""
+        return RECORD.iter_unpack(self.records)
+
+    def to_row(self, record: Tuple[int, int, int, int, int]) -> Dict[str, str]:
+        millis, user_id, action_id, username_id, offset = record
+        return {
+            'timestamp': _from_millis(millis),
+            'user_id': str(user_id),
+            'username': self.usernames[username_id],
+            'action': self.actions[action_id],
+            'payload_summary': self.payload(offset),
+            'response_ref': '',
+        }
+
+    def iter_rows(self, user_id: Optional[int] = None, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None) -> Iterator[Dict[str, str]]:
+        start_ms = int(start.timestamp() * 1000) if start else None
+        end_ms = int(end.timestamp() * 1000) if end else None
+        for record in RECORD.iter_unpack(self.records):
+            if user_id is not None and record[1] != user_id:
+                continue
+            if start_ms is not None and record[0] < start_ms:
+                continue
+            if end_ms is not None and record[0] >= end_ms:
+                continue
+            yield self.to_row(record)
+
+    def close(self) -> None:
+        self.records.release()
+        for mapped in (self._records, self._heap):
+            if mapped is not None:
+                mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def csv_to_binary(csv_path: str, base_path: str, chunk_size: int = 10000) -> int:
+    """Перевести CSV лог активности в двоичный; возвращает число записей"""
+    log = BinaryActivityLog(base_path)
+    count = 0
+    try:
+        with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+            chunk: List[list] = []
+            for row in csv.DictReader(f):
+                chunk.append([row[column] for column in CSV_HEADER])
+                if len(chunk) >= chunk_size:
+                    log.write_rows(chunk)
+                    count += len(chunk)
+                    chunk = []
+            log.write_rows(chunk)
+            count += len(chunk)
+    finally:
+        log.close()
+    return count
+
+
+def binary_to_csv(base_path: str, csv_path: str) -> int:
+    """Перевести двоичный лог активности в CSV; возвращает число записей"""
+    count = 0
+    with BinaryActivityReader(base_path) as reader, open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for row in reader.iter_rows():
+            writer.writerow([row[column] for column in CSV_HEADER])
+            count += 1
+    return count
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Конвертер лога активности CSV <-> двоичный формат")
+    parser.add_argument('direction', choices=['to-binary', 'to-csv'])
+    parser.add_argument('source', help="CSV файл или база двоичного лога (без .bin)")
+    parser.add_argument('target', help="база двоичного лога (без .bin) или CSV файл")
+    args = parser.parse_args(argv)
+    if args.direction == 'to-binary':
+        count = csv_to_binary(args.source, args.target)
+    else:
+        count = binary_to_csv(args.source, args.target)
+    print(f"Записей: {count}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""
+Индекс лога активности: user_id -> смещения строк пользователя (SQLite)
+"""
+import csv
+import io
+import os
+import sqlite3
+from collections import Counter
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from bot.utils.incident_log import resolve_log_path
+from bot.utils.sqlite_connections import ThreadLocalSQLite
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS offsets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    segment TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_offsets_user ON offsets(user_id, id);
+CREATE INDEX IF NOT EXISTS idx_offsets_segment ON offsets(segment);
+CREATE TABLE IF NOT EXISTS segments (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    user_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, action)
+) WITHOUT ROWID;
+"""
+# Версия схемы (PRAGMA user_version): индекс старой версии пересобирается из лога
+SCHEMA_VERSION = 1
+
+# Запись индекса: (user_id, смещение строки, действие, сколько событий в строке)
+IndexEntry = Tuple[int, int, str, int]
+# response_ref агрегированной строки (см. ActivityArchive.compact): aggregate:<число событий>
+AGGREGATE_PREFIX = 'aggregate:'
+
+SQL_INSERT_OFFSET = "INSERT INTO offsets (user_id, segment, position) VALUES (?, ?, ?)"
+SQL_SET_SIZE = (
+    "INSERT INTO segments (name, size) VALUES (?, ?) "
+    "ON CONFLICT(name) DO UPDATE SET size = MAX(size, excluded.size)"
+)
+SQL_COUNT = (
+    "INSERT INTO counters (user_id, action, count) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id, action) DO UPDATE SET count = count + excluded.count"
+)
+SQL_INSERT_OFFSET_ID = "INSERT INTO offsets (id, user_id, segment, position) VALUES (?, ?, ?, ?)"
+SQL_SEGMENT_IDS = "SELECT id FROM offsets WHERE segment = ? ORDER BY id"
+SQL_DELETE_SEGMENT = "DELETE FROM offsets WHERE segment = ?"
+SQL_REPLACE_SIZE = "INSERT OR REPLACE INTO segments (name, size) VALUES (?, ?)"
+SQL_BY_USER = "SELECT segment, position FROM offsets WHERE user_id = ? ORDER BY id"
+SQL_BY_USER_DESC = "SELECT segment, position FROM offsets WHERE user_id = ? ORDER BY id DESC"
+SQL_COUNTS = "SELECT action, count FROM counters WHERE user_id = ?"
+
+
+def iter_file_lines(f: BinaryIO, offset: int = 0) -> Iterator[Tuple[int, bytes]]:
+    """Строки открытого (в режиме 'rb') файла начиная со смещения: пары (смещение, строка)"""
+    f.seek(offset)
+    position = offset
+    for line in f:
+        yield position, line
+        position += len(line)
+
+
+def iter_path_lines(path: str, offset: int = 0) -> Iterator[Tuple[int, bytes]]:
+    with open(path, 'rb') as f:
+        yield from iter_file_lines(f, offset)
+
+
+def iter_csv_rows(lines: Iterable[Tuple[int, bytes]]) -> Iterator[Tuple[int, List[str]]]:
+    """CSV строки с их смещениями; строка может занимать несколько физических строк"""
+    row_start: List[Optional[int]] = [None]
+
+    def text_lines() -> Iterator[str]:
+        for position, line in lines:
+            if row_start[0] is None:
+                row_start[0] = position
+            yield line.decode('utf-8')
+
+    for row in csv.reader(text_lines()):
+        start, row_start[0] = row_start[0], None
+        yield start, row
+
+
+def iter_csv_rows_reversed(f: BinaryIO, block_size: int = 64 * 1024) -> Iterator[List[str]]:
+    """CSV строки открытого (в режиме 'rb') файла с конца, блоками от последнего к первому.
+
+    Для лога без индекса: последние N строк читаются без просмотра файла
+    целиком. Перевод строки - граница записи, если после него до конца
+    файла четное число кавычек (внутри поля в кавычках - нечетное),
+    поэтому переводы строк в полях не разрывают запись. Недописанная
+    последняя строка (без перевода строки в конце) пропускается.
+    """
+    position = f.seek(0, os.SEEK_END)
+    pending = b''       # начало последней еще не найденной записи и все после него
+    pending_quotes = 0  # кавычки в pending
+    torn = True         # хвост до первого перевода строки с конца еще не отброшен
+    while position > 0:
+        size = min(block_size, position)
+        position -= size
+        f.seek(position)
+        data = f.read(size) + pending
+        record_end = len(data)
+        quotes, scan = pending_quotes, size
+        while True:
+            newline = data.rfind(b'\n', 0, scan)
+            if newline < 0:
+                break
+            quotes += data.count(b'"', newline + 1, scan)
+            scan = newline
+            if torn:
+                torn = False
+            elif quotes % 2:
+                continue
+            else:
+                yield from csv.reader(io.StringIO(data[newline + 1:record_end].decode('utf-8'), newline=''))
+            record_end, quotes = newline + 1, 0
+        pending = data[:record_end]
+        pending_quotes = quotes + data.count(b'"', 0, scan)
+    if pending and not torn:
+        yield from csv.reader(io.StringIO(pending.decode('utf-8'), newline=''))
+
+
+def read_csv_row(lines: Iterable[Tuple[int, bytes]]) -> Optional[List[str]]:
+    """Одна CSV строка с начала потока строк (для чтения по смещению из индекса)"""
+    for _, row in iter_csv_rows(lines):
+        return row
+    return None
+
+
+def row_user_id(row: List[str]) -> Optional[int]:
+    """user_id строки активности (None для заголовка и битых строк)"""
+    if len(row) < 2 or not row[1].lstrip('-').isdigit():
+        return None
+    return int(row[1])
+
+
+def row_weight(row: List[str]) -> int:
+    """Сколько событий представляет строка: 1, для агрегированной - их число"""
+    ref = row[5] if len(row) > 5 else ''
+    if ref.startswith(AGGREGATE_PREFIX) and ref[len(AGGREGATE_PREFIX):].isdigit():
+        return int(ref[len(AGGREGATE_PREFIX):])
+    return 1
+
+
+def csv_entries(lines: Iterable[Tuple[int, bytes]]) -> Iterator[IndexEntry]:
+    """Записи индекса для строк CSV лога активности"""
+    for offset, row in iter_csv_rows(lines):
+        user_id = row_user_id(row)
+        if user_id is not None:
+            yield user_id, offset, row[3] if len(row) > 3 else '', row_weight(row)
+
+
+class ActivityIndex:
+    """Смещения строк каждого пользователя в сегментах лога активности.
+
+    Писатель лога добавляет смещения вместе с каждой пачкой строк; для
+    сегмента хранится, до какого байта он проиндексирован, поэтому
+    недостающий хвост (сбой между записью строк и индекса, удаленный
+    индекс) дочитывается при открытии - sync(). Выборка по пользователю
+    идет по индексу (user_id, id) в прямом или обратном порядке записи.
+
+    В той же транзакции обновляются счетчики действий пользователя,
+    поэтому статистика истории не требует чтения его строк и всегда
+    согласована со смещениями (при пересборке пересчитывается заново).
+    Агрегированная строка (после сжатия старых сегментов) дает счетчику
+    свое число событий, поэтому счетчики при сжатии не меняются.
+    """
+
+    def __init__(self, db_file: str, busy_timeout_ms: int = 5000):
+        self.db_file = resolve_log_path(db_file)
+        self.busy_timeout_ms = busy_timeout_ms
+        # Индекс восстанавливается из лога, поэтому fsync на каждую пачку не нужен
+        self._db = ThreadLocalSQLite(self.db_file, busy_timeout_ms, synchronous='NORMAL')
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Индекс без счетчиков: очищаем, sync() заполнит его из лога
+            with conn:
+                conn.execute("DELETE FROM offsets")
+                conn.execute("DELETE FROM segments")
+                conn.execute("DELETE FROM counters")
+            conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        return self._db.connection()
+
+    def add(self, segment: str, entries: Iterable[IndexEntry], size: int) -> None:
+        """Добавить строки (user_id, offset, action, weight) сегмента, проиндексированного до size байт"""
+        entries = list(entries)
+        counts: Counter = Counter()
+        for user_id, _, action, weight in entries:
+            counts[user_id, action] += weight
+        conn = self._connection()
+        with conn:
+            conn.executemany(SQL_INSERT_OFFSET, ((user_id, segment, offset) for user_id, offset, _, _ in entries))
+            conn.executemany(SQL_COUNT, ((user_id, action, count) for (user_id, action), count in counts.items()))
+            conn.execute(SQL_SET_SIZE, (segment, size))
+
+    def replace_segment(self, segment: str, entries: Iterable[IndexEntry], size: int) -> None:
+        """Заменить смещения переписанного сегмента (одной транзакцией).
+
+        Счетчики не меняются: новый сегмент содержит те же события
+        (отброшенные строки учтены в агрегированных). Строки получают
+        id удаленных строк сегмента по порядку, поэтому место сегмента
+        в порядке записи (и в истории пользователя) сохраняется.
+        """
+        entries = list(entries)
+        conn = self._connection()
+        with conn:
+            ids = [row[0] for row in conn.execute(SQL_SEGMENT_IDS, (segment,))]
+            ids += [None] * (len(entries) - len(ids))
+            conn.execute(SQL_DELETE_SEGMENT, (segment,))
+            conn.executemany(SQL_INSERT_OFFSET_ID, ((row_id, user_id, segment, offset)
+                                                    for row_id, (user_id, offset, _, _) in zip(ids, entries)))
+            conn.execute(SQL_REPLACE_SIZE, (segment, size))
+
+    def sizes(self) -> Dict[str, int]:
+        """Сегмент -> до какого байта проиндексирован"""
+        return dict(self._connection().execute("SELECT name, size FROM segments"))
+
+    def sync(self, segment: str, size: int, entries_from: Callable[[int], Iterable[IndexEntry]]) -> int:
+        """Проиндексировать хвост сегмента, если файл длиннее индекса; возвращает число строк.
+
+        entries_from(offset) - записи индекса для строк сегмента начиная с offset
+        (для CSV - csv_entries от строк файла).
+        """
+        indexed = self.sizes().get(segment, 0)
+        if size <= indexed:
+            return 0
+        entries = list(entries_from(indexed))
+        self.add(segment, entries, size)
+        return len(entries)
+
+    def iter_offsets(self, user_id: int, newest_first: bool = False) -> Iterator[Tuple[str, int]]:
+        """Смещения строк пользователя (сегмент, смещение) - курсор без загрузки всего списка"""
+        return iter(self._connection().execute(SQL_BY_USER_DESC if newest_first else SQL_BY_USER, (user_id,)))
+
+    def action_counts(self, user_id: int) -> Dict[str, int]:
+        """Сколько раз пользователь выполнил каждое действие"""
+        return dict(self._connection().execute(SQL_COUNTS, (user_id,)))
+
+    def close(self) -> None:
+        """Закрыть соединения всех потоков"""
+        self._db.close()
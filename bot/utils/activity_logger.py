@@ -1,19 +1,65 @@
 """
 Логирование активности пользователей
 """
-import csv
+import atexit
+import itertools
 import os
+import queue
+import threading
+import time
 from pathlib import Path
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Iterator, List, Optional
 
 from bot.interfaces import ILogger
+from bot.utils.activity_archive import CSV_HEADER, ActivityArchive, encode_rows_with_offsets
+from bot.utils.activity_index import (ActivityIndex, csv_entries, iter_file_lines, iter_path_lines,
+                                      read_csv_row, row_user_id)
+from bot.utils.activity_binary import BinaryActivityLog
+
+# Раскладка лога: один файл, сегменты по дням (logs/activity/YYYY-MM-DD.csv)
+# или двоичный формат (logs/activity.bin + .heap + .sym)
+LAYOUT_SINGLE = 'single'
+LAYOUT_DAILY = 'daily'
+LAYOUT_BINARY = 'binary'
+LAYOUTS = (LAYOUT_SINGLE, LAYOUT_DAILY, LAYOUT_BINARY)
+
+# Политики переполнения очереди записей
+OVERFLOW_BLOCK = 'block'   # ждать места в очереди (запись не теряется)
+OVERFLOW_DROP = 'drop'     # отбросить запись
+OVERFLOW_COUNT = 'count'   # отбросить запись, а в лог записать, сколько потеряно
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP, OVERFLOW_COUNT)
+
+# Действия, после которых история пользователя для кэша не меняется (просмотр самой истории)
+UNVERSIONED_ACTIONS = frozenset({'history_requested'})
+# Число счетчиков версий: у пользователей с одинаковым остатком id общий счетчик
+VERSION_STRIPES = 65536
+
+_FLUSH = object()   # маркер принудительного сброса
+_STOP = object()    # маркер остановки фонового потока
 
 
 class ActivityLogger(ILogger):
-    """Класс для логирования активности пользователей в CSV файл"""
-    
-    def __init__(self, log_file: str = 'logs/activity.csv'):
+    """Класс для логирования активности пользователей в CSV файл.
+
+    log_activity только кладет строку в ограниченную очередь; фоновый
+    поток пишет накопленные строки пачкой в один постоянно открытый файл -
+    когда набралось batch_size строк или прошло flush_interval секунд.
+    Каждая пачка уходит одним вызовом write, поэтому строки нескольких
+    логгеров одного файла не перемешиваются. При остановке (close или
+    выход из процесса) очередь дописывается до конца.
+
+    По умолчанию (layout='daily') строки пишутся не в log_file, а в сегменты
+    по дням рядом с ним (logs/activity/YYYY-MM-DD.csv, см. ActivityArchive);
+    layout='binary' - в компактный двоичный лог (см. BinaryActivityLog).
+    Во всех раскладках ведется индекс смещений строк по пользователям
+    со счетчиками действий (ActivityIndex): история читает только
+    последние строки пользователя, а статистику берет из счетчиков.
+    """
+
+    def __init__(self, log_file: str = 'logs/activity.csv', max_queue: Optional[int] = None,
+                 flush_interval: Optional[float] = None, batch_size: int = 500,
+                 overflow: Optional[str] = None, layout: Optional[str] = None):
         # Преобразуем в абсолютный путь для надежности
         if not os.path.isabs(log_file):
             # Определяем корневую директорию проекта
@@ -22,35 +68,229 @@ class ActivityLogger(ILogger):
             self.log_file = str(base_dir / log_file)
         else:
             self.log_file = log_file
+        self.max_queue = max_queue or int(os.getenv('ACTIVITY_LOG_QUEUE_SIZE', '10000'))
+        self.flush_interval = flush_interval or float(os.getenv('ACTIVITY_LOG_FLUSH_SEC', '1'))
+        self.batch_size = batch_size
+        self.overflow = overflow or os.getenv('ACTIVITY_LOG_OVERFLOW', OVERFLOW_COUNT)
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика переполнения: {self.overflow}")
+
+        self.layout = layout or os.getenv('ACTIVITY_LOG_LAYOUT', LAYOUT_DAILY)
+        if self.layout not in LAYOUTS:
+            raise ValueError(f"Неизвестная раскладка лога активности: {self.layout}")
+
+        self.dropped = 0            # всего отброшено записей
+        self._dropped_pending = 0   # отброшено с момента последней отметки в логе
+        # Версии истории пользователей для кэшей (растут с каждой новой записью)
+        self._versions = [0] * VERSION_STRIPES
+        self._queue: "queue.Queue" = queue.Queue(maxsize=self.max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+        self._file = None
         self._ensure_log_directory()
-    
+        # logs/activity.csv -> logs/activity/; старый общий файл переносится в сегменты один раз
+        self.archive = None
+        self.index: Optional[ActivityIndex] = None
+        if self.layout == LAYOUT_SINGLE:
+            # logs/activity.csv -> logs/activity_index.db
+            self.index = ActivityIndex(os.path.splitext(self.log_file)[0] + '_index.db')
+            if os.path.exists(self.log_file):
+                self.index.sync(os.path.basename(self.log_file), os.path.getsize(self.log_file),
+                                lambda offset: csv_entries(iter_path_lines(self.log_file, offset)))
+        elif self.layout == LAYOUT_DAILY:
+            self.archive = ActivityArchive(os.path.splitext(self.log_file)[0], import_log=self.log_file)
+        elif self.layout == LAYOUT_BINARY:
+            self.archive = BinaryActivityLog(os.path.splitext(self.log_file)[0])
+
     def _ensure_log_directory(self):
         """Создать директорию для логов, если не существует"""
         log_dir = os.path.dirname(self.log_file)
         if log_dir:  # Проверяем, что путь содержит директорию
             os.makedirs(log_dir, exist_ok=True)
-    
-    def log_activity(self, user_id: int, username: Optional[str], action: str, payload_summary: str = "") -> None:
-        """Логирует активность пользователя в CSV файл"""
+
+    @property
+    def nonblocking(self) -> bool:
+        """Запись не ждет места в очереди - можно вызывать прямо из цикла событий"""
+        return self.overflow != OVERFLOW_BLOCK
+
+    def _start(self) -> None:
+        """Запустить фоновый поток при первой записи"""
+        with self._start_lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name='activity-log', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def log_activity(self, user_id: int, username: Optional[str], action: str, payload_summary: str = "",
+                     response_ref: str = "") -> None:
+        """Логирует активность пользователя в CSV файл (через очередь)"""
+        if self._thread is None:
+            self._start()
+        row = [
+            datetime.now().isoformat(),
+            user_id,
+            username or 'Unknown',
+            action,
+            payload_summary[:100],  # Ограничиваем длину
+            response_ref
+        ]
+        if self.overflow == OVERFLOW_BLOCK:
+            self._queue.put(row)
+        else:
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self.dropped += 1
+                self._dropped_pending += 1
+        # Версия меняется после постановки в очередь: кто увидел новую версию,
+        # тот после flush() прочитает и новую запись
+        if action not in UNVERSIONED_ACTIONS:
+            self._versions[user_id % VERSION_STRIPES] += 1
+
+    def user_version(self, user_id: int) -> int:
+        """Версия истории пользователя: меняется, когда у него появляется новая запись.
+
+        Счетчик общий для пользователей с одинаковым остатком id по
+        VERSION_STRIPES (память не растет с числом пользователей) - лишний
+        раз кэш может сброситься, но устаревшим не останется. Просмотр
+        истории (UNVERSIONED_ACTIONS) версию не меняет - такие действия
+        не показываются на страницах истории. Версия ведется в
+        памяти процесса - для кэшей этого же процесса.
+        """
+        return self._versions[user_id % VERSION_STRIPES]
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Дождаться записи всего, что уже в очереди"""
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        """Дописать очередь и закрыть файл (при остановке бота)"""
+        with self._start_lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        if self.archive is not None:
+            self.archive.close()
+        if self.index is not None:
+            self.index.close()
+
+    def _run(self) -> None:
+        """Фоновый поток: собирать строки в пачки и дописывать их в файл"""
+        batch: List[list] = []
+        waiters: List[threading.Event] = []
+        deadline = None
+        stop = False
+        while not stop:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                stop = True
+            elif isinstance(item, tuple) and item and item[0] is _FLUSH:
+                waiters.append(item[1])
+            elif item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if stop or waiters or len(batch) >= self.batch_size or \
+                    (deadline is not None and time.monotonic() >= deadline):
+                if stop:
+                    # Дописываем все, что осталось в очереди
+                    while True:
+                        try:
+                            item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if isinstance(item, tuple) and item and item[0] is _FLUSH:
+                            waiters.append(item[1])
+                        elif item is not _STOP:
+                            batch.append(item)
+                self._write_batch(batch)
+                batch, deadline = [], None
+                for waiter in waiters:
+                    waiter.set()
+                waiters = []
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_batch(self, rows: List[list]) -> None:
+        """Записать пачку строк; ошибка записи не останавливает поток"""
+        if self.overflow == OVERFLOW_COUNT and self._dropped_pending:
+            dropped, self._dropped_pending = self._dropped_pending, 0
+            rows = rows + [[datetime.now().isoformat(), 0, 'system', 'log_overflow',
+                            f"Отброшено записей при переполнении очереди: {dropped}", ""]]
+        if not rows:
+            return
         try:
-            file_exists = os.path.exists(self.log_file)
-            
-            with open(self.log_file, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                
-                # Записываем заголовки, если файл новый
-                if not file_exists:
-                    writer.writerow(['timestamp', 'user_id', 'username', 'action', 'payload_summary', 'response_ref'])
-                
-                # Записываем данные
-                writer.writerow([
-                    datetime.now().isoformat(),
-                    user_id,
-                    username or 'Unknown',
-                    action,
-                    payload_summary[:100],  # Ограничиваем длину
-                    ""  # response_ref пока не используется
-                ])
-                
+            self._write_rows(rows)
         except Exception as e:
             print(f"Ошибка логирования активности: {e}")  # Используем print вместо logger, чтобы избежать циклических зависимостей
+            # Файл мог быть удален или испорчен - откроем заново при следующей записи
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write_rows(self, rows: List[list]) -> None:
+        """Дописать строки активности в CSV файл одним вызовом write"""
+        if self.archive is not None:
+            self.archive.write_rows(rows)
+            return
+        if self._file is None:
+            self._file = open(self.log_file, 'ab', buffering=0)
+
+        # Заголовок пишется, если файл новый
+        position = self._file.seek(0, os.SEEK_END)
+        data, offsets = encode_rows_with_offsets(rows, position)
+        self._file.write(data)
+        self.index.add(os.path.basename(self.log_file), offsets, position + len(data))
+
+    def _iter_user_rows(self, user_id: int, newest_first: bool) -> Iterator[Dict[str, str]]:
+        """Записи пользователя по индексу смещений: читаются только они"""
+        if self.archive is not None:
+            yield from self.archive.iter_user_rows(user_id, newest_first)
+            return
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, 'rb') as f:
+            for _, offset in self.index.iter_offsets(user_id, newest_first):
+                row = read_csv_row(iter_file_lines(f, offset))
+                # Файл могли удалить и начать заново - устаревшие смещения пропускаются
+                if row is not None and row_user_id(row) == user_id:
+                    yield dict(zip(CSV_HEADER, row))
+
+    def iter_user_activities(self, user_id: int) -> Iterator[Dict[str, str]]:
+        """Записи активности пользователя (блокирующее чтение, с учетом еще не записанных)"""
+        self.flush(timeout=5)
+        yield from self._iter_user_rows(user_id, newest_first=False)
+
+    def recent_user_activities(self, user_id: int, limit: int = 10) -> List[Dict[str, str]]:
+        """Последние limit записей пользователя (старые первыми), читаются с конца лога"""
+        self.flush(timeout=5)
+        rows = self._iter_user_rows(user_id, newest_first=True)
+        try:
+            recent = list(itertools.islice(rows, limit))
+        finally:
+            rows.close()
+        recent.reverse()
+        return recent
+
+    def user_action_counts(self, user_id: int) -> Dict[str, int]:
+        """Счетчики действий пользователя: обновляются с каждой записанной пачкой строк"""
+        self.flush(timeout=5)
+        index = self.index if self.index is not None else self.archive.index
+        return index.action_counts(user_id)
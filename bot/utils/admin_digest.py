@@ -0,0 +1,187 @@
+"""
+Периодическая сводка для админов по событиям низкого приоритета
+"""
+import os
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from bot.utils.admin_routing import AdminRouter
+from bot.utils.io_executor import run_io
+from bot.utils.rate_limiter import PRIORITY_LOW, with_priority
+
+# Вид записи outbox: сводка для админ-чата
+ADMIN_DIGEST = 'admin_digest'
+# Сколько разных пользователей помнить за период (дальше число помечается как «N+»)
+MAX_TRACKED_USERS = 10000
+
+
+class AdminDigest:
+    """Накопитель событий для сводки: вопросы без ответа, блокировки спама, всплески.
+
+    Все буферы ограничены: вопросов хранится не больше max_samples (счетчик
+    ведется по всем), пользователей в счетчиках - не больше max_users
+    (остальные попадают в «прочие»). Сводка строится из счетчиков,
+    без чтения логов, и обнуляет их.
+
+    Всплеск - минута, в которой сообщений в spike_factor раз больше
+    скользящего среднего предыдущих минут (и не меньше spike_min).
+    """
+
+    def __init__(self, max_samples: int = 10, max_users: int = 100,
+                 spike_factor: Optional[float] = None, spike_min: Optional[int] = None,
+                 bucket_sec: int = 60, outbox=None, dispatcher=None,
+                 router: Optional[AdminRouter] = None):
+        self.max_samples = max_samples
+        self.max_users = max_users
+        self.spike_factor = spike_factor or float(os.getenv('ADMIN_DIGEST_SPIKE_FACTOR', '3'))
+        self.spike_min = spike_min or int(os.getenv('ADMIN_DIGEST_SPIKE_MIN', '30'))
+        self.bucket_sec = bucket_sec
+        self.outbox = outbox
+        self.dispatcher = dispatcher
+        self.router = router or AdminRouter.from_file()
+
+        # Скользящее среднее сообщений в минуту переживает обнуление сводки
+        self._baseline = 0.0
+        self._bucket: Optional[int] = None
+        self._bucket_count = 0
+        self._reset(time.time())
+
+    def _reset(self, now: float) -> None:
+        self.period_start = now
+        self.unanswered_count = 0
+        self.unanswered: Deque[Tuple[float, Optional[str], str]] = deque(maxlen=self.max_samples)
+        self.spam_blocks: Counter = Counter()
+        self.spam_other = 0
+        self.messages = 0
+        self.users = set()
+        self.users_overflow = False
+        self.peak: Tuple[Optional[int], int] = (None, 0)
+        self.spikes: Deque[Tuple[int, int, float]] = deque(maxlen=self.max_samples)
+
+    def _count_user(self, counter: Counter, key: Any) -> bool:
+        """Учесть пользователя в ограниченном счетчике; False - места нет"""
+        if key in counter or len(counter) < self.max_users:
+            counter[key] += 1
+            return True
+        return False
+
+    def record_unanswered(self, user_id: int, username: Optional[str], question: str,
+                          now: Optional[float] = None) -> None:
+        """Вопрос консультанту, на который нашелся только ответ-заглушка"""
+        now = time.time() if now is None else now
+        self.unanswered_count += 1
+        self.unanswered.append((now, username or str(user_id), question[:100]))
+
+    def record_spam_block(self, user_id: int, username: Optional[str]) -> None:
+        """Сообщение отклонено защитой от спама"""
+        if not self._count_user(self.spam_blocks, username or str(user_id)):
+            self.spam_other += 1
+
+    def record_message(self, user_id: int, now: Optional[float] = None) -> None:
+        """Входящее сообщение (для статистики и поиска всплесков)"""
+        now = time.time() if now is None else now
+        bucket = int(now // self.bucket_sec)
+        if bucket != self._bucket:
+            self._close_bucket(bucket)
+        self._bucket_count += 1
+        self.messages += 1
+        if user_id in self.users or len(self.users) < MAX_TRACKED_USERS:
+            self.users.add(user_id)
+        else:
+            self.users_overflow = True
+
+    def _close_bucket(self, new_bucket: int) -> None:
+        """Закрыть минуту: проверить на всплеск и обновить скользящее среднее"""
+        if self._bucket is not None:
+            count = self._bucket_count
+            if count > self.peak[1]:
+                self.peak = (self._bucket, count)
+            if self._baseline > 0 and count >= max(self.spike_min, self.spike_factor * self._baseline):
+                self.spikes.append((self._bucket, count, self._baseline))
+            # Пустые минуты между сообщениями тоже снижают среднее (не больше часа)
+            idle = min(max(new_bucket - self._bucket - 1, 0), 60)
+            self._baseline = 0.9 * self._baseline + 0.1 * count if self._baseline else float(count)
+            self._baseline *= 0.9 ** idle
+        self._bucket = new_bucket
+        self._bucket_count = 0
+
+    def _bucket_time(self, bucket: int) -> str:
+        return datetime.fromtimestamp(bucket * self.bucket_sec).strftime('%H:%M')
+
+    def collect(self, now: Optional[float] = None) -> Optional[str]:
+        """Текст сводки за период с обнулением счетчиков; None - сообщать нечего"""
+        now = time.time() if now is None else now
+        current = int(now // self.bucket_sec)
+        if self._bucket is not None and self._bucket != current:
+            self._close_bucket(current)
+
+        if not (self.unanswered_count or self.spam_blocks or self.spam_other or self.spikes):
+            self._reset(now)
+            return None
+
+        start = datetime.fromtimestamp(self.period_start).strftime('%d.%m %H:%M')
+        end = datetime.fromtimestamp(now).strftime('%H:%M')
+        users = f"{len(self.users)}+" if self.users_overflow else str(len(self.users))
+        lines: List[str] = [f"📊 **Сводка за {start}–{end}**\n"]
+        lines.append(f"💬 Сообщений: {self.messages} от {users} пользователей")
+
+        if self.spikes:
+            lines.append("\n📈 **Всплески активности:**")
+            for bucket, count, baseline in self.spikes:
+                lines.append(f"• {self._bucket_time(bucket)}: {count} сообщений/мин (обычно ~{baseline:.0f})")
+        elif self.peak[0] is not None:
+            lines.append(f"📈 Пик: {self.peak[1]} сообщений/мин в {self._bucket_time(self.peak[0])}")
+
+        if self.unanswered_count:
+            lines.append(f"\n❓ **Вопросы без ответа:** {self.unanswered_count}")
+            for timestamp, username, question in self.unanswered:
+                lines.append(f"• {datetime.fromtimestamp(timestamp).strftime('%H:%M')} @{username}: {question}")
+            if self.unanswered_count > len(self.unanswered):
+                lines.append(f"  …и еще {self.unanswered_count - len(self.unanswered)}")
+
+        if self.spam_blocks or self.spam_other:
+            total = sum(self.spam_blocks.values()) + self.spam_other
+            lines.append(f"\n⚠️ **Блокировки спама:** {total}")
+            for username, count in self.spam_blocks.most_common(5):
+                lines.append(f"• @{username}: {count}")
+            if self.spam_other:
+                lines.append(f"• прочие: {self.spam_other}")
+
+        self._reset(now)
+        return "\n".join(lines)
+
+    async def send_digest(self, context) -> None:
+        """Задача JobQueue: поставить сводку в outbox для админ-чата"""
+        text = self.collect()
+        if text is None:
+            return
+        recipients = self.router.route({'categories': [], 'location': None},
+                                       fallback_chat_id=os.getenv('ADMIN_CHAT_ID'))
+        if not recipients:
+            print("Сводка для админов не отправлена: ADMIN_CHAT_ID не настроен")
+            return
+        if self.outbox is None:
+            for _, chat_id in recipients:
+                await self.deliver(context.bot, {'chat_id': chat_id, 'payload': {'text': text}})
+            return
+        await run_io(self.outbox.enqueue_many, ADMIN_DIGEST,
+                     [(chat_id, {'text': text}) for _, chat_id in recipients])
+        if self.dispatcher is not None:
+            self.dispatcher.wake()
+
+    @with_priority(PRIORITY_LOW)
+    async def deliver(self, bot, entry: Dict[str, Any]) -> None:
+        """Доставить сводку из outbox (вызывается диспетчером)"""
+        await bot.send_message(chat_id=entry['chat_id'], text=entry['payload']['text'], parse_mode='Markdown')
+
+    def schedule(self, application, interval_min: Optional[float] = None) -> bool:
+        """Запускать сводку по расписанию через JobQueue приложения"""
+        interval = (interval_min or float(os.getenv('ADMIN_DIGEST_INTERVAL_MIN', '60'))) * 60
+        if application.job_queue is None:
+            print("JobQueue недоступна (pip install \"python-telegram-bot[job-queue]\") - сводка отключена")
+            return False
+        application.job_queue.run_repeating(self.send_digest, interval=interval, first=interval,
+                                            name=ADMIN_DIGEST)
+        return True
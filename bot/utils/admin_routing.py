@@ -0,0 +1,95 @@
+"""
+Маршрутизация сообщений об опасности по дежурным чатам
+"""
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot.utils.incident_store import extract_building
+
+DEFAULT_ROUTING_FILE = str(Path(__file__).parent.parent.parent / 'configs' / 'admin_routing.json')
+PLACEHOLDER_CHAT_IDS = ('', 'ADMIN_ID_PLACEHOLDER')
+
+
+class AdminRouter:
+    """Выбор получателей сообщения по категории и корпусу.
+
+    Категории определяются по ключевым словам в описании. Правило
+    срабатывает, если совпали и категория, и корпус (пустой список -
+    любое значение). Получатели всех сработавших правил объединяются;
+    если не сработало ни одно - используются получатели по умолчанию.
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        self.recipients: Dict[str, Dict[str, Any]] = config.get('recipients', {})
+        self.categories: Dict[str, Dict[str, Any]] = config.get('categories', {})
+        self.rules: List[Dict[str, Any]] = config.get('rules', [])
+        self.default: List[str] = config.get('default', [])
+
+    @classmethod
+    def from_file(cls, config_file: str = DEFAULT_ROUTING_FILE) -> 'AdminRouter':
+        """Загрузить таблицу маршрутизации (нет файла - все в админ-чат по умолчанию)"""
+        try:
+            with open(config_file, 'r', encoding='utf-8') as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls()
+        except Exception as e:
+            print(f"Ошибка загрузки маршрутизации {config_file}: {e}")
+            return cls()
+
+    def classify(self, text: str) -> List[str]:
+        """Категории сообщения по ключевым словам"""
+        text = text.lower()
+        return [
+            name for name, category in self.categories.items()
+            if any(keyword in text for keyword in category.get('keywords', []))
+        ]
+
+    def category_titles(self, categories: List[str]) -> List[str]:
+        return [self.categories.get(name, {}).get('title', name) for name in categories]
+
+    @staticmethod
+    def _resolve_chat_id(chat_id: Any) -> Optional[str]:
+        """chat_id из конфигурации: число, строка или env:ИМЯ_ПЕРЕМЕННОЙ"""
+        if chat_id is None:
+            return None
+        chat_id = str(chat_id)
+        if chat_id.startswith('env:'):
+            chat_id = os.getenv(chat_id[4:], '')
+        return None if chat_id in PLACEHOLDER_CHAT_IDS else chat_id
+
+    def route(self, report: Dict[str, Any], fallback_chat_id: Optional[str] = None) -> List[Tuple[str, str]]:
+        """Получатели сообщения: пары (имя получателя, chat_id) без повторов чатов"""
+        categories = report.get('categories')
+        if categories is None:
+            categories = self.classify(f"{report.get('description', '')} {report.get('location', '')}")
+        building = extract_building(report.get('location'))
+
+        names: List[str] = []
+        for rule in self.rules:
+            rule_categories = rule.get('categories') or []
+            rule_buildings = [str(item).lower() for item in rule.get('buildings') or []]
+            if rule_categories and not set(rule_categories) & set(categories):
+                continue
+            if rule_buildings and building not in rule_buildings:
+                continue
+            names.extend(name for name in rule.get('recipients', []) if name not in names)
+        if not names:
+            names = list(self.default)
+
+        result: List[Tuple[str, str]] = []
+        seen_chats = set()
+        for name in names:
+            chat_id = self._resolve_chat_id(self.recipients.get(name, {}).get('chat_id'))
+            if chat_id and chat_id not in seen_chats:
+                seen_chats.add(chat_id)
+                result.append((name, chat_id))
+
+        fallback_chat_id = self._resolve_chat_id(fallback_chat_id)
+        if not result and fallback_chat_id:
+            # Дежурные чаты не настроены - как раньше, в единственный админ-чат
+            result.append(('admin', fallback_chat_id))
+        return result
@@ -0,0 +1,162 @@
+"""
+Логирование приложения: очередь в отдельный поток, JSON в файл, выборка частых строк
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Уровни по умолчанию: httpx пишет INFO на каждый запрос getUpdates
+DEFAULT_LEVELS = 'httpx=WARNING,httpcore=WARNING,apscheduler=WARNING'
+
+# Стандартные атрибуты LogRecord: все остальные пришли через extra и попадают в JSON
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON: время, уровень, логгер, сообщение и поля из extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def parse_levels(spec: str) -> Dict[str, int]:
+    """'httpx=WARNING,bot.main=DEBUG' -> {логгер: уровень}"""
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return {name: level for name, level in levels.items() if isinstance(level, int)}
+
+
+def build_queue_logging(log_file: str, max_bytes: Optional[int] = None, backup_count: Optional[int] = None,
+                        console: bool = True) -> Tuple[logging.handlers.QueueHandler,
+                                                       logging.handlers.QueueListener]:
+    """Обработчик-очередь для логгеров и поток, который пишет из очереди.
+
+    Вызов logger.info() только кладет запись в очередь; форматирование
+    JSON, запись в файл, ротация (RotatingFileHandler: LOG_FILE_MAX_MB,
+    LOG_FILE_BACKUPS) и вывод в консоль идут в потоке QueueListener.
+    """
+    max_bytes = max_bytes or int(float(os.getenv('LOG_FILE_MAX_MB', '10')) * 1024 * 1024)
+    backup_count = backup_count if backup_count is not None else int(os.getenv('LOG_FILE_BACKUPS', '5'))
+    log_dir = os.path.dirname(log_file)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                                        encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(stream_handler)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    return logging.handlers.QueueHandler(log_queue), listener
+
+
+def setup_logging(log_file: str = 'logs/app.log') -> logging.handlers.QueueListener:
+    """Настроить корневой логгер (один раз на процесс) и запустить поток записи.
+
+    LOG_LEVEL - уровень корневого логгера, LOG_LEVELS - уровни отдельных
+    логгеров ('httpx=WARNING,bot.main=DEBUG', дополняют DEFAULT_LEVELS).
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
+        handler, listener = build_queue_logging(log_file)
+        root = logging.getLogger()
+        for old_handler in root.handlers[:]:
+            root.removeHandler(old_handler)
+        root.addHandler(handler)
+        root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+        levels = parse_levels(DEFAULT_LEVELS)
+        levels.update(parse_levels(os.getenv('LOG_LEVELS', '')))
+        for name, level in levels.items():
+            logging.getLogger(name).setLevel(level)
+        listener.start()
+        atexit.register(stop_logging)
+        _listener = listener
+        return listener
+
+
+def stop_logging() -> None:
+    """Дописать очередь и остановить поток записи"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+class SampledLog:
+    """Частые строки лога: не больше per_second записей в секунду на ключ.
+
+    Лишние вызовы отбрасываются до создания записи (проверка счетчика,
+    без форматирования); в следующую записанную строку попадает поле
+    suppressed - сколько строк с этим ключом было пропущено.
+    """
+
+    def __init__(self, logger: logging.Logger, per_second: Optional[float] = None):
+        self.logger = logger
+        self.per_second = per_second if per_second is not None else float(os.getenv('LOG_HOT_PER_SEC', '5'))
+        # ключ -> [начало текущей секунды, записано в ней, пропущено]
+        self._windows: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> Optional[int]:
+        """None - строку пропустить, иначе число пропущенных перед ней"""
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = [now, 0, 0]
+            elif now - window[0] >= 1.0:
+                window[0], window[1] = now, 0
+            if window[1] >= self.per_second:
+                window[2] += 1
+                return None
+            window[1] += 1
+            suppressed, window[2] = window[2], 0
+            return suppressed
+
+    def log(self, level: int, key: str, msg: str, *args: Any, **fields: Any) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        suppressed = self.allow(key)
+        if suppressed is None:
+            return
+        if suppressed:
+            fields['suppressed'] = suppressed
+        self.logger.log(level, msg, *args, extra=fields)
+
+    def info(self, key: str, msg: str, *args: Any, **fields: Any) -> None:
+        self.log(logging.INFO, key, msg, *args, **fields)
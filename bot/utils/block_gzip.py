@@ -0,0 +1,135 @@
+"""
+Блочное gzip-сжатие строковых файлов с произвольным доступом
+"""
+import bisect
+import gzip
+import json
+import os
+import struct
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Последние 8 байт файла - смещение служебного блока (footer)
+FOOTER_POINTER = struct.Struct('<Q')
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+
+def write_blocks(lines: Iterable[bytes], dst_path: str, footer: Optional[Dict[str, Any]] = None,
+                 block_size: int = DEFAULT_BLOCK_SIZE) -> Dict[str, Any]:
+    """Сжать строки в файл из независимых gzip-блоков и дописать footer.
+
+    Блоки режутся только по границам строк, поэтому любое смещение
+    в исходном (несжатом) потоке можно прочитать, распаковав один блок.
+    В footer сохраняется таблица блоков [несжатое смещение, сжатое смещение].
+    """
+    footer = dict(footer or {})
+    blocks: List[Tuple[int, int]] = []
+    uncompressed_offset = 0
+    tmp_path = dst_path + '.tmp'
+
+    with open(tmp_path, 'wb') as out:
+        pending: List[bytes] = []
+        pending_size = 0
+        block_start = 0
+
+        def flush_block():
+            nonlocal pending, pending_size
+            if not pending:
+                return
+            blocks.append((block_start, out.tell()))
+            out.write(gzip.compress(b''.join(pending), compresslevel=6, mtime=0))
+            pending = []
+            pending_size = 0
+
+        for line in lines:
+            if not pending:
+                block_start = uncompressed_offset
+            pending.append(line)
+            pending_size += len(line)
+            uncompressed_offset += len(line)
+            if pending_size >= block_size:
+                flush_block()
+        flush_block()
+
+        footer['blocks'] = blocks
+        footer['uncompressed_size'] = uncompressed_offset
+        footer_offset = out.tell()
+        out.write(gzip.compress(json.dumps(footer, ensure_ascii=False).encode('utf-8'), mtime=0))
+        out.write(FOOTER_POINTER.pack(footer_offset))
+        out.flush()
+        os.fsync(out.fileno())
+
+    os.replace(tmp_path, dst_path)
+    return footer
+
+
+def compress_file(src_path: str, dst_path: str, footer: Optional[Dict[str, Any]] = None,
+                  block_size: int = DEFAULT_BLOCK_SIZE) -> Dict[str, Any]:
+    """Сжать текстовый файл построчно в блочный gzip"""
+    with open(src_path, 'rb') as src:
+        return write_blocks(src, dst_path, footer, block_size)
+
+
+class BlockGzipReader:
+    """Чтение блочного gzip-файла с произвольным доступом по несжатому смещению"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.footer = self._read_footer()
+        self._block_starts = [block[0] for block in self.footer['blocks']]
+        # Последний распакованный блок: чтение нескольких строк подряд по смещениям
+        self._cached_block: Optional[Tuple[int, bytes]] = None
+
+    def _read_footer(self) -> Dict[str, Any]:
+        self._file.seek(-FOOTER_POINTER.size, os.SEEK_END)
+        pointer_position = self._file.tell()
+        footer_offset, = FOOTER_POINTER.unpack(self._file.read(FOOTER_POINTER.size))
+        self._file.seek(footer_offset)
+        data = self._file.read(pointer_position - footer_offset)
+        return json.loads(gzip.decompress(data))
+
+    def _compressed_end(self, block_index: int) -> int:
+        blocks = self.footer['blocks']
+        if block_index + 1 < len(blocks):
+            return blocks[block_index + 1][1]
+        # За последним блоком данных идет footer
+        self._file.seek(-FOOTER_POINTER.size, os.SEEK_END)
+        return FOOTER_POINTER.unpack(self._file.read(FOOTER_POINTER.size))[0]
+
+    def read_block(self, block_index: int) -> bytes:
+        """Распаковать один блок"""
+        if self._cached_block is not None and self._cached_block[0] == block_index:
+            return self._cached_block[1]
+        start = self.footer['blocks'][block_index][1]
+        end = self._compressed_end(block_index)
+        self._file.seek(start)
+        data = gzip.decompress(self._file.read(end - start))
+        self._cached_block = (block_index, data)
+        return data
+
+    def iter_lines(self, offset: int = 0) -> Iterator[Tuple[int, bytes]]:
+        """Строки начиная с несжатого смещения: пары (смещение, строка)"""
+        if not self._block_starts:
+            return
+        block_index = max(bisect.bisect_right(self._block_starts, offset) - 1, 0)
+        for index in range(block_index, len(self._block_starts)):
+            position = self._block_starts[index]
+            for line in self.read_block(index).splitlines(keepends=True):
+                if position >= offset:
+                    yield position, line
+                position += len(line)
+
+    def read_line_at(self, offset: int) -> Optional[bytes]:
+        """Прочитать одну строку по несжатому смещению"""
+        for _, line in self.iter_lines(offset):
+            return line
+        return None
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
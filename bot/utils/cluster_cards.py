@@ -0,0 +1,121 @@
+"""
+Карточки событий в админ-чатах: текст группы похожих сообщений и отложенное редактирование
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Callable, Optional, Set
+
+from bot.utils.incident_dedup import IncidentCluster
+from bot.utils.media_album import CAPTION_LIMIT
+from bot.utils.paginator import utf16_len
+from bot.utils.rate_limiter import PRIORITY_HIGH, with_priority
+
+
+def format_cluster_text(cluster: IncidentCluster, report_text: str, limit: Optional[int] = None) -> str:
+    """Карточка события: текст первого сообщения, счетчик и последние подробности.
+
+    С limit (подпись к медиа, UTF-16) строки отбрасываются целиком -
+    сначала давние подробности, затем сводка, - чтобы не разрезать
+    разметку Markdown или эмодзи.
+    """
+    last_time = datetime.fromisoformat(cluster.recent[-1]['timestamp']).strftime('%H:%M:%S')
+    summary = [
+        f"🔁 **Похожих сообщений:** {cluster.count - 1} "
+        f"(пользователей: {len(cluster.users)}, последнее в {last_time})\n"
+    ]
+    if cluster.media_count:
+        summary.append(f"📎 **Медиафайлов всего:** {cluster.media_count}\n")
+
+    details = []
+    for report in cluster.recent:
+        description = report['description']
+        if len(description) > 100:
+            description = description[:100] + "..."
+        details.append(f"• @{report['username']}: {description} ({report['location']})\n")
+    header = "\n**Последние сообщения:**\n"
+
+    def render() -> str:
+        return report_text + "".join(summary) + (header + "".join(details) if details else "")
+
+    if limit is not None:
+        while details and utf16_len(render()) > limit:
+            details.pop(0)
+        while summary and utf16_len(render()) > limit:
+            summary.pop()
+    return render()
+
+
+class ClusterCardEditor:
+    """Обновление доставленных карточек события при новых похожих сообщениях.
+
+    Карточка в каждом чате редактируется не чаще раза в edit_interval
+    секунд (INCIDENT_DEDUP_EDIT_SEC); сообщения, пришедшие за это время,
+    попадают в одно редактирование. render(cluster, limit) - текст карточки.
+    """
+
+    def __init__(self, render: Callable[[IncidentCluster, Optional[int]], str],
+                 edit_interval: Optional[float] = None):
+        self.render = render
+        self.edit_interval = edit_interval if edit_interval is not None else \
+            float(os.getenv('INCIDENT_DEDUP_EDIT_SEC', '10'))
+        self._tasks: Set[asyncio.Task] = set()
+
+    def schedule(self, bot, cluster: IncidentCluster) -> None:
+        """Запланировать обновление карточек (не чаще раза в edit_interval)"""
+        if not cluster.admin_messages:
+            # Карточка еще в outbox - обновление запланирует доставка
+            return
+        if cluster.update_task is not None and not cluster.update_task.done():
+            # Уже запланированное обновление покажет и это сообщение
+            return
+        task = asyncio.create_task(self._update(bot, cluster))
+        cluster.update_task = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _edit_card(self, bot, chat_id: str, message_id: int, is_caption: bool,
+                         cluster: IncidentCluster) -> None:
+        """Отредактировать карточку события в одном чате"""
+        try:
+            if is_caption:
+                await bot.edit_message_caption(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    caption=self.render(cluster, CAPTION_LIMIT),
+                    parse_mode='Markdown'
+                )
+            else:
+                await bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=self.render(cluster, None),
+                    parse_mode='Markdown'
+                )
+        except Exception as e:
+            print(f"Ошибка обновления карточки события в чате {chat_id}: {e}")
+
+    @with_priority(PRIORITY_HIGH)
+    async def _update(self, bot, cluster: IncidentCluster) -> None:
+        """Отредактировать карточки события во всех чатах, куда она доставлена"""
+        delay = cluster.last_edit + self.edit_interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        rendered_count = cluster.count
+        cluster.last_edit = time.monotonic()
+        await asyncio.gather(*(
+            self._edit_card(bot, chat_id, message_id, is_caption, cluster)
+            for chat_id, (message_id, is_caption) in list(cluster.admin_messages.items())
+        ))
+
+        if cluster.count != rendered_count:
+            # Пока шло редактирование, пришли новые сообщения
+            cluster.update_task = None
+            self.schedule(bot, cluster)
+
+    async def flush(self) -> None:
+        """Дождаться отложенных обновлений карточек (при остановке бота)"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
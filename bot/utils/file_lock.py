@@ -0,0 +1,79 @@
+"""
+Межпроцессные блокировки файлов (fcntl.flock, на Windows - msvcrt)
+"""
+import os
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def lock_file(f: IO, blocking: bool = True) -> bool:
+    """Захватить исключительную блокировку открытого файла.
+
+    Блокировка рекомендательная: ее соблюдают только процессы,
+    которые тоже берут ее перед записью. Возвращает False, если
+    blocking=False и файл заблокирован другим владельцем.
+    """
+    if fcntl is not None:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f.fileno(), flags)
+        except BlockingIOError:
+            return False
+        return True
+
+    # msvcrt блокирует байты от текущей позиции - блокируем первый байт файла
+    position = f.tell()
+    f.seek(0)
+    try:
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    finally:
+        f.seek(position)
+    return True
+
+
+def unlock_file(f: IO) -> None:
+    """Снять блокировку, захваченную lock_file"""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return
+
+    position = f.tell()
+    f.seek(0)
+    try:
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+        f.seek(position)
+
+
+@contextmanager
+def locked(f: IO) -> Iterator[IO]:
+    """Держать исключительную блокировку открытого файла внутри блока with"""
+    lock_file(f)
+    try:
+        yield f
+    finally:
+        unlock_file(f)
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Блокировка через отдельный файл path + '.lock'.
+
+    Нужна, когда защищаемый файл заменяется целиком (os.replace)
+    и блокировка на нем самом потерялась бы вместе со старым inode.
+    """
+    lock_path = path + '.lock'
+    lock_dir = os.path.dirname(lock_path)
+    if lock_dir:
+        os.makedirs(lock_dir, exist_ok=True)
+    with open(lock_path, 'a+b') as f:
+        with locked(f):
+            yield
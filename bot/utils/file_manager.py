@@ -6,6 +6,7 @@ import os
 from typing import Dict, Any
 
 from bot.interfaces import IFileManager
+from bot.utils.file_lock import file_lock
 
 
 class FileManager(IFileManager):
@@ -40,19 +41,23 @@ class FileManager(IFileManager):
         return os.path.exists(file_path)
     
     def append_json_array(self, file_path: str, new_item: Dict[str, Any]) -> None:
-        """Добавить элемент в JSON массив"""
+        """Добавить элемент в JSON массив (безопасно для нескольких процессов)"""
         try:
-            # Читаем существующие данные
-            existing_data = []
-            if self.file_exists(file_path):
-                existing_data = self.load_json(file_path)
-                if not isinstance(existing_data, list):
-                    existing_data = []
-            
-            # Добавляем новый элемент
-            existing_data.append(new_item)
-            
-            # Сохраняем обновленные данные
-            self.save_json(file_path, existing_data)
+            # Чтение-изменение-запись целиком под межпроцессной блокировкой
+            with file_lock(file_path):
+                # Читаем существующие данные
+                existing_data = []
+                if self.file_exists(file_path):
+                    existing_data = self.load_json(file_path)
+                    if not isinstance(existing_data, list):
+                        existing_data = []
+                
+                # Добавляем новый элемент
+                existing_data.append(new_item)
+                
+                # Сохраняем через временный файл, чтобы читатели не увидели половину массива
+                tmp_path = file_path + '.tmp'
+                self.save_json(tmp_path, existing_data)
+                os.replace(tmp_path, file_path)
         except Exception as e:
             print(f"Ошибка добавления в JSON массив {file_path}: {e}")
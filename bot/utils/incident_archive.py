@@ -0,0 +1,314 @@
+"""
+Архив инцидентов, разбитый на месячные сегменты с разреженным индексом времени
+"""
+import bisect
+import json
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from bot.interfaces import IIncidentStore
+from bot.utils.block_gzip import BlockGzipReader, compress_file
+from bot.utils.file_lock import lock_file
+from bot.utils.incident_log import IncidentLog, iter_jsonl_entries, iter_jsonl_reversed, resolve_log_path
+
+SEGMENT_PATTERN = re.compile(r'^(\d{4}-\d{2})\.jsonl(\.gz)?$')
+
+
+class _SegmentMeta:
+    """Разреженный индекс и статистика открытого сегмента"""
+
+    def __init__(self, index_every: int):
+        self.index_every = index_every
+        self.index: List[Tuple[str, int]] = []  # (timestamp, смещение) каждой index_every-й записи
+        self.count = 0
+        self.min_ts: Optional[str] = None
+        self.max_ts: Optional[str] = None
+        self.sorted = True  # записи идут по возрастанию времени
+        self.users = set()
+        self.with_media = 0
+
+    def add(self, timestamp: str, offset: int, incident: Dict[str, Any]) -> None:
+        if self.count % self.index_every == 0:
+            self.index.append((timestamp, offset))
+        if self.max_ts is not None and timestamp < self.max_ts:
+            self.sorted = False
+        self.min_ts = timestamp if self.min_ts is None else min(self.min_ts, timestamp)
+        self.max_ts = timestamp if self.max_ts is None else max(self.max_ts, timestamp)
+        self.users.add(incident.get('user_id'))
+        if incident.get('media_files'):
+            self.with_media += 1
+        self.count += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'min_ts': self.min_ts,
+            'max_ts': self.max_ts,
+            'sorted': self.sorted,
+            'unique_users': len(self.users),
+            'with_media': self.with_media,
+        }
+
+
+class PartitionedIncidentArchive(IIncidentStore):
+    """Архив инцидентов по месяцам: logs/incidents/YYYY-MM.jsonl[.gz].
+
+    Текущий месяц дописывается в обычный JSON Lines файл. Закрытые месяцы
+    в фоне сжимаются в блочный gzip, в конце которого лежит footer
+    с разреженным индексом (время -> смещение) и статистикой сегмента.
+    Запрос за период открывает только пересекающиеся сегменты и читает
+    их начиная с ближайшей точки индекса.
+
+    Писатель у архива один: индекс открытого сегмента живет в памяти,
+    поэтому процесс захватывает <каталог архива>.lock на все время работы.
+    Для нескольких процессов-писателей используйте SQLite.
+    """
+
+    def __init__(self, archive_dir: str = 'logs/incidents', index_every: int = 64,
+                 import_log: Optional[str] = 'logs/incidents.jsonl',
+                 fsync_policy: Optional[str] = None):
+        self.archive_dir = resolve_log_path(archive_dir)
+        self.index_every = index_every
+        self.fsync_policy = fsync_policy
+        self._lock = threading.RLock()
+        self._open_month: Optional[str] = None
+        self._open_log: Optional[IncidentLog] = None
+        self._open_meta: Optional[_SegmentMeta] = None
+        self._footers: Dict[str, Dict[str, Any]] = {}
+        self._compress_threads: List[threading.Thread] = []
+
+        is_new = not os.path.isdir(self.archive_dir)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self._owner_lock = open(self.archive_dir + '.lock', 'a+b')
+        if not lock_file(self._owner_lock, blocking=False):
+            self._owner_lock.close()
+            raise RuntimeError(
+                f"Архив инцидентов {self.archive_dir} уже открыт другим процессом; "
+                "для нескольких процессов используйте INCIDENT_STORE=sqlite"
+            )
+        self._recover()
+        if is_new and import_log and os.path.exists(resolve_log_path(import_log)):
+            self.append_many(IncidentLog(import_log).iter_incidents())
+
+    def _path(self, month: str, compressed: bool = False) -> str:
+        return os.path.join(self.archive_dir, f"{month}.jsonl" + ('.gz' if compressed else ''))
+
+    def _list_segments(self) -> Dict[str, bool]:
+        """Месяц -> сжат ли сегмент"""
+        segments: Dict[str, bool] = {}
+        for name in os.listdir(self.archive_dir):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                month, compressed = match.group(1), bool(match.group(2))
+                segments[month] = segments.get(month, False) or compressed
+        return segments
+
+    def _recover(self) -> None:
+        """Открыть последний несжатый сегмент, остальные несжатые - дожать"""
+        segments = self._list_segments()
+        plain = sorted(month for month in segments if os.path.exists(self._path(month)))
+        for month in plain:
+            if segments[month]:
+                # Сжатие завершилось, но исходник не успели удалить
+                os.remove(self._path(month))
+        plain = [month for month in plain if not segments[month]]
+        if not plain:
+            return
+        for month in plain[:-1]:
+            self._open_segment(month)
+            self._close_segment()
+        self._open_segment(plain[-1])
+
+    def _open_segment(self, month: str) -> None:
+        """Открыть сегмент месяца для дозаписи, восстановив индекс сканированием"""
+        compressed_path = self._path(month, compressed=True)
+        if os.path.exists(compressed_path) and not os.path.exists(self._path(month)):
+            # Редкий случай: месяц уже сжат (например, после перезапуска) - распаковываем обратно
+            tmp_path = self._path(month) + '.tmp'
+            with BlockGzipReader(compressed_path) as reader, open(tmp_path, 'wb') as out:
+                for _, line in reader.iter_lines():
+                    out.write(line)
+            os.replace(tmp_path, self._path(month))
+            os.remove(compressed_path)
+            self._footers.pop(compressed_path, None)
+        self._open_month = month
+        self._open_log = IncidentLog(self._path(month), fsync_policy=self.fsync_policy, legacy_file=None)
+        self._open_meta = _SegmentMeta(self.index_every)
+        for offset, incident in self._open_log.iter_entries():
+            self._open_meta.add(incident.get('timestamp', ''), offset, incident)
+
+    def _close_segment(self) -> None:
+        """Закрыть текущий сегмент и сжать его в фоне"""
+        if self._open_log is None:
+            return
+        self._open_log.close()
+        month, meta = self._open_month, self._open_meta
+        thread = threading.Thread(target=self._compress_segment, args=(month, meta),
+                                  name=f"compress-incidents-{month}", daemon=True)
+        thread.start()
+        self._compress_threads = [t for t in self._compress_threads if t.is_alive()] + [thread]
+        self._open_month = self._open_log = self._open_meta = None
+
+    def _compress_segment(self, month: str, meta: _SegmentMeta) -> None:
+        """Сжать закрытый сегмент в блочный gzip с footer"""
+        try:
+            footer = {'index': meta.index, 'stats': meta.stats()}
+            compress_file(self._path(month), self._path(month, compressed=True), footer)
+            os.remove(self._path(month))
+        except Exception as e:
+            print(f"Ошибка сжатия сегмента инцидентов {month}: {e}")
+
+    def _footer(self, month: str) -> Dict[str, Any]:
+        """Footer сжатого сегмента (кэшируется)"""
+        path = self._path(month, compressed=True)
+        footer = self._footers.get(path)
+        if footer is None:
+            with BlockGzipReader(path) as reader:
+                footer = reader.footer
+            self._footers[path] = footer
+        return footer
+
+    def append(self, incident: Dict[str, Any]) -> None:
+        """Дописать инцидент в сегмент его месяца"""
+        self.append_many([incident])
+
+    def append_many(self, incidents: Iterable[Dict[str, Any]]) -> None:
+        """Дописать пачку инцидентов (одна запись на каждый затронутый сегмент)"""
+        with self._lock:
+            batch: List[Dict[str, Any]] = []
+            for incident in incidents:
+                incident.setdefault('timestamp', datetime.now().isoformat())
+                month = incident['timestamp'][:7]
+                if self._open_month is None or month > self._open_month:
+                    self._write_batch(batch)
+                    batch = []
+                    self._close_segment()
+                    self._open_segment(month)
+                # Запоздавшие записи прошлых месяцев попадают в текущий сегмент
+                batch.append(incident)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        if not batch:
+            return
+        offsets = self._open_log.append_many(batch)
+        for offset, incident in zip(offsets, batch):
+            self._open_meta.add(incident['timestamp'], offset, incident)
+
+    def _segments_for_range(self, start: str, end: str) -> Iterator[Tuple[str, Dict[str, Any], List, bool]]:
+        """Сегменты, пересекающиеся с периодом: (месяц, статистика, индекс, сжат ли)"""
+        with self._lock:
+            open_month = self._open_month
+            open_meta = None
+            if self._open_meta is not None:
+                open_meta = (self._open_meta.stats(), list(self._open_meta.index))
+
+        for month, compressed in sorted(self._list_segments().items()):
+            if month == open_month and open_meta is not None:
+                stats, index = open_meta
+                compressed = False
+            elif compressed:
+                footer = self._footer(month)
+                stats, index = footer['stats'], footer['index']
+            else:
+                # Сегмент еще сжимается - читаем целиком
+                stats, index = {'min_ts': None, 'max_ts': None, 'sorted': False}, []
+            if stats['min_ts'] is not None and (stats['max_ts'] < start or stats['min_ts'] >= end):
+                continue
+            yield month, stats, index, compressed
+
+    def _iter_segment(self, month: str, compressed: bool, offset: int) -> Iterator[Dict[str, Any]]:
+        """Инциденты сегмента начиная с несжатого смещения"""
+        if not compressed and not os.path.exists(self._path(month)):
+            # Сегмент успели сжать, пока шел запрос
+            compressed = True
+        if compressed:
+            with BlockGzipReader(self._path(month, compressed=True)) as reader:
+                for _, line in reader.iter_lines(offset):
+                    yield json.loads(line)
+        else:
+            for _, incident in iter_jsonl_entries(self._path(month), offset):
+                yield incident
+
+    def iter_range(self, start: datetime, end: datetime) -> Iterator[Dict[str, Any]]:
+        """Инциденты за период [start, end), читая только нужные сегменты и смещения"""
+        start_str, end_str = start.isoformat(), end.isoformat()
+        for month, stats, index, compressed in self._segments_for_range(start_str, end_str):
+            offset = 0
+            if stats['sorted'] and index:
+                position = bisect.bisect_left([ts for ts, _ in index], start_str) - 1
+                offset = index[max(position, 0)][1]
+            for incident in self._iter_segment(month, compressed, offset):
+                timestamp = incident.get('timestamp', '')
+                if timestamp >= end_str and stats['sorted']:
+                    break
+                if start_str <= timestamp < end_str:
+                    yield incident
+
+    def query_by_time(self, start: datetime, end: datetime, limit: int = 100) -> List[Dict[str, Any]]:
+        """Инциденты за период [start, end)"""
+        result = []
+        for incident in self.iter_range(start, end):
+            result.append(incident)
+            if len(result) >= limit:
+                break
+        return result
+
+    def iter_incidents(self) -> Iterator[Dict[str, Any]]:
+        """Все инциденты архива от старых сегментов к новым"""
+        for month, compressed in sorted(self._list_segments().items()):
+            yield from self._iter_segment(month, compressed and month != self._open_month, 0)
+
+    def _segments_newest_first(self) -> Iterator[Tuple[str, bool]]:
+        """Сегменты от новых к старым: (месяц, сжат ли)"""
+        for month, compressed in sorted(self._list_segments().items(), reverse=True):
+            yield month, compressed and month != self._open_month
+
+    def _iter_segment_newest_first(self, month: str, compressed: bool) -> Iterator[Dict[str, Any]]:
+        """Инциденты сегмента от последних записанных к первым, по блоку за раз"""
+        if not compressed and not os.path.exists(self._path(month)):
+            # Сегмент успели сжать, пока шел запрос
+            compressed = True
+        if compressed:
+            with BlockGzipReader(self._path(month, compressed=True)) as reader:
+                for index in reversed(range(len(reader.footer['blocks']))):
+                    for line in reversed(reader.read_block(index).splitlines()):
+                        yield json.loads(line)
+        else:
+            yield from iter_jsonl_reversed(self._path(month))
+
+    def get(self, incident_id: str) -> Optional[Dict[str, Any]]:
+        """Найти инцидент по идентификатору (сегменты от новых к старым, потоком)"""
+        for month, compressed in self._segments_newest_first():
+            for incident in self._iter_segment(month, compressed, 0):
+                if incident.get('incident_id') == incident_id:
+                    return incident
+        return None
+
+    def query_by_user(self, user_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Последние инциденты пользователя: чтение с конца архива до limit найденных"""
+        result = []
+        for month, compressed in self._segments_newest_first():
+            for incident in self._iter_segment_newest_first(month, compressed):
+                if incident.get('user_id') == user_id:
+                    result.append(incident)
+                    if len(result) >= limit:
+                        return result
+        return result
+
+    def wait_for_compression(self) -> None:
+        """Дождаться фонового сжатия закрытых сегментов"""
+        for thread in self._compress_threads:
+            thread.join()
+        self._compress_threads = []
+
+    def close(self) -> None:
+        """Закрыть открытый сегмент и дождаться сжатия"""
+        self.wait_for_compression()
+        with self._lock:
+            if self._open_log is not None:
+                self._open_log.close()
+        self._owner_lock.close()
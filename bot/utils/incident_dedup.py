@@ -0,0 +1,165 @@
+"""
+Потоковая группировка похожих сообщений об опасности (MinHash + LSH)
+"""
+import os
+import re
+import time
+import random
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+WORD_PATTERN = re.compile(r'\w+')
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+class MinHasher:
+    """Сигнатуры MinHash по символьным n-граммам текста.
+
+    Каждая n-грамма хешируется один раз (crc32), а num_perm независимых
+    хеш-функций получаются как (a * h + b) mod p.
+    """
+
+    def __init__(self, num_perm: int = 32, shingle_size: int = 3, seed: int = 1):
+        rng = random.Random(seed)
+        self.permutations = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        self.shingle_size = shingle_size
+
+    def shingles(self, text: str) -> Set[int]:
+        """Хеши символьных n-грамм нормализованного текста"""
+        normalized = ' '.join(WORD_PATTERN.findall(text.lower()))
+        size = self.shingle_size
+        if len(normalized) <= size:
+            return {zlib.crc32(normalized.encode('utf-8'))}
+        return {
+            zlib.crc32(normalized[i:i + size].encode('utf-8'))
+            for i in range(len(normalized) - size + 1)
+        }
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        """MinHash-сигнатура текста"""
+        hashes = self.shingles(text)
+        return tuple(
+            min((a * h + b) % MERSENNE_PRIME for h in hashes)
+            for a, b in self.permutations
+        )
+
+    @staticmethod
+    def similarity(left: Tuple[int, ...], right: Tuple[int, ...]) -> float:
+        """Оценка коэффициента Жаккара по доле совпавших значений"""
+        return sum(1 for a, b in zip(left, right) if a == b) / len(left)
+
+
+class IncidentCluster:
+    """Группа похожих сообщений об одном событии"""
+
+    def __init__(self, cluster_id: str, signature: Tuple[int, ...], now: float, keep_recent: int = 3):
+        self.cluster_id = cluster_id
+        self.signature = signature
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 0
+        self.first: Optional[Dict[str, Any]] = None
+        self.recent: deque = deque(maxlen=keep_recent)  # последние сообщения для подробностей
+        self.users: Set[int] = set()
+        self.media_count = 0
+        # Карточки в админ-чатах: chat_id -> (message_id, текст карточки - подпись к медиа)
+        self.admin_messages: Dict[str, Tuple[int, bool]] = {}
+        self.last_edit = 0.0
+        self.update_task = None
+
+    def add(self, incident: Dict[str, Any], now: float) -> None:
+        if self.first is None:
+            self.first = incident
+        else:
+            self.recent.append(incident)
+        self.count += 1
+        self.users.add(incident.get('user_id'))
+        self.media_count += len(incident.get('media_files') or [])
+        self.last_seen = now
+
+
+class IncidentDeduplicator:
+    """Группировка похожих сообщений в скользящем окне времени.
+
+    Сигнатура MinHash строится по описанию и местоположению, затем
+    делится на полосы (LSH): кандидатами считаются кластеры, совпавшие
+    с сообщением хотя бы в одной полосе. Стоимость обработки сообщения
+    не зависит от числа кластеров в окне.
+    """
+
+    def __init__(self, window_sec: Optional[float] = None, threshold: float = 0.3,
+                 num_perm: int = 32, bands: int = 16):
+        if num_perm % bands:
+            raise ValueError("num_perm должно делиться на число полос")
+        self.window_sec = window_sec or float(os.getenv('INCIDENT_DEDUP_WINDOW_SEC', '300'))
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self._clusters: 'OrderedDict[str, IncidentCluster]' = OrderedDict()  # от давних к свежим
+        self._buckets: Dict[Tuple[int, tuple], Set[str]] = {}
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, tuple]]:
+        return [
+            (band, signature[band * self.rows:(band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+
+    def _expire(self, now: float) -> None:
+        """Удалить кластеры, в которые давно не поступало сообщений"""
+        while self._clusters:
+            cluster_id, cluster = next(iter(self._clusters.items()))
+            if now - cluster.last_seen <= self.window_sec:
+                break
+            del self._clusters[cluster_id]
+            for key in self._band_keys(cluster.signature):
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(cluster_id)
+                    if not bucket:
+                        del self._buckets[key]
+
+    def add(self, incident: Dict[str, Any], now: Optional[float] = None) -> Tuple[IncidentCluster, bool]:
+        """Добавить сообщение; возвращает (кластер, создан ли новый кластер)"""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+
+        text = f"{incident.get('description', '')} {incident.get('location', '')}"
+        signature = self.hasher.signature(text)
+        keys = self._band_keys(signature)
+
+        candidates: Set[str] = set()
+        for key in keys:
+            candidates.update(self._buckets.get(key, ()))
+
+        best, best_similarity = None, self.threshold
+        for cluster_id in candidates:
+            cluster = self._clusters[cluster_id]
+            similarity = MinHasher.similarity(signature, cluster.signature)
+            if similarity >= best_similarity:
+                best, best_similarity = cluster, similarity
+
+        is_new = best is None
+        if is_new:
+            # id уникален между перезапусками: он сохраняется в записях outbox
+            best = IncidentCluster(uuid.uuid4().hex, signature, now)
+            self._clusters[best.cluster_id] = best
+            for key in keys:
+                self._buckets.setdefault(key, set()).add(best.cluster_id)
+        else:
+            self._clusters.move_to_end(best.cluster_id)
+
+        best.add(incident, now)
+        return best, is_new
+
+    def get(self, cluster_id: Optional[str]) -> Optional[IncidentCluster]:
+        """Кластер, еще живущий в окне"""
+        return self._clusters.get(cluster_id)
+
+    def __len__(self) -> int:
+        return len(self._clusters)
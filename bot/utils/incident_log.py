@@ -0,0 +1,273 @@
+"""
+Журнал инцидентов в формате JSON Lines (только дозапись)
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from bot.interfaces import IIncidentStore
+from bot.utils.file_lock import locked
+
+# Политики сброса данных на диск
+FSYNC_ALWAYS = 'always'      # fsync после каждой записи
+FSYNC_INTERVAL = 'interval'  # fsync не чаще, чем раз в fsync_interval секунд
+FSYNC_NEVER = 'never'        # только flush, fsync оставляем ОС
+
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+
+def resolve_log_path(log_file: str) -> str:
+    """Преобразовать относительный путь лога в путь от корня проекта"""
+    if os.path.isabs(log_file):
+        return log_file
+    base_dir = Path(__file__).parent.parent.parent
+    return str(base_dir / log_file)
+
+
+def iter_jsonl_entries(file_path: str, offset: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Прочитать JSON Lines файл начиная со смещения: пары (смещение, запись)"""
+    if not os.path.exists(file_path):
+        return
+
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Запись еще дописывается - читаем только завершенные строки
+                break
+            try:
+                yield offset, json.loads(line)
+            except ValueError:
+                print(f"Журнал {file_path}: пропущена поврежденная строка на смещении {offset}")
+            offset += len(line)
+
+
+def iter_jsonl_reversed(file_path: str, block_size: int = 64 * 1024) -> Iterator[Dict[str, Any]]:
+    """Записи JSON Lines файла с конца, блоками от последнего к первому.
+
+    В памяти - один блок и начало строки, которая в него не поместилась.
+    Недописанная последняя строка (без перевода строки) пропускается.
+    """
+    if not os.path.exists(file_path):
+        return
+
+    def records(lines: List[bytes]) -> Iterator[Dict[str, Any]]:
+        for line in reversed(lines):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                print(f"Журнал {file_path}: пропущена поврежденная строка")
+
+    with open(file_path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        pending = b''   # начало строки, продолжение которой уже прочитано
+        torn = True     # хвост после последнего перевода строки еще не отброшен
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + pending).split(b'\n')
+            pending = lines[0]
+            if torn:
+                if len(lines) == 1:
+                    continue
+                lines.pop()
+                torn = False
+            yield from records(lines[1:])
+        if not torn:
+            yield from records([pending])
+
+
+class IncidentLog(IIncidentStore):
+    """Append-only журнал инцидентов: одна JSON-запись на строку.
+
+    Сохранение инцидента - это одна дозапись в конец файла, поэтому
+    стоимость не зависит от размера истории. Запись идет под блокировкой
+    файла (flock), поэтому в журнал могут писать несколько процессов.
+    Если процесс упал посреди записи, неполная последняя строка
+    отрезается при следующем открытии.
+    Запросы выполняются полным просмотром журнала - для выборок
+    используйте SQLiteIncidentStore.
+    """
+
+    def __init__(self, log_file: str = 'logs/incidents.jsonl',
+                 fsync_policy: Optional[str] = None,
+                 fsync_interval: float = 1.0,
+                 legacy_file: Optional[str] = 'logs/incidents.json'):
+        self.log_file = resolve_log_path(log_file)
+        self.fsync_policy = fsync_policy or os.getenv('INCIDENT_FSYNC_POLICY', FSYNC_ALWAYS)
+        if self.fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Неизвестная политика fsync: {self.fsync_policy}")
+        self.fsync_interval = fsync_interval
+        self._last_fsync = 0.0
+        self._file = None
+        # Журнал может использоваться из нескольких потоков пула ввода-вывода
+        self._lock = threading.Lock()
+
+        self._ensure_log_directory()
+        if legacy_file:
+            self.migrate_json_array(resolve_log_path(legacy_file))
+        self._recover_torn_tail()
+
+    def _ensure_log_directory(self):
+        """Создать директорию для журнала, если не существует"""
+        log_dir = os.path.dirname(self.log_file)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+
+    def _recover_torn_tail(self) -> None:
+        """Отрезать неполную последнюю строку, оставшуюся после сбоя"""
+        if not os.path.exists(self.log_file):
+            return
+
+        # Под блокировкой: строку, которую прямо сейчас дописывает другой процесс, не трогаем
+        with open(self.log_file, 'rb+') as f, locked(f):
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+
+            # Ищем последний перевод строки, читая файл с конца блоками
+            valid_size = 0
+            position = size
+            block_size = 4096
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                newline_index = f.read(read_size).rfind(b'\n')
+                if newline_index != -1:
+                    valid_size = position + newline_index + 1
+                    break
+
+            f.truncate(valid_size)
+            print(f"Журнал инцидентов {self.log_file}: отброшена неполная запись ({size - valid_size} байт)")
+
+    def migrate_json_array(self, legacy_file: str) -> int:
+        """Однократно перенести инциденты из старого JSON-массива в журнал"""
+        if not os.path.exists(legacy_file):
+            return 0
+
+        # Дописываем, а не пересоздаем журнал: другие процессы держат его открытым.
+        # Блокировка журнала гарантирует, что перенос выполнит только один процесс.
+        with open(self.log_file, 'ab') as out, locked(out):
+            if not os.path.exists(legacy_file):
+                return 0
+
+            try:
+                with open(legacy_file, 'r', encoding='utf-8') as f:
+                    incidents = json.load(f)
+            except Exception as e:
+                print(f"Ошибка чтения старого файла инцидентов {legacy_file}: {e}")
+                return 0
+
+            if not isinstance(incidents, list):
+                incidents = []
+
+            out.write(b''.join(self._encode(incident) for incident in incidents))
+            out.flush()
+            os.fsync(out.fileno())
+            os.replace(legacy_file, legacy_file + '.migrated')
+        return len(incidents)
+
+    @staticmethod
+    def _encode(incident: Dict[str, Any]) -> bytes:
+        """Сериализовать инцидент в одну строку JSON Lines"""
+        return (json.dumps(incident, ensure_ascii=False) + '\n').encode('utf-8')
+
+    def _open(self):
+        """Открыть файл журнала для дозаписи (один раз)"""
+        if self._file is None or self._file.closed:
+            self._file = open(self.log_file, 'ab')
+        return self._file
+
+    def _sync(self, f) -> None:
+        """Сбросить данные на диск согласно политике fsync"""
+        f.flush()
+        if self.fsync_policy == FSYNC_ALWAYS:
+            os.fsync(f.fileno())
+        elif self.fsync_policy == FSYNC_INTERVAL:
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(f.fileno())
+                self._last_fsync = now
+
+    def append(self, incident: Dict[str, Any]) -> int:
+        """Дописать инцидент в конец журнала; возвращает смещение записи"""
+        return self.append_many([incident])[0]
+
+    def append_many(self, incidents: Iterable[Dict[str, Any]]) -> List[int]:
+        """Дописать пачку инцидентов одной записью; возвращает смещения записей"""
+        lines = [self._encode(incident) for incident in incidents]
+        if not lines:
+            return []
+        with self._lock:
+            f = self._open()
+            with locked(f):
+                offset = f.seek(0, os.SEEK_END)
+                offsets = []
+                for line in lines:
+                    offsets.append(offset)
+                    offset += len(line)
+                f.write(b''.join(lines))
+                self._sync(f)
+        return offsets
+
+    def iter_entries(self, offset: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Прочитать инциденты начиная со смещения: пары (смещение, инцидент)"""
+        return iter_jsonl_entries(self.log_file, offset)
+
+    def iter_incidents(self) -> Iterator[Dict[str, Any]]:
+        """Последовательно прочитать все инциденты журнала"""
+        for _, incident in self.iter_entries():
+            yield incident
+
+    def get(self, incident_id: str) -> Optional[Dict[str, Any]]:
+        """Найти инцидент по идентификатору (полный просмотр)"""
+        for incident in self.iter_incidents():
+            if incident.get('incident_id') == incident_id:
+                return incident
+        return None
+
+    def query_by_time(self, start: datetime, end: datetime, limit: int = 100) -> List[Dict[str, Any]]:
+        """Инциденты за период [start, end) (полный просмотр)"""
+        start_str, end_str = start.isoformat(), end.isoformat()
+        result = []
+        for incident in self.iter_incidents():
+            if start_str <= incident.get('timestamp', '') < end_str:
+                result.append(incident)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def query_by_user(self, user_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Последние инциденты пользователя (полный просмотр)"""
+        result = [incident for incident in self.iter_incidents() if incident.get('user_id') == user_id]
+        return result[::-1][:limit]
+
+    def truncate(self) -> None:
+        """Очистить журнал (после того как записи перенесены в хранилище)"""
+        with self._lock:
+            f = self._open()
+            with locked(f):
+                f.flush()
+                f.truncate(0)
+
+    def close(self) -> None:
+        """Сбросить данные и закрыть файл журнала"""
+        with self._lock:
+            if self._file is not None and not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+            self._file = None
@@ -0,0 +1,274 @@
+"""
+Хранилище инцидентов на SQLite (режим WAL)
+"""
+import json
+import os
+import re
+import sqlite3
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from bot.interfaces import IIncidentStore
+from bot.utils.incident_archive import PartitionedIncidentArchive
+from bot.utils.incident_log import FSYNC_ALWAYS, IncidentLog, resolve_log_path
+from bot.utils.sqlite_connections import ThreadLocalSQLite
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS incidents (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    incident_id TEXT UNIQUE,
+    timestamp TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT,
+    description TEXT NOT NULL DEFAULT '',
+    location TEXT NOT NULL DEFAULT '',
+    media_files TEXT NOT NULL DEFAULT '[]',
+    building TEXT
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_incidents_user_id ON incidents(user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_incidents_timestamp ON incidents(timestamp);
+CREATE INDEX IF NOT EXISTS idx_incidents_location ON incidents(location COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_incidents_user_page ON incidents(user_id, id);
+CREATE INDEX IF NOT EXISTS idx_incidents_building ON incidents(building, id);
+"""
+
+# Номер корпуса/здания в свободном тексте местоположения
+BUILDING_PATTERN = re.compile(
+    r'(?:корпус|корп\.?|здание|зд\.?|строение|стр\.?|цех|building|bldg\.?)\s*№?\s*([0-9]+[а-яёa-z]?)',
+    re.IGNORECASE
+)
+BARE_BUILDING_PATTERN = re.compile(r'^\s*№?\s*([0-9]+[а-яёa-z]?)\b', re.IGNORECASE)
+
+
+def extract_building(location: Optional[str]) -> Optional[str]:
+    """Выделить номер корпуса из текста местоположения ('Корпус 5, 2 этаж' -> '5')"""
+    if not location:
+        return None
+    match = BUILDING_PATTERN.search(location) or BARE_BUILDING_PATTERN.match(location)
+    return match.group(1).lower() if match else None
+
+
+# Запросы параметризованы и переиспользуются через кэш подготовленных выражений sqlite3
+SQL_INSERT = (
+    "INSERT OR IGNORE INTO incidents "
+    "(incident_id, timestamp, user_id, username, description, location, media_files, building) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_COLUMNS = "id, incident_id, timestamp, user_id, username, description, location, media_files"
+SQL_GET = f"SELECT {SQL_COLUMNS} FROM incidents WHERE incident_id = ?"
+SQL_GET_BY_ROWID = f"SELECT {SQL_COLUMNS} FROM incidents WHERE id = ?"
+SQL_BY_TIME = (
+    f"SELECT {SQL_COLUMNS} FROM incidents "
+    "WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp LIMIT ?"
+)
+SQL_BY_USER = (
+    f"SELECT {SQL_COLUMNS} FROM incidents "
+    "WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?"
+)
+
+
+class SQLiteIncidentStore(IIncidentStore):
+    """Хранилище инцидентов в SQLite с индексами по пользователю, времени и месту.
+
+    Режим WAL позволяет нескольким процессам дописывать инциденты
+    одновременно, а читателям не ждать писателей. У каждого рабочего
+    потока своё соединение.
+    """
+
+    def __init__(self, db_file: str = 'logs/incidents.db',
+                 import_log: Optional[str] = 'logs/incidents.jsonl',
+                 fsync_policy: Optional[str] = None,
+                 busy_timeout_ms: int = 5000):
+        self.db_file = resolve_log_path(db_file)
+        self.fsync_policy = fsync_policy or os.getenv('INCIDENT_FSYNC_POLICY', FSYNC_ALWAYS)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._db = ThreadLocalSQLite(
+            self.db_file, busy_timeout_ms,
+            synchronous="FULL" if self.fsync_policy == FSYNC_ALWAYS else "NORMAL",
+            row_factory=sqlite3.Row, cached_statements=64
+        )
+
+        is_new = not os.path.exists(self.db_file)
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        self._migrate_schema(conn)
+        conn.executescript(INDEXES)
+        if is_new and import_log:
+            self._import_log(resolve_log_path(import_log))
+
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        return self._db.connection()
+
+    @staticmethod
+    def _migrate_schema(conn: sqlite3.Connection) -> None:
+        """Добавить колонку корпуса в базы, созданные до ее появления"""
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(incidents)")}
+        if 'building' in columns:
+            return
+        conn.create_function('extract_building', 1, extract_building)
+        with conn:
+            conn.execute("ALTER TABLE incidents ADD COLUMN building TEXT")
+            conn.execute("UPDATE incidents SET building = extract_building(location)")
+
+    def _import_log(self, log_file: str) -> None:
+        """Однократно перенести инциденты из журнала JSON Lines"""
+        if not os.path.exists(log_file):
+            return
+        incident_log = IncidentLog(log_file)
+        self.append_many(incident_log.iter_incidents())
+        incident_log.close()
+
+    @staticmethod
+    def _to_row(incident: Dict[str, Any]) -> tuple:
+        """Преобразовать инцидент в строку таблицы"""
+        return (
+            incident.get('incident_id'),
+            incident.get('timestamp') or datetime.now().isoformat(),
+            incident['user_id'],
+            incident.get('username'),
+            incident.get('description', ''),
+            incident.get('location', ''),
+            json.dumps(incident.get('media_files', []), ensure_ascii=False),
+            extract_building(incident.get('location')),
+        )
+
+    @staticmethod
+    def _from_row(row: sqlite3.Row) -> Dict[str, Any]:
+        """Преобразовать строку таблицы в инцидент"""
+        incident = dict(row)
+        incident['media_files'] = json.loads(incident['media_files'])
+        return incident
+
+    def append(self, incident: Dict[str, Any]) -> None:
+        """Сохранить инцидент"""
+        conn = self._connection()
+        with conn:
+            conn.execute(SQL_INSERT, self._to_row(incident))
+
+    def append_many(self, incidents: Iterable[Dict[str, Any]]) -> None:
+        """Сохранить пачку инцидентов одной транзакцией"""
+        conn = self._connection()
+        with conn:
+            conn.executemany(SQL_INSERT, (self._to_row(incident) for incident in incidents))
+
+    def get(self, incident_id: str) -> Optional[Dict[str, Any]]:
+        """Получить инцидент по идентификатору"""
+        row = self._connection().execute(SQL_GET, (incident_id,)).fetchone()
+        return self._from_row(row) if row else None
+
+    def query_by_time(self, start: datetime, end: datetime, limit: int = 100) -> List[Dict[str, Any]]:
+        """Инциденты за период [start, end) по индексу времени"""
+        rows = self._connection().execute(SQL_BY_TIME, (start.isoformat(), end.isoformat(), limit))
+        return [self._from_row(row) for row in rows]
+
+    def query_by_user(self, user_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+        """Последние инциденты пользователя по индексу user_id"""
+        rows = self._connection().execute(SQL_BY_USER, (user_id, limit))
+        return [self._from_row(row) for row in rows]
+
+    def get_by_rowid(self, rowid: int) -> Optional[Dict[str, Any]]:
+        """Получить инцидент по порядковому номеру (#id в админ-командах)"""
+        row = self._connection().execute(SQL_GET_BY_ROWID, (rowid,)).fetchone()
+        return self._from_row(row) if row else None
+
+    def page(self, user_id: Optional[int] = None, building: Optional[str] = None,
+             since: Optional[datetime] = None, until: Optional[datetime] = None,
+             before_id: Optional[int] = None, after_id: Optional[int] = None,
+             limit: int = 10) -> List[Dict[str, Any]]:
+        """Страница инцидентов от новых к старым с пагинацией по ключу (id).
+
+        Фильтры (заданные объединяются через И): пользователь, корпус,
+        время [since, until). Условия - постоянные строки, значения
+        передаются параметрами. По пользователю и корпусу страница берется
+        по индексу (колонка, id) и не зависит от номера страницы; по времени
+        просматриваются инциденты периода, поэтому порядок id и порядок
+        времени могут не совпадать (журнал и архив дописывают старые записи).
+        """
+        filters = [
+            ("user_id = ?", user_id),
+            ("building = ?", building),
+            ("timestamp >= ?", since.isoformat() if since is not None else None),
+            ("timestamp < ?", until.isoformat() if until is not None else None),
+        ]
+        conditions = [condition for condition, value in filters if value is not None]
+        params = tuple(value for _, value in filters if value is not None)
+        if after_id is not None:
+            # Предыдущая страница: ближайшие более новые записи
+            conditions.append("id > ?")
+            order, params = "ASC", params + (after_id, limit)
+        else:
+            conditions.append("id < ?")
+            cursor = before_id if before_id is not None else 2 ** 63 - 1
+            order, params = "DESC", params + (cursor, limit)
+        sql = f"SELECT {SQL_COLUMNS} FROM incidents WHERE {' AND '.join(conditions)} ORDER BY id {order} LIMIT ?"
+        rows = self._connection().execute(sql, params).fetchall()
+        if after_id is not None:
+            rows.reverse()
+        return [self._from_row(row) for row in rows]
+
+    def close(self) -> None:
+        """Закрыть соединения всех потоков"""
+        self._db.close()
+
+
+class IndexedIncidentStore(IIncidentStore):
+    """Основное хранилище (журнал или архив) с индексом в SQLite для выборок.
+
+    Записи попадают в оба хранилища; чтение идет из индекса. Новый индекс
+    однократно заполняется из основного хранилища.
+    """
+
+    def __init__(self, primary: IIncidentStore, index_file: str = 'logs/incidents_index.db'):
+        self.primary = primary
+        is_new = not os.path.exists(resolve_log_path(index_file))
+        self.index = SQLiteIncidentStore(index_file, import_log=None, fsync_policy=primary.fsync_policy)
+        if is_new:
+            self.index.append_many(primary.iter_incidents())
+
+    def append(self, incident: Dict[str, Any]) -> None:
+        """Сохранить инцидент в основное хранилище и индекс"""
+        self.append_many([incident])
+
+    def append_many(self, incidents: Iterable[Dict[str, Any]]) -> None:
+        """Сохранить пачку инцидентов в основное хранилище и индекс"""
+        incidents = list(incidents)
+        self.primary.append_many(incidents)
+        self.index.append_many(incidents)
+
+    def get(self, incident_id: str) -> Optional[Dict[str, Any]]:
+        return self.index.get(incident_id)
+
+    def query_by_time(self, start: datetime, end: datetime, limit: int = 100) -> List[Dict[str, Any]]:
+        return self.index.query_by_time(start, end, limit)
+
+    def query_by_user(self, user_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+        return self.index.query_by_user(user_id, limit)
+
+    def close(self) -> None:
+        self.primary.close()
+        self.index.close()
+
+
+def get_incident_index(store: IIncidentStore) -> SQLiteIncidentStore:
+    """Индекс SQLite, из которого обслуживаются выборки по хранилищу"""
+    if isinstance(store, SQLiteIncidentStore):
+        return store
+    if isinstance(store, IndexedIncidentStore):
+        return store.index
+    raise TypeError(f"Хранилище {type(store).__name__} не поддерживает индексированные выборки")
+
+
+def create_incident_store() -> IIncidentStore:
+    """Создать хранилище инцидентов согласно INCIDENT_STORE (sqlite | jsonl | archive)"""
+    backend = os.getenv('INCIDENT_STORE', 'sqlite')
+    if backend == 'jsonl':
+        return IndexedIncidentStore(IncidentLog())
+    if backend == 'archive':
+        return IndexedIncidentStore(PartitionedIncidentArchive())
+    if backend == 'sqlite':
+        return SQLiteIncidentStore()
+    raise ValueError(f"Неизвестное хранилище инцидентов: {backend}")
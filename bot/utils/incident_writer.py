@@ -0,0 +1,247 @@
+"""
+Групповая запись инцидентов через очередь в памяти (write-behind)
+"""
+import asyncio
+import glob
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot.interfaces import IIncidentStore
+from bot.utils.file_lock import lock_file
+from bot.utils.incident_log import FSYNC_NEVER, IncidentLog, iter_jsonl_entries, resolve_log_path
+from bot.utils.io_executor import run_io
+
+# Политики подтверждения пользователю
+ACK_DURABLE = 'durable'      # ждать фиксации пачки в хранилище
+ACK_JOURNALED = 'journaled'  # достаточно записи в журнал (переживает падение процесса)
+
+ACK_POLICIES = (ACK_DURABLE, ACK_JOURNALED)
+
+# Паузы между повторами неудавшейся фиксации (сек) и ожидание очереди при остановке
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+CLOSE_TIMEOUT = 10.0
+
+
+class GroupCommitWriter:
+    """Очередь записи инцидентов с групповой фиксацией.
+
+    Каждый инцидент сначала дописывается в журнал без fsync и ставится
+    в очередь. Фоновая задача забирает из очереди пачки (до max_batch
+    записей или flush_interval_ms миллисекунд) и фиксирует их в хранилище
+    одной записью с одним fsync. При старте журнал проигрывается заново,
+    поэтому подтвержденные инциденты не теряются при падении процесса.
+    Неудавшаяся пачка возвращается в очередь и повторяется с растущей
+    паузой; ожидающие ее future получают ошибку сразу.
+
+    У каждого процесса свой журнал (journal_file.<pid>), занятость
+    которого отмечена блокировкой файла <журнал>.lock. При старте
+    проигрываются журналы, чьи владельцы уже завершились.
+    """
+
+    def __init__(self, store: IIncidentStore,
+                 journal_file: str = 'logs/incidents.journal',
+                 flush_interval_ms: Optional[int] = None,
+                 max_batch: Optional[int] = None,
+                 ack_policy: Optional[str] = None):
+        self.store = store
+        self.flush_interval = (flush_interval_ms or int(os.getenv('INCIDENT_FLUSH_MS', '50'))) / 1000
+        self.max_batch = max_batch or int(os.getenv('INCIDENT_BATCH_SIZE', '100'))
+        self.ack_policy = ack_policy or os.getenv('INCIDENT_ACK_POLICY', ACK_DURABLE)
+        if self.ack_policy not in ACK_POLICIES:
+            raise ValueError(f"Неизвестная политика подтверждения: {self.ack_policy}")
+
+        self.journal_file = resolve_log_path(journal_file)
+        # Журнал открывается в start(): процесс мог быть порожден fork после создания объекта
+        self.journal: Optional[IncidentLog] = None
+        self._owner_lock = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending = 0  # инциденты, записанные в журнал, но еще не зафиксированные
+        self._truncating: Optional[asyncio.Future] = None  # журнал очищается в пуле
+
+    @property
+    def durable_ack(self) -> bool:
+        """Нужно ли ждать фиксации перед ответом пользователю"""
+        return self.ack_policy == ACK_DURABLE
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> int:
+        """Проиграть журналы и запустить фоновую фиксацию"""
+        replayed = await run_io(self.replay_journal)
+        await run_io(self._open_journal)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        return replayed
+
+    def _open_journal(self) -> None:
+        """Открыть журнал этого процесса и отметить его занятость блокировкой"""
+        journal_path = f"{self.journal_file}.{os.getpid()}"
+        self._owner_lock = open(journal_path + '.lock', 'a+b')
+        lock_file(self._owner_lock)
+        self.journal = IncidentLog(journal_path, fsync_policy=FSYNC_NEVER, legacy_file=None)
+
+    def _journal_candidates(self) -> List[str]:
+        """Общий журнал прежних версий и журналы всех процессов"""
+        paths = glob.glob(glob.escape(self.journal_file) + '.*')
+        paths = [path for path in paths if not path.endswith('.lock')]
+        if os.path.exists(self.journal_file):
+            paths.insert(0, self.journal_file)
+        return paths
+
+    def replay_journal(self) -> int:
+        """Дописать в хранилище записи журналов завершившихся процессов"""
+        replayed = 0
+        for path in self._journal_candidates():
+            with open(path + '.lock', 'a+b') as owner_lock:
+                if not lock_file(owner_lock, blocking=False):
+                    # Владелец журнала жив - он зафиксирует свои записи сам
+                    continue
+                replayed += self._replay_file(path)
+                if os.path.exists(path):
+                    os.remove(path)
+            try:
+                os.remove(path + '.lock')
+            except FileNotFoundError:
+                pass
+        return replayed
+
+    def _replay_file(self, path: str) -> int:
+        """Дописать в хранилище записи одного журнала, не дошедшие до него до сбоя"""
+        missing = [
+            incident for _, incident in iter_jsonl_entries(path)
+            if not incident.get('incident_id') or self.store.get(incident['incident_id']) is None
+        ]
+        if missing:
+            self.store.append_many(missing)
+        return len(missing)
+
+    async def submit(self, incident: Dict[str, Any]) -> asyncio.Future:
+        """Поставить инцидент в очередь; результат - future фиксации в хранилище"""
+        future = asyncio.get_running_loop().create_future()
+
+        if not self.running:
+            # Фоновая фиксация не запущена - пишем сразу
+            await run_io(self._commit, [incident])
+            future.set_result(None)
+            return future
+
+        self._pending += 1
+        if self._truncating is not None:
+            # Дописывать в журнал только после очистки, иначе запись сотрется
+            await asyncio.shield(self._truncating)
+        await run_io(self.journal.append, incident)
+        self._queue.put_nowait((incident, future))
+        return future
+
+    def _commit(self, incidents: List[Dict[str, Any]]) -> None:
+        """Зафиксировать пачку в хранилище (одна запись, один fsync)"""
+        self.store.append_many(incidents)
+
+    async def _collect_batch(self) -> List[Tuple[Dict[str, Any], Optional[asyncio.Future]]]:
+        """Дождаться первой записи и добрать пачку до лимита или таймаута"""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _commit_retry(self, incidents: List[Dict[str, Any]]) -> None:
+        """Повторить фиксацию: часть пачки могла дойти до хранилища до ошибки"""
+        self._commit([
+            incident for incident in incidents
+            if not incident.get('incident_id') or self.store.get(incident['incident_id']) is None
+        ])
+
+    async def _flush(self, batch: List[Tuple[Dict[str, Any], Optional[asyncio.Future]]]) -> bool:
+        """Зафиксировать пачку и разбудить ожидающих; False - пачка возвращена в очередь"""
+        incidents = [incident for incident, _ in batch]
+        retry = any(future is None for _, future in batch)
+        try:
+            await run_io(self._commit_retry if retry else self._commit, incidents)
+        except Exception as e:
+            print(f"Ошибка групповой записи инцидентов: {e}")
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            # Записи остаются в журнале (_pending не меняется) и повторяются фоновой задачей
+            for incident in incidents:
+                self._queue.put_nowait((incident, None))
+            return False
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+        for _, future in batch:
+            if future is not None and not future.done():
+                future.set_result(None)
+
+        self._pending -= len(batch)
+        if self._pending == 0:
+            # Все записи журнала зафиксированы - журнал можно очистить
+            self._truncating = asyncio.get_running_loop().create_future()
+            try:
+                await run_io(self.journal.truncate)
+            except Exception as e:
+                print(f"Ошибка очистки журнала инцидентов: {e}")
+            finally:
+                self._truncating.set_result(None)
+                self._truncating = None
+        return True
+
+    async def _run(self) -> None:
+        """Фоновая задача групповой фиксации"""
+        delay = 0.0
+        while True:
+            batch = await self._collect_batch()
+            if await self._flush(batch):
+                delay = 0.0
+            else:
+                delay = min(delay * 2 or RETRY_DELAY, MAX_RETRY_DELAY)
+                await asyncio.sleep(delay)
+
+    async def close(self, timeout: float = CLOSE_TIMEOUT) -> None:
+        """Дождаться фиксации очереди и остановить запись (SIGTERM).
+
+        Если фоновая задача упала или очередь не зафиксирована за timeout
+        секунд, остановка не ждет: незафиксированные записи остаются в
+        журнале и проигрываются при следующем старте.
+        """
+        if self._task is not None:
+            if not self._task.done():
+                join = asyncio.ensure_future(self._queue.join())
+                await asyncio.wait({join, self._task}, timeout=timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                join.cancel()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                print(f"Фоновая запись инцидентов завершилась с ошибкой: {e}")
+        self._task = None
+        if self.journal is not None:
+            self.journal.close()
+            if self._pending == 0:
+                # Все записи зафиксированы - журнал процесса больше не нужен
+                try:
+                    os.remove(self.journal.log_file)
+                except FileNotFoundError:
+                    pass  # в журнал ничего не писали
+            self.journal = None
+        if self._owner_lock is not None:
+            self._owner_lock.close()
+            if self._pending == 0:
+                os.remove(self._owner_lock.name)
+            self._owner_lock = None
@@ -0,0 +1,106 @@
+"""
+Вынос блокирующего файлового ввода-вывода из цикла событий asyncio
+"""
+import asyncio
+import functools
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from bot.interfaces import IFileManager, ILogger
+
+
+class IOExecutor:
+    """Ограниченный пул потоков для блокирующих дисковых операций.
+
+    Число потоков и число ожидающих задач ограничены: при переполнении
+    корутины ждут свободного места, а не копят очередь без предела.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, max_pending: Optional[int] = None):
+        self.max_workers = max_workers or int(os.getenv('IO_WORKERS', '4'))
+        self.max_pending = max_pending or self.max_workers * 16
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bot-io')
+        # Семафор привязан к циклу событий, поэтому храним отдельный на каждый цикл
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = \
+            weakref.WeakKeyDictionary()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_pending)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Выполнить блокирующую функцию в пуле и дождаться результата"""
+        async with self._semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Остановить пул, дождавшись начатых операций"""
+        self._executor.shutdown(wait=wait)
+
+
+_default_executor: Optional[IOExecutor] = None
+_default_executor_lock = threading.Lock()
+
+
+def get_io_executor() -> IOExecutor:
+    """Общий пул ввода-вывода приложения"""
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = IOExecutor()
+        return _default_executor
+
+
+async def run_io(func: Callable, *args, **kwargs) -> Any:
+    """Выполнить блокирующую функцию в общем пуле ввода-вывода"""
+    return await get_io_executor().run(func, *args, **kwargs)
+
+
+def read_file_bytes(file_path: str) -> bytes:
+    """Прочитать файл целиком (для отправки фото и документов)"""
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+class AsyncFileManager:
+    """Асинхронная обертка над IFileManager"""
+
+    def __init__(self, file_manager: IFileManager, executor: Optional[IOExecutor] = None):
+        self.file_manager = file_manager
+        self.executor = executor or get_io_executor()
+
+    async def load_json(self, file_path: str) -> Dict[str, Any]:
+        return await self.executor.run(self.file_manager.load_json, file_path)
+
+    async def save_json(self, file_path: str, data: Dict[str, Any]) -> None:
+        await self.executor.run(self.file_manager.save_json, file_path, data)
+
+    async def file_exists(self, file_path: str) -> bool:
+        return await self.executor.run(self.file_manager.file_exists, file_path)
+
+    async def read_bytes(self, file_path: str) -> bytes:
+        return await self.executor.run(read_file_bytes, file_path)
+
+
+class AsyncLogger:
+    """Асинхронная обертка над ILogger"""
+
+    def __init__(self, logger: ILogger, executor: Optional[IOExecutor] = None):
+        self.logger = logger
+        self.executor = executor or get_io_executor()
+
+    async def log_activity(self, user_id: int, username: Optional[str], action: str,
+                           payload_summary: str = "") -> None:
+        if getattr(self.logger, 'nonblocking', False):
+            # Логгер только ставит запись в очередь - пул потоков не нужен
+            self.logger.log_activity(user_id, username, action, payload_summary)
+            return
+        await self.executor.run(self.logger.log_activity, user_id, username, action, payload_summary)
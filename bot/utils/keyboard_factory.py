@@ -1,7 +1,7 @@
 """
 Фабрика клавиатур для устранения дублирования кода
 """
-from telegram import ReplyKeyboardMarkup, KeyboardButton
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 
 from bot.interfaces import IKeyboardFactory
 
@@ -107,3 +107,33 @@ class KeyboardFactory(IKeyboardFactory):
             keyboard.append([f"📄📑 Открыть документ {i}"])
         keyboard.append(['⬅️🔙 Назад'])
         return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    def create_incident_pagination(self, kind: str, arg: str, first_id: int, last_id: int,
+                                   has_prev: bool, has_next: bool):
+        """Создать inline-кнопки листания выборки инцидентов.
+
+        В callback_data (до 64 байт) передается граница страницы,
+        а не ее номер: следующая страница читается по индексу с этого id.
+        """
+        buttons = []
+        if has_prev:
+            buttons.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"inc|{kind}|{arg}|p{first_id}"))
+        if has_next:
+            buttons.append(InlineKeyboardButton("Старше ➡️", callback_data=f"inc|{kind}|{arg}|n{last_id}"))
+        return InlineKeyboardMarkup([buttons]) if buttons else None
+    
+    def create_page_navigation(self, prefix: str, page: int, total: int):
+        """Создать inline-кнопки листания страниц одного сообщения.
+
+        callback_data = <prefix>|<номер страницы>; средняя кнопка с номером
+        страницы ничего не делает (<prefix>|-).
+        """
+        if total <= 1:
+            return None
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"{prefix}|{page - 1}"))
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"{prefix}|-"))
+        if page < total - 1:
+            buttons.append(InlineKeyboardButton("Старше ➡️", callback_data=f"{prefix}|{page + 1}"))
+        return InlineKeyboardMarkup([buttons])
@@ -0,0 +1,97 @@
+"""
+Отправка медиафайлов альбомами (send_media_group)
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram import InputMediaPhoto, InputMediaVideo, Message
+
+from bot.utils.paginator import utf16_len
+
+MEDIA_GROUP_LIMIT = 10   # максимум элементов в альбоме
+CAPTION_LIMIT = 1024     # максимум единиц UTF-16 в подписи
+
+
+def split_media(media_files: List[Dict[str, Any]], limit: int = MEDIA_GROUP_LIMIT) -> List[List[Dict[str, Any]]]:
+    """Разбить медиафайлы на альбомы поровну (без альбомов из одного элемента)"""
+    if not media_files:
+        return []
+    chunks_count = -(-len(media_files) // limit)
+    size, extra = divmod(len(media_files), chunks_count)
+    chunks, start = [], 0
+    for index in range(chunks_count):
+        end = start + size + (1 if index < extra else 0)
+        chunks.append(media_files[start:end])
+        start = end
+    return chunks
+
+
+def _input_media(media: Dict[str, Any], caption: Optional[str], parse_mode: Optional[str]):
+    if media['file_type'] == 'photo':
+        return InputMediaPhoto(media=media['file_id'], caption=caption, parse_mode=parse_mode)
+    return InputMediaVideo(media=media['file_id'], caption=caption, parse_mode=parse_mode)
+
+
+async def _send_single(bot, chat_id, media: Dict[str, Any], caption: Optional[str],
+                       parse_mode: Optional[str]) -> Message:
+    if media['file_type'] == 'photo':
+        return await bot.send_photo(chat_id=chat_id, photo=media['file_id'],
+                                    caption=caption, parse_mode=parse_mode)
+    return await bot.send_video(chat_id=chat_id, video=media['file_id'],
+                                caption=caption, parse_mode=parse_mode)
+
+
+async def _send_chunk(bot, chat_id, chunk: List[Dict[str, Any]], caption: Optional[str],
+                      parse_mode: Optional[str]) -> List[Message]:
+    """Отправить один альбом; при ошибке - повторить каждый файл отдельно"""
+    if len(chunk) > 1:
+        try:
+            messages = await bot.send_media_group(
+                chat_id=chat_id,
+                media=[
+                    _input_media(media, caption if index == 0 else None, parse_mode)
+                    for index, media in enumerate(chunk)
+                ]
+            )
+            return list(messages)
+        except Exception as e:
+            # Один испорченный файл отклоняет весь альбом - отправляем по одному
+            print(f"Ошибка отправки альбома ({len(chunk)} файлов), отправляем по одному: {e}")
+
+    messages = []
+    for media in chunk:
+        try:
+            messages.append(await _send_single(bot, chat_id, media, caption, parse_mode))
+            caption = None
+        except Exception as e:
+            print(f"Ошибка отправки медиафайла: {e}")
+    return messages
+
+
+async def send_report_with_media(bot, chat_id, text: str, media_files: List[Dict[str, Any]],
+                                 parse_mode: Optional[str] = 'Markdown') -> Tuple[Optional[Message], bool]:
+    """Отправить текст сообщения вместе с медиафайлами альбомами по 10.
+
+    Текст становится подписью первого элемента, если укладывается
+    в лимит подписи, иначе уходит отдельным сообщением. Возвращает
+    сообщение с текстом и признак того, что текст - это подпись
+    (для последующего редактирования).
+    """
+    if not media_files:
+        return await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode), False
+
+    is_caption = utf16_len(text) <= CAPTION_LIMIT
+    caption = text if is_caption else None
+    report_message = None
+    if caption is None:
+        report_message = await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+
+    for chunk in split_media(media_files):
+        messages = await _send_chunk(bot, chat_id, chunk, caption, parse_mode)
+        if caption is not None and messages:
+            report_message = messages[0]
+            caption = None
+
+    if report_message is None:
+        # Не ушел ни один файл - текст отправляем отдельно, чтобы он не потерялся
+        return await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode), False
+    return report_message, is_caption
@@ -0,0 +1,271 @@
+"""
+Персистентная очередь исходящих уведомлений (outbox) и ее диспетчер
+"""
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+from bot.utils.incident_log import resolve_log_path
+from bot.utils.io_executor import run_io
+from bot.utils.sqlite_connections import ThreadLocalSQLite
+from bot.utils.telegram_errors import retry_after_seconds
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox(next_attempt_at);
+"""
+
+OUTBOX_COLUMNS = "id, kind, chat_id, payload, attempts, next_attempt_at, created_at, last_error"
+
+
+class Outbox:
+    """Очередь уведомлений в SQLite: запись переживает перезапуск, пока не доставлена.
+
+    Время в очереди - time.time(), чтобы расписание повторов
+    сохраняло смысл после перезапуска процесса.
+    """
+
+    def __init__(self, db_file: str = 'logs/outbox.db', busy_timeout_ms: int = 5000):
+        self.db_file = resolve_log_path(db_file)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._db = ThreadLocalSQLite(self.db_file, busy_timeout_ms, row_factory=sqlite3.Row)
+        self._connection().executescript(OUTBOX_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        return self._db.connection()
+
+    @staticmethod
+    def _from_row(row: sqlite3.Row) -> Dict[str, Any]:
+        entry = dict(row)
+        entry['payload'] = json.loads(entry['payload'])
+        return entry
+
+    def enqueue(self, kind: str, chat_id: Any, payload: Dict[str, Any]) -> int:
+        """Поставить уведомление в очередь; возвращает id записи"""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO outbox (kind, chat_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, str(chat_id), json.dumps(payload, ensure_ascii=False), now, now)
+            )
+        return cursor.lastrowid
+
+    def enqueue_many(self, kind: str, items: List[Tuple[Any, Dict[str, Any]]]) -> List[int]:
+        """Поставить в очередь по записи на каждого получателя (chat_id, payload) одной транзакцией.
+
+        У каждой записи свое расписание повторов: сбой одного чата
+        не задерживает доставку остальным.
+        """
+        now = time.time()
+        conn = self._connection()
+        ids = []
+        with conn:
+            for chat_id, payload in items:
+                cursor = conn.execute(
+                    "INSERT INTO outbox (kind, chat_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (kind, str(chat_id), json.dumps(payload, ensure_ascii=False), now, now)
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def due(self, now: Optional[float] = None, limit: int = 50,
+            chat_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Записи, которым пора отправляться (все или одного чата)"""
+        now = time.time() if now is None else now
+        if chat_id is None:
+            chat_filter, params = "", (now, limit)
+        else:
+            chat_filter, params = "AND chat_id = ? ", (now, chat_id, limit)
+        rows = self._connection().execute(
+            f"SELECT {OUTBOX_COLUMNS} FROM outbox WHERE next_attempt_at <= ? {chat_filter}"
+            "ORDER BY next_attempt_at, id LIMIT ?",
+            params
+        )
+        return [self._from_row(row) for row in rows]
+
+    def due_chats(self, now: Optional[float] = None) -> List[str]:
+        """Чаты, в которых есть записи, которым пора отправляться"""
+        now = time.time() if now is None else now
+        rows = self._connection().execute(
+            "SELECT DISTINCT chat_id FROM outbox WHERE next_attempt_at <= ?", (now,)
+        )
+        return [row[0] for row in rows]
+
+    def next_attempt_at(self, exclude_chats: Iterable[str] = ()) -> Optional[float]:
+        """Время ближайшей запланированной отправки (без чатов exclude_chats)"""
+        exclude_chats = list(exclude_chats)
+        chat_filter = f" WHERE chat_id NOT IN ({', '.join('?' * len(exclude_chats))})" if exclude_chats else ""
+        row = self._connection().execute(
+            f"SELECT MIN(next_attempt_at) FROM outbox{chat_filter}", exclude_chats
+        ).fetchone()
+        return row[0]
+
+    def mark_sent(self, entry_id: int) -> None:
+        """Удалить доставленную запись"""
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def reschedule(self, entry_id: int, next_attempt_at: float, error: str) -> None:
+        """Запланировать повторную отправку"""
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (next_attempt_at, error[:500], entry_id)
+            )
+
+    def pending_count(self) -> int:
+        """Число недоставленных записей"""
+        return self._connection().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self) -> None:
+        """Закрыть соединения всех потоков"""
+        self._db.close()
+
+
+DeliverFunc = Callable[[Any, Dict[str, Any]], Awaitable[None]]
+
+
+class OutboxDispatcher:
+    """Фоновая доставка записей outbox с экспоненциальной задержкой повторов.
+
+    Запись удаляется только после успешной отправки, поэтому при падении
+    процесса она будет доставлена после перезапуска (не менее одного раза).
+    Ответ 429 откладывает запись ровно на retry_after.
+
+    У каждого чата своя полоса - задача, которая доставляет его записи
+    (не больше per_chat_concurrency одновременно): медленный чат или
+    долгий retry_after не задерживают остальные чаты. Всего одновременно
+    идет не больше concurrency отправок.
+    """
+
+    def __init__(self, outbox: Outbox, handlers: Dict[str, DeliverFunc],
+                 base_delay: Optional[float] = None, max_delay: Optional[float] = None,
+                 concurrency: Optional[int] = None, per_chat_concurrency: Optional[int] = None):
+        self.outbox = outbox
+        self.handlers = handlers
+        self.base_delay = base_delay or float(os.getenv('OUTBOX_RETRY_BASE_SEC', '2'))
+        self.max_delay = max_delay or float(os.getenv('OUTBOX_RETRY_MAX_SEC', '600'))
+        self.concurrency = concurrency or int(os.getenv('OUTBOX_CONCURRENCY', '8'))
+        self.per_chat_concurrency = per_chat_concurrency or int(os.getenv('OUTBOX_PER_CHAT_CONCURRENCY', '1'))
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lanes: Dict[str, asyncio.Task] = {}  # chat_id -> задача доставки в чат
+        self.bot = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, bot) -> int:
+        """Запустить доставку; возвращает число записей, оставшихся с прошлого запуска"""
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        return await run_io(self.outbox.pending_count)
+
+    def wake(self) -> None:
+        """Разбудить диспетчер после постановки новой записи"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def backoff(self, attempts: int) -> float:
+        """Задержка перед повтором: base * 2^attempts с разбросом, не больше max_delay"""
+        delay = min(self.base_delay * (2 ** attempts), self.max_delay)
+        return delay * random.uniform(0.8, 1.2)
+
+    async def deliver(self, entry: Dict[str, Any]) -> bool:
+        """Доставить одну запись; False - запись отложена"""
+        handler = self.handlers.get(entry['kind'])
+        try:
+            if handler is None:
+                raise ValueError(f"Нет обработчика для уведомлений вида {entry['kind']}")
+            await handler(self.bot, entry)
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            await run_io(self.outbox.reschedule, entry['id'], time.time() + delay, f"429: retry after {delay}")
+            return False
+        except Exception as e:
+            delay = self.backoff(entry['attempts'])
+            print(f"Ошибка доставки уведомления {entry['id']} (попытка {entry['attempts'] + 1}), "
+                  f"повтор через {delay:.0f} с: {e}")
+            await run_io(self.outbox.reschedule, entry['id'], time.time() + delay, str(e))
+            return False
+        await run_io(self.outbox.mark_sent, entry['id'])
+        return True
+
+    async def _deliver_limited(self, entry: Dict[str, Any]) -> bool:
+        """Доставка с общим ограничением параллельности"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            return await self.deliver(entry)
+
+    async def _run_lane(self, chat_id: str) -> None:
+        """Полоса чата: доставлять его записи, пока есть те, которым пора"""
+        try:
+            while True:
+                entries = await run_io(self.outbox.due, None, self.per_chat_concurrency, chat_id)
+                if not entries:
+                    return
+                await asyncio.gather(*(self._deliver_limited(entry) for entry in entries))
+        except Exception as e:
+            print(f"Ошибка доставки уведомлений в чат {chat_id}: {e}")
+        finally:
+            del self._lanes[chat_id]
+            # Диспетчер пересчитает время следующей отправки с учетом этого чата
+            self.wake()
+
+    async def dispatch_due(self) -> int:
+        """Запустить полосы чатов, где есть записи, которым пора; возвращает число новых полос"""
+        started = 0
+        for chat_id in await run_io(self.outbox.due_chats):
+            if chat_id not in self._lanes:
+                self._lanes[chat_id] = asyncio.create_task(self._run_lane(chat_id))
+                started += 1
+        return started
+
+    async def _run(self) -> None:
+        """Фоновая задача: запустить полосы и уснуть до следующей записи свободного чата или до wake()"""
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.dispatch_due()
+                next_at = await run_io(self.outbox.next_attempt_at, list(self._lanes))
+            except Exception as e:
+                print(f"Ошибка диспетчера уведомлений: {e}")
+                next_at = time.time() + self.base_delay
+            timeout = None if next_at is None else max(next_at - time.time(), 0.05)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self) -> None:
+        """Остановить доставку; недоставленное останется в outbox до следующего запуска"""
+        tasks = list(self._lanes.values())
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
@@ -0,0 +1,132 @@
+"""
+Разбиение длинного текста на страницы сообщений Telegram
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+# Telegram ограничивает текст сообщения 4096 единицами UTF-16; оставляем запас
+TELEGRAM_TEXT_LIMIT = 4096
+PAGE_LIMIT = 4000
+
+
+def utf16_len(text: str) -> int:
+    """Длина текста в единицах UTF-16 (эмодзи вне BMP занимают две)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _split_long(entry: str, limit: int) -> Iterator[str]:
+    """Разрезать запись длиннее страницы, не разрывая суррогатные пары"""
+    start, size = 0, 0
+    for index, char in enumerate(entry):
+        width = 2 if ord(char) > 0xFFFF else 1
+        if size + width > limit:
+            yield entry[start:index]
+            start, size = index, 0
+        size += width
+    if start < len(entry):
+        yield entry[start:]
+
+
+def paginate(entries: Iterable[str], header: str = "", limit: int = PAGE_LIMIT,
+             max_entries: Optional[int] = None) -> List[str]:
+    """Собрать записи в страницы не длиннее limit (UTF-16) за один проход.
+
+    Каждая страница начинается с header; запись переносится на следующую
+    страницу целиком, слишком длинная запись режется. max_entries -
+    не больше стольких записей на странице.
+    """
+    header_len = utf16_len(header)
+    room = max(limit - header_len, 1)
+    pages: List[str] = []
+    parts: List[str] = []
+    size = count = 0
+
+    def close_page() -> None:
+        nonlocal parts, size, count
+        if parts:
+            pages.append(header + ''.join(parts))
+        parts, size, count = [], 0, 0
+
+    for entry in entries:
+        entry_len = utf16_len(entry)
+        pieces = [entry] if entry_len <= room else list(_split_long(entry, room))
+        for piece in pieces:
+            piece_len = entry_len if len(pieces) == 1 else utf16_len(piece)
+            if parts and (size + piece_len > room or (max_entries and count >= max_entries)):
+                close_page()
+            parts.append(piece)
+            size += piece_len
+            count += 1
+    close_page()
+    return pages or [header]
+
+
+class PageCache:
+    """Готовые страницы по ключу (пользователю), действительные для версии данных.
+
+    get() возвращает страницы, только если версия не изменилась
+    (например, у пользователя не появилось новых записей). Общий объем
+    страниц ограничен max_bytes (HISTORY_CACHE_MB), при превышении
+    вытесняются давно не использованные. stats() - попадания, промахи,
+    вытеснения и текущий объем.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes or int(float(os.getenv('HISTORY_CACHE_MB', '8')) * 1024 * 1024)
+        self._items: 'OrderedDict[Hashable, Tuple[Hashable, List[str], int]]' = OrderedDict()
+        self._lock = threading.Lock()  # страницы строятся в потоках ввода-вывода
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0       # промахи из-за новой версии
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeof(pages: List[str]) -> int:
+        return sys.getsizeof(pages) + sum(sys.getsizeof(page) for page in pages)
+
+    def get(self, key: Hashable, version: Hashable) -> Optional[List[str]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != version:
+                self.misses += 1
+                if item is not None:
+                    self.stale += 1
+                    self._remove(key)
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: Hashable, version: Hashable, pages: List[str]) -> None:
+        size = self._sizeof(pages)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._items[key] = (version, pages, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        self.size -= self._items.pop(key)[2]
+
+    def stats(self) -> Dict[str, float]:
+        """Метрики кэша"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'items': len(self._items),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / requests if requests else 0.0,
+            }
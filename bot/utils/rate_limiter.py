@@ -0,0 +1,261 @@
+"""
+Ограничение частоты исходящих запросов к Bot API с приоритетными полосами
+"""
+import asyncio
+import contextvars
+import functools
+import itertools
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Coroutine, Dict, Iterator, List, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from bot.utils.telegram_errors import retry_after_seconds
+
+# Полосы приоритета: меньше - раньше
+PRIORITY_HIGH = 0     # подтверждения сообщений об опасности, уведомления админам
+PRIORITY_NORMAL = 1   # обычные ответы
+PRIORITY_LOW = 2      # история, списки документов
+
+# Методы, отвечающие на действие пользователя в интерфейсе, - без очереди
+UNTHROTTLED_ENDPOINTS = {'answerCallbackQuery', 'getMe', 'getFile', 'deleteWebhook', 'setMyCommands'}
+
+_request_priority: contextvars.ContextVar[int] = contextvars.ContextVar('request_priority', default=PRIORITY_NORMAL)
+
+
+@contextmanager
+def priority_lane(priority: int) -> Iterator[None]:
+    """Все запросы к Bot API внутри блока with идут в указанную полосу.
+
+    Контекст копируется в задачи, созданные внутри блока, поэтому
+    полосу наследуют и фоновые отправки (например, диспетчер outbox).
+    """
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+def with_priority(priority: int) -> Callable:
+    """Декоратор: запросы корутины-обработчика идут в указанную полосу"""
+    def decorator(func: Callable[..., Coroutine]) -> Callable[..., Coroutine]:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with priority_lane(priority):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 - сейчас)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float) -> None:
+        """Не выдавать токены seconds секунд (после ответа 429)"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _PendingRequest:
+    __slots__ = ('priority', 'seq', 'chat_id', 'granted')
+
+    def __init__(self, priority: int, seq: int, chat_id: Optional[str], granted: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.granted = granted
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Планировщик исходящих запросов на ведрах токенов.
+
+    Ведра: общее (около 30 сообщений в секунду), на каждый чат (около
+    одного в секунду) и дополнительное для групп (20 в минуту). Запрос
+    ждет, пока токены есть во всех своих ведрах; из готовых первым
+    уходит запрос высшей полосы, внутри полосы - по порядку поступления.
+    Поэтому всплеск ответов в полосе PRIORITY_LOW не задерживает
+    подтверждения и уведомления админам дольше одного интервала общего ведра.
+
+    Полоса берется из rate_limit_args (int), иначе из priority_lane().
+    Ответ 429 приостанавливает ведро чата (или общее) на retry_after
+    и повторяет запрос до max_retries раз.
+    """
+
+    def __init__(self, overall_rate: Optional[float] = None, chat_rate: Optional[float] = None,
+                 group_rate_per_minute: Optional[float] = None, max_retries: int = 3,
+                 burst: Optional[float] = None):
+        self.overall_rate = overall_rate or float(os.getenv('BOT_API_RATE_PER_SEC', '30'))
+        self.chat_rate = chat_rate or float(os.getenv('BOT_API_CHAT_RATE_PER_SEC', '1'))
+        self.group_rate = (group_rate_per_minute or float(os.getenv('BOT_API_GROUP_RATE_PER_MIN', '20'))) / 60
+        self.max_retries = max_retries
+        # Небольшой запас позволяет ответить на пару сообщений подряд без ожидания
+        self.burst = burst or float(os.getenv('BOT_API_CHAT_BURST', '3'))
+
+        self._overall = TokenBucket(self.overall_rate, self.overall_rate)
+        self._chats: Dict[str, TokenBucket] = {}
+        self._groups: Dict[str, TokenBucket] = {}
+        self._pending: List[_PendingRequest] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        for request in self._pending:
+            if not request.granted.done():
+                request.granted.cancel()
+        self._pending.clear()
+
+    @staticmethod
+    def _is_group(chat_id: str) -> bool:
+        # У групп и каналов отрицательные id
+        return chat_id.startswith('-')
+
+    def _chat_buckets(self, chat_id: Optional[str]) -> List[TokenBucket]:
+        if chat_id is None:
+            return []
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.burst)
+        if not self._is_group(chat_id):
+            return [bucket]
+        group_bucket = self._groups.get(chat_id)
+        if group_bucket is None:
+            group_bucket = self._groups[chat_id] = TokenBucket(self.group_rate, self.burst)
+        return [bucket, group_bucket]
+
+    def _cleanup(self, now: float) -> None:
+        """Забыть ведра чатов, которые давно восстановились"""
+        busy = {request.chat_id for request in self._pending}
+        for buckets in (self._chats, self._groups):
+            for chat_id in [chat_id for chat_id, bucket in buckets.items()
+                            if chat_id not in busy and bucket.is_idle(now)]:
+                del buckets[chat_id]
+
+    def _grant_next(self, now: float) -> Optional[float]:
+        """Выдать токен лучшему готовому запросу; иначе - сколько ждать следующего"""
+        overall_wait = self._overall.wait_time(now)
+        if overall_wait > 0:
+            return overall_wait
+
+        best, best_index, min_wait = None, -1, None
+        for index, request in enumerate(self._pending):
+            if best is not None and (request.priority, request.seq) > (best.priority, best.seq):
+                continue
+            wait = max((bucket.wait_time(now) for bucket in self._chat_buckets(request.chat_id)), default=0.0)
+            if wait == 0:
+                best, best_index = request, index
+            elif min_wait is None or wait < min_wait:
+                min_wait = wait
+
+        if best is None:
+            return min_wait
+        self._pending.pop(best_index)
+        self._overall.consume(now)
+        for bucket in self._chat_buckets(best.chat_id):
+            bucket.consume(now)
+        if not best.granted.done():
+            best.granted.set_result(None)
+        return 0.0
+
+    async def _run(self) -> None:
+        """Фоновая задача: раздавать токены ожидающим запросам"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            timeout = None
+            while self._pending:
+                timeout = self._grant_next(now)
+                if timeout != 0:
+                    break
+                timeout = None
+            if not self._pending and len(self._chats) > 1000:
+                self._cleanup(now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, priority: int, chat_id: Optional[str]) -> None:
+        if self._task is None:
+            # Лимитер не запущен (например, в тестах без Application) - без ограничений
+            return
+        request = _PendingRequest(priority, next(self._seq), chat_id,
+                                  asyncio.get_running_loop().create_future())
+        self._pending.append(request)
+        self._wakeup.set()
+        try:
+            await request.granted
+        except asyncio.CancelledError:
+            if request in self._pending:
+                self._pending.remove(request)
+            raise
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Any:
+        if endpoint in UNTHROTTLED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        priority = rate_limit_args if rate_limit_args is not None else _request_priority.get()
+        chat_id = data.get('chat_id')
+        chat_id = None if chat_id is None else str(chat_id)
+
+        for attempt in itertools.count():
+            await self._acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                now = time.monotonic()
+                buckets = self._chat_buckets(chat_id) or [self._overall]
+                for bucket in buckets:
+                    bucket.pause(now, delay)
+                print(f"Ответ 429 для {endpoint} (чат {chat_id}), повтор через {delay} с")
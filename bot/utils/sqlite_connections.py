@@ -0,0 +1,56 @@
+"""
+Соединения SQLite по одному на поток (хранилище инцидентов, outbox, индекс истории)
+"""
+import os
+import sqlite3
+import threading
+from typing import Any, List, Optional
+
+
+class ThreadLocalSQLite:
+    """Соединение с базой у каждого потока, закрытие всех соединений сразу.
+
+    Соединение создается при первом обращении потока (режим WAL,
+    busy_timeout, заданный synchronous). Соединения открываются с
+    check_same_thread=False: пользуется каждым только его поток, а
+    close() закрывает все, в том числе открытые потоками пула run_io.
+    """
+
+    def __init__(self, db_file: str, busy_timeout_ms: int = 5000, synchronous: str = 'FULL',
+                 row_factory: Optional[Any] = None, **connect_kwargs: Any):
+        self.db_file = db_file
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.row_factory = row_factory
+        self.connect_kwargs = connect_kwargs
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+        db_dir = os.path.dirname(self.db_file)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout_ms / 1000,
+                                   check_same_thread=False, **self.connect_kwargs)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self) -> None:
+        """Закрыть соединения всех потоков; следующее обращение откроет новое"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for conn in connections:
+            conn.close()
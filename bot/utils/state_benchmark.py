@@ -0,0 +1,84 @@
+"""
+Замер памяти состояний пользователей: словари (прежнее хранение) против StateManager
+"""
+import argparse
+import gc
+import sys
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from bot.utils.state_manager import StateManager
+
+MESSAGES_PER_USER = 3
+DESCRIPTION = "Задымление в коридоре второго этажа"
+
+
+def _user_state(user_id: int) -> Optional[Dict[str, Any]]:
+    """Нагрузка: у всех пользователей времена сообщений, у 20% - вопрос консультанту,
+    у 10% - черновик сообщения об опасности"""
+    bucket = user_id % 10
+    if bucket < 2:
+        return {'state': 'waiting_question', 'data': {}}
+    if bucket == 2:
+        return {'state': 'danger_location', 'data': {'description': DESCRIPTION}}
+    return None
+
+
+def _fill_legacy(users: int) -> List[Dict[int, Any]]:
+    """Прежнее хранение: словарь состояния на пользователя и список datetime сообщений"""
+    user_states: Dict[int, Dict[str, Any]] = {}
+    message_times: Dict[int, List[datetime]] = {}
+    for user_id in range(users):
+        state = _user_state(user_id)
+        if state is not None:
+            user_states[user_id] = {'state': state['state'], 'data': dict(state['data'])}
+        message_times[user_id] = [datetime.now() for _ in range(MESSAGES_PER_USER)]
+    return [user_states, message_times]
+
+
+def _fill_compact(users: int) -> StateManager:
+    manager = StateManager()
+    for user_id in range(users):
+        state = _user_state(user_id)
+        if state is not None:
+            manager.set_user_state(user_id, state)
+        for _ in range(MESSAGES_PER_USER):
+            manager.check_spam_protection(user_id)
+    return manager
+
+
+def _measure(fill: Callable[[int], Any], users: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        store = fill(users)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del store
+    return used
+
+
+def memory_benchmark(users: int) -> Dict[str, float]:
+    """Байт на пользователя: before - словари, after - StateManager (компактные записи)"""
+    legacy = _measure(_fill_legacy, users)
+    compact = _measure(_fill_compact, users)
+    return {'users': users, 'before': legacy / users, 'after': compact / users}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Память состояний пользователей (байт на пользователя)")
+    parser.add_argument('users', nargs='*', type=int, default=[100000, 1000000], help="число пользователей")
+    args = parser.parse_args(argv)
+    for users in args.users:
+        result = memory_benchmark(users)
+        print(f"{users} пользователей: было {result['before']:.0f} Б, стало {result['after']:.0f} Б "
+              f"({result['after'] / result['before']:.0%})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,51 +1,81 @@
 """
 Управление состояниями пользователей
 """
-from typing import Dict, Any, Optional
-from datetime import datetime, timedelta
+import os
+import time
+from array import array
+from typing import Dict, Any, Callable, Optional
 
 from bot.interfaces import IStateManager
+from bot.models.user_state import CompactUserState
+from bot.utils.ttl_store import GenerationDict, TTLDict
+
+# Окно защиты от спама (сек): времена сообщений старше него не нужны
+SPAM_WINDOW = 60
+
+
+def record_message(times: array, now: float, max_messages: int, window: float) -> bool:
+    """Учесть сообщение в кольце времен (array('d'), epoch-секунды).
+
+    Кольцо растет до max_messages, затем самое старое (минимальное) время
+    заменяется новым - позицию хранить не нужно. Если самое старое из
+    max_messages последних сообщений моложе window, сообщение отклоняется.
+    """
+    while len(times) > max_messages:
+        times.remove(min(times))
+    if len(times) < max_messages:
+        times.append(now)
+        return True
+    oldest = min(times)
+    if now - oldest < window:
+        return False
+    times[times.index(oldest)] = now
+    return True
 
 
 class StateManager(IStateManager):
-    """Класс для управления состояниями пользователей"""
-    
-    def __init__(self):
-        self._user_states: Dict[int, Dict[str, Any]] = {}
-        self._message_times: Dict[int, list] = {}  # Для защиты от спама
-    
+    """Класс для управления состояниями пользователей.
+
+    Состояние диалога живет state_ttl секунд после последнего обращения
+    (DIALOG_STATE_TTL_MIN), истекшее передается в on_expire(user_id, state).
+    Времена сообщений живут одно-два окна защиты от спама (GenerationDict).
+
+    Внутри состояние хранится компактно (CompactUserState: код состояния
+    и слоты черновика; кольцо времен сообщений - array('d')), наружу
+    отдается словарь {'state': ..., 'data': ...}. Словарь - копия:
+    изменения черновика сохраняются через set_user_state.
+    """
+
+    def __init__(self, state_ttl: Optional[float] = None,
+                 on_expire: Optional[Callable[[int, Dict[str, Any]], None]] = None):
+        state_ttl = state_ttl or float(os.getenv('DIALOG_STATE_TTL_MIN', '30')) * 60
+        self.on_expire = on_expire
+        self._user_states: TTLDict = TTLDict(state_ttl, self._state_expired)
+        self._message_times: GenerationDict = GenerationDict(SPAM_WINDOW)  # Для защиты от спама
+
+    def _state_expired(self, user_id: int, state: CompactUserState) -> None:
+        if self.on_expire is not None:
+            self.on_expire(user_id, state.to_dict())
+
     def get_user_state(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить состояние пользователя"""
-        return self._user_states.get(user_id)
-    
+        state = self._user_states.get(user_id)
+        return state.to_dict() if state is not None else None
+
     def set_user_state(self, user_id: int, state: Dict[str, Any]) -> None:
         """Установить состояние пользователя"""
-        self._user_states[user_id] = state
-    
+        self._user_states[user_id] = CompactUserState.from_dict(state)
+
     def clear_user_state(self, user_id: int) -> None:
         """Очистить состояние пользователя"""
         if user_id in self._user_states:
             del self._user_states[user_id]
         if user_id in self._message_times:
             del self._message_times[user_id]
-    
+
     def check_spam_protection(self, user_id: int, max_messages: int = 10) -> bool:
         """Проверяет защиту от спама (максимум сообщений в минуту)"""
-        current_time = datetime.now()
-        
-        # Очищаем старые сообщения (старше минуты)
-        if user_id in self._message_times:
-            self._message_times[user_id] = [
-                msg_time for msg_time in self._message_times[user_id]
-                if (current_time - msg_time).total_seconds() < 60
-            ]
-        else:
-            self._message_times[user_id] = []
-        
-        # Проверяем лимит
-        if len(self._message_times[user_id]) >= max_messages:
-            return False
-        
-        # Добавляем текущее время
-        self._message_times[user_id].append(current_time)
-        return True
+        times = self._message_times.get(user_id)
+        if times is None:
+            times = self._message_times[user_id] = array('d')
+        return record_message(times, time.time(), max_messages, SPAM_WINDOW)
@@ -0,0 +1,14 @@
+"""
+Разбор ошибок Bot API, общий для транспорта и очередей доставки
+"""
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Пауза из ответа 429 (в разных версиях библиотеки - int или timedelta)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
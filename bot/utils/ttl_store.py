@@ -0,0 +1,182 @@
+"""
+Словари с временем жизни записей: хешированное колесо таймеров и поколения
+"""
+import math
+import time
+from typing import Any, Callable, Dict, Hashable, Iterator, List, MutableMapping, Optional, Set
+
+
+class TimingWheel:
+    """Хешированное колесо таймеров: постановка, перенос и снятие ключа за O(1).
+
+    Время делится на такты по tick секунд; ключ со сроком в такте T лежит
+    в ячейке T % slots. advance() проходит только ячейки тактов, прошедших
+    с прошлого вызова (не больше одного оборота), и снимает ключи, срок
+    которых наступил; ключи следующих оборотов остаются на месте.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 512, clock: Callable[[], float] = time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._deadlines: Dict[Hashable, int] = {}
+        self._current = int(clock() / tick)
+        self._last_deadline = 0  # ключи одного такта делят один объект int
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        """Поставить (или перенести) срок ключа через delay секунд"""
+        deadline = max(math.ceil((self.clock() + delay) / self.tick), self._current + 1)
+        if deadline == self._last_deadline:
+            deadline = self._last_deadline
+        self._last_deadline = deadline
+        old = self._deadlines.get(key)
+        if old is not None:
+            self._slots[old % len(self._slots)].discard(key)
+        self._deadlines[key] = deadline
+        self._slots[deadline % len(self._slots)].add(key)
+
+    def cancel(self, key: Hashable) -> None:
+        deadline = self._deadlines.pop(key, None)
+        if deadline is not None:
+            self._slots[deadline % len(self._slots)].discard(key)
+
+    def advance(self) -> List[Hashable]:
+        """Снять ключи, срок которых наступил к текущему моменту"""
+        target = int(self.clock() / self.tick)
+        if target <= self._current:
+            return []
+        expired = []
+        steps = min(target - self._current, len(self._slots))
+        for tick in range(self._current + 1, self._current + 1 + steps):
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            due = [key for key in slot if self._deadlines[key] <= target]
+            for key in due:
+                slot.discard(key)
+                del self._deadlines[key]
+            expired.extend(due)
+        self._current = target
+        return expired
+
+
+class TTLDict(MutableMapping):
+    """Словарь, запись которого удаляется через ttl секунд после последнего обращения.
+
+    Чтение и запись продлевают срок записи ("касание"); проверка
+    наличия (in) не продлевает. Истекшие записи снимаются при любом
+    обращении к словарю (колесо продвигается только на прошедшие такты)
+    и передаются в on_expire(key, value), например, чтобы сохранить
+    брошенный черновик. Память ограничена активными за ttl ключами.
+    """
+
+    def __init__(self, ttl: float, on_expire: Optional[Callable[[Hashable, Any], None]] = None,
+                 tick: Optional[float] = None, slots: int = 512, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.on_expire = on_expire
+        # По умолчанию оборот колеса примерно равен ttl
+        self._wheel = TimingWheel(tick or max(ttl / slots, 0.05), slots, clock)
+        self._data: Dict[Hashable, Any] = {}
+
+    def expire(self) -> int:
+        """Снять истекшие записи; возвращает их число"""
+        expired = self._wheel.advance()
+        for key in expired:
+            value = self._data.pop(key)
+            if self.on_expire is not None:
+                try:
+                    self.on_expire(key, value)
+                except Exception as e:
+                    print(f"Ошибка обработки истекшей записи {key}: {e}")
+        return len(expired)
+
+    def touch(self, key: Hashable) -> None:
+        """Продлить срок записи"""
+        if key in self._data:
+            self._wheel.schedule(key, self.ttl)
+
+    def __getitem__(self, key: Hashable) -> Any:
+        self.expire()
+        value = self._data[key]
+        self._wheel.schedule(key, self.ttl)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self.expire()
+        self._data[key] = value
+        self._wheel.schedule(key, self.ttl)
+
+    def __delitem__(self, key: Hashable) -> None:
+        self.expire()
+        del self._data[key]
+        self._wheel.cancel(key)
+
+    def __contains__(self, key: object) -> bool:
+        self.expire()
+        return key in self._data
+
+    def __iter__(self) -> Iterator[Hashable]:
+        self.expire()
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        self.expire()
+        return len(self._data)
+
+
+class GenerationDict(MutableMapping):
+    """Словарь для коротких окон (защита от спама): без таймера на каждую запись.
+
+    Записи живут в двух поколениях; раз в window секунд текущее поколение
+    становится прошлым, а прошлое удаляется целиком. Обращение переносит
+    запись в текущее поколение, поэтому запись живет от window до
+    2 * window секунд после последнего обращения.
+    """
+
+    def __init__(self, window: float, clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.clock = clock
+        self._current: Dict[Hashable, Any] = {}
+        self._previous: Dict[Hashable, Any] = {}
+        self._rotated = clock()
+
+    def _rotate(self) -> None:
+        now = self.clock()
+        if now - self._rotated >= self.window:
+            self._previous = self._current if now - self._rotated < 2 * self.window else {}
+            self._current = {}
+            self._rotated = now
+
+    def __getitem__(self, key: Hashable) -> Any:
+        self._rotate()
+        try:
+            return self._current[key]
+        except KeyError:
+            value = self._current[key] = self._previous.pop(key)
+            return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self._rotate()
+        self._current[key] = value
+        self._previous.pop(key, None)
+
+    def __delitem__(self, key: Hashable) -> None:
+        self._rotate()
+        found = self._current.pop(key, self) is not self
+        if self._previous.pop(key, self) is self and not found:
+            raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        self._rotate()
+        return key in self._current or key in self._previous
+
+    def __iter__(self) -> Iterator[Hashable]:
+        self._rotate()
+        return iter(list(self._current) + list(self._previous))
+
+    def __len__(self) -> int:
+        self._rotate()
+        return len(self._current) + len(self._previous)
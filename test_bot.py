@@ -3,6 +3,7 @@
 """
 import os
 import sys
+import time
 import asyncio
 import pytest
 from unittest.mock import Mock, AsyncMock
@@ -13,9 +14,25 @@ sys.path.append('.')
 
 from bot.main_refactored import BotApplication
 from bot.utils.activity_logger import ActivityLogger
+from bot.utils.activity_archive import ActivityArchive
+from bot.utils.activity_binary import BinaryActivityReader, binary_to_csv, csv_to_binary
 from bot.utils.state_manager import StateManager
 from bot.utils.file_manager import FileManager
 from bot.utils.keyboard_factory import KeyboardFactory
+from bot.utils.incident_log import IncidentLog
+from bot.utils.incident_store import SQLiteIncidentStore
+from bot.utils.incident_writer import GroupCommitWriter
+from bot.utils.incident_archive import PartitionedIncidentArchive
+from bot.services.incident_query_service import IncidentQueryService
+from bot.handlers.admin_incidents_handler import AdminIncidentsHandler
+from bot.services.danger_report_service import DangerReportService
+from bot.utils.incident_dedup import IncidentDeduplicator
+from bot.models.user_state import DangerReportData
+from bot.utils.media_album import send_report_with_media, split_media
+from bot.utils.outbox import Outbox, OutboxDispatcher
+from bot.utils.admin_routing import AdminRouter
+from bot.utils.admin_digest import ADMIN_DIGEST, AdminDigest
+from bot.utils.rate_limiter import PRIORITY_HIGH, PRIORITY_LOW, PriorityRateLimiter, priority_lane
 
 
 class MockUpdate:
@@ -62,6 +79,40 @@ class MockContext:
         self.bot_data = {'admin_chat_id': 'ADMIN_ID_PLACEHOLDER'}
 
 
+@pytest.fixture(autouse=True)
+def isolated_app_files(tmp_path, monkeypatch):
+    """Лог активности, инциденты и outbox BotApplication - во временном каталоге, а не в logs/ проекта"""
+    import bot.main_refactored as main_refactored
+    import bot.services.danger_report_service as danger_report_service
+    app_dir = tmp_path / 'app_logs'
+    app_dir.mkdir()
+    monkeypatch.setattr(main_refactored, 'ActivityLogger',
+                        lambda: ActivityLogger(str(app_dir / 'activity.csv')))
+    monkeypatch.setattr(danger_report_service, 'create_incident_store',
+                        lambda: SQLiteIncidentStore(str(app_dir / 'incidents.db'), import_log=None))
+    monkeypatch.setattr(danger_report_service, 'Outbox', lambda: Outbox(str(app_dir / 'outbox.db')))
+    return app_dir
+
+
+@pytest.fixture
+def main_module(tmp_path, monkeypatch):
+    """bot.main, импортированный заново: его файлы - во временном каталоге"""
+    import importlib
+    import bot.utils.incident_store as incident_store_module
+    import bot.utils.outbox as outbox_module
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(incident_store_module, 'create_incident_store',
+                        lambda: SQLiteIncidentStore(str(tmp_path / 'incidents.db'), import_log=None))
+    monkeypatch.setattr(outbox_module, 'Outbox', lambda: Outbox(str(tmp_path / 'outbox.db')))
+    sys.modules.pop('bot.main', None)
+    main = importlib.import_module('bot.main')
+    yield main
+    main.activity_logger.close()
+    main.incident_store.close()
+    main.outbox.close()
+    sys.modules.pop('bot.main', None)
+
+
 @pytest.mark.asyncio
 async def test_start_command():
     """Тест команды /start"""
@@ -232,6 +283,7 @@ async def test_utilities():
     # Тест ActivityLogger
     logger = ActivityLogger('logs/test_activity.csv')
     logger.log_activity(12345, "test_user", "test_action", "test_payload")
+    logger.close()
     print("✅ ActivityLogger работает")
     
     # Тест StateManager
@@ -261,6 +313,1565 @@ async def test_utilities():
         os.remove('logs/test.json')
     if os.path.exists('logs/test_activity.csv'):
         os.remove('logs/test_activity.csv')
+    if os.path.isdir('logs/test_activity'):
+        import shutil
+        shutil.rmtree('logs/test_activity')
+
+
+@pytest.mark.asyncio
+async def test_event_loop_lag_with_slow_disk(monkeypatch):
+    """Тест отзывчивости цикла событий при медленном диске"""
+    print("🧪 Тестируем отзывчивость цикла событий при медленном диске...")
+    
+    # Имитируем медленный диск: каждая запись в лог занимает 200 мс
+    original_write_rows = ActivityLogger._write_rows
+    def slow_write_rows(self, *args):
+        time.sleep(0.2)
+        original_write_rows(self, *args)
+    monkeypatch.setattr(ActivityLogger, '_write_rows', slow_write_rows)
+    # И чтение справочников (убежища, документы) тоже
+    original_load_json = FileManager.load_json
+    def slow_load_json(self, *args):
+        time.sleep(0.2)
+        return original_load_json(self, *args)
+    monkeypatch.setattr(FileManager, 'load_json', slow_load_json)
+    
+    app = BotApplication()
+    context = MockContext()
+    
+    max_lag = 0.0
+    done = asyncio.Event()
+    
+    async def ticker():
+        nonlocal max_lag
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - started - 0.01)
+    
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.gather(*[
+        app.handle_message(MockUpdate(user_id=1000 + i, text="🏠🛡️ Ближайшее укрытие"), context)
+        for i in range(4)
+    ])
+    shelters, documents, template = await asyncio.gather(
+        app.shelter_service.get_shelters(),
+        app.consultant_service.get_documents(),
+        app.consultant_service.get_answer_template("Где огнетушитель?")
+    )
+    done.set()
+    await ticker_task
+    assert shelters and documents and template['answer']
+    
+    # Четыре записи и три чтения по 200 мс не должны останавливать цикл событий
+    assert max_lag < 0.1
+    print(f"✅ Максимальная задержка цикла событий: {max_lag * 1000:.1f} мс")
+
+
+def test_incident_log(tmp_path):
+    """Тест журнала инцидентов JSON Lines"""
+    print("🧪 Тестируем журнал инцидентов...")
+    
+    legacy_file = tmp_path / 'incidents.json'
+    log_file = tmp_path / 'incidents.jsonl'
+    legacy_file.write_text('[{"user_id": 1, "description": "старый"}]', encoding='utf-8')
+    
+    # Миграция старого JSON-массива
+    incident_log = IncidentLog(str(log_file), legacy_file=str(legacy_file))
+    assert not legacy_file.exists()
+    incident_log.append({'user_id': 2, 'description': 'новый'})
+    incident_log.close()
+    print("✅ Миграция и дозапись работают")
+    
+    # Имитируем сбой посреди записи
+    with open(log_file, 'ab') as f:
+        f.write(b'{"user_id": 3, "descr')
+    
+    incident_log = IncidentLog(str(log_file), legacy_file=str(legacy_file))
+    incidents = list(incident_log.iter_incidents())
+    assert [incident['user_id'] for incident in incidents] == [1, 2]
+    assert log_file.read_bytes().endswith(b'\n')
+    print("✅ Восстановление после неполной записи работает")
+
+
+def test_sqlite_incident_store(tmp_path):
+    """Тест хранилища инцидентов SQLite"""
+    print("🧪 Тестируем хранилище инцидентов SQLite...")
+    
+    store = SQLiteIncidentStore(str(tmp_path / 'incidents.db'), import_log=None)
+    mode = store._connection().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == 'wal'
+    
+    # Пишем из нескольких потоков - у каждого свое соединение
+    import threading
+    def writer(thread_no):
+        for i in range(25):
+            store.append({
+                'incident_id': f"{thread_no}-{i}",
+                'timestamp': f"2026-10-{10 + thread_no:02d}T12:00:{i:02d}",
+                'user_id': thread_no,
+                'username': 'test_user',
+                'description': 'Описание',
+                'location': 'Корпус 1',
+                'media_files': [{'file_id': 'x', 'file_type': 'photo'}]
+            })
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert len(store.query_by_user(2)) == 25
+    assert store.query_by_user(2, limit=1)[0]['incident_id'] == '2-24'
+    in_range = store.query_by_time(datetime(2026, 10, 11), datetime(2026, 10, 13))
+    assert {incident['user_id'] for incident in in_range} == {1, 2}
+    assert store.get('3-0')['media_files'][0]['file_type'] == 'photo'
+    store.close()
+    print("✅ Хранилище инцидентов SQLite работает")
+
+
+@pytest.mark.asyncio
+async def test_group_commit_writer(tmp_path):
+    """Тест групповой записи инцидентов"""
+    print("🧪 Тестируем групповую запись инцидентов...")
+    
+    store = SQLiteIncidentStore(str(tmp_path / 'incidents.db'), import_log=None)
+    commits = []
+    original_append_many = store.append_many
+    def counting_append_many(incidents):
+        incidents = list(incidents)
+        commits.append(len(incidents))
+        original_append_many(incidents)
+    store.append_many = counting_append_many
+    
+    # Инцидент из журнала, не дошедший до хранилища до сбоя
+    journal_file = tmp_path / 'incidents.journal'
+    journal_file.write_text('{"incident_id": "lost", "user_id": 1, "timestamp": "2026-10-01T10:00:00"}\n',
+                            encoding='utf-8')
+    # Журнал завершившегося процесса-соседа (его блокировка не удерживается)
+    (tmp_path / 'incidents.journal.424242').write_text(
+        '{"incident_id": "orphan", "user_id": 2, "timestamp": "2026-10-01T10:00:01"}\n', encoding='utf-8'
+    )
+    
+    writer = GroupCommitWriter(store, str(journal_file), flush_interval_ms=50, max_batch=100)
+    assert await writer.start() == 2
+    assert store.get('lost') is not None and store.get('orphan') is not None
+    
+    futures = await asyncio.gather(*[
+        writer.submit({'incident_id': f"id-{i}", 'user_id': i, 'timestamp': datetime.now().isoformat()})
+        for i in range(50)
+    ])
+    await asyncio.gather(*futures)
+    await writer.close()
+    
+    assert len(store.query_by_time(datetime(2000, 1, 1), datetime(2100, 1, 1), limit=1000)) == 52
+    # 50 инцидентов зафиксированы несколькими пачками, а не 50 отдельными записями
+    assert sum(commits[2:]) == 50 and len(commits) - 2 <= 5
+    # Журналы проиграны и удалены, журнал процесса удален при штатной остановке
+    assert not list(tmp_path.glob('incidents.journal*'))
+    store.close()
+    print(f"✅ Групповая запись работает: пачки {commits[2:]}")
+
+
+@pytest.mark.asyncio
+async def test_group_commit_retry(tmp_path, monkeypatch):
+    """Тест повтора неудавшейся групповой записи и остановки упавшей записи"""
+    print("🧪 Тестируем повтор групповой записи...")
+
+    import bot.utils.incident_writer as incident_writer_module
+    monkeypatch.setattr(incident_writer_module, 'RETRY_DELAY', 0.01)
+
+    store = SQLiteIncidentStore(str(tmp_path / 'incidents.db'), import_log=None)
+    original_append_many = store.append_many
+    failures = [1]
+    def flaky_append_many(incidents):
+        if failures[0]:
+            failures[0] -= 1
+            raise OSError("диск недоступен")
+        original_append_many(incidents)
+    store.append_many = flaky_append_many
+
+    journal_file = tmp_path / 'incidents.journal'
+    writer = GroupCommitWriter(store, str(journal_file), flush_interval_ms=10, max_batch=10)
+    await writer.start()
+    durable = await writer.submit({'incident_id': 'retry', 'user_id': 1, 'timestamp': '2026-10-01T10:00:00'})
+    with pytest.raises(OSError):
+        await durable
+    # Пачка повторена фоновой задачей, журнал очищен
+    for _ in range(100):
+        if writer._pending == 0:
+            break
+        await asyncio.sleep(0.01)
+    assert store.get('retry') is not None and writer._pending == 0
+    assert os.path.getsize(writer.journal.log_file) == 0
+    await writer.close()
+
+    # Фоновая задача упала - остановка не зависает, записи остаются в журнале
+    writer = GroupCommitWriter(store, str(journal_file), flush_interval_ms=10, max_batch=10)
+    await writer.start()
+    async def broken_flush(batch):
+        raise RuntimeError("сбой")
+    writer._flush = broken_flush
+    await writer.submit({'incident_id': 'late', 'user_id': 2, 'timestamp': '2026-10-01T10:00:01'})
+    await asyncio.wait_for(writer.close(), 1)
+    assert store.get('late') is None and list(tmp_path.glob('incidents.journal.*'))
+
+    writer = GroupCommitWriter(store, str(journal_file), flush_interval_ms=10, max_batch=10)
+    assert await writer.start() == 1 and store.get('late') is not None
+    await writer.close()
+    store.close()
+    print("✅ Повтор групповой записи работает")
+
+
+@pytest.mark.asyncio
+async def test_durable_ack_failure(main_module, monkeypatch):
+    """Тест ответа пользователю, если инцидент не удалось зафиксировать"""
+    print("🧪 Тестируем ответ при сбое фиксации инцидента...")
+
+    from bot.handlers.danger_report_handler import DangerReportHandler, SAVE_FAILED_TEXT
+
+    def failed_commit():
+        durable = asyncio.get_running_loop().create_future()
+        durable.set_exception(OSError("диск недоступен"))
+        return durable
+
+    # Обработчик BotApplication: админ уведомлен, но "отправлено" пользователь не видит
+    danger_service = Mock(save_incident=AsyncMock(return_value=failed_commit()), send_to_admin=AsyncMock())
+    danger_service.incident_writer.durable_ack = True
+    handler = DangerReportHandler(Mock(), StateManager(), KeyboardFactory(), danger_service)
+    update = MockUpdate()
+    await handler._send_incident(update, MockContext(), {'description': 'Дым', 'location': 'Корпус 1'})
+    assert danger_service.send_to_admin.called
+    assert update.message.reply_text.call_args.args[0] == SAVE_FAILED_TEXT
+
+    # То же в bot.main
+    monkeypatch.setattr(main_module, 'incident_writer',
+                        Mock(durable_ack=True, submit=AsyncMock(return_value=failed_commit())))
+    send_to_admin = AsyncMock()
+    monkeypatch.setattr(main_module, 'send_to_admin', send_to_admin)
+    update = MockUpdate()
+    main_module.user_states[update.effective_user.id] = {
+        'state': 'danger_confirm', 'data': {'description': 'Дым', 'location': 'Корпус 1'}
+    }
+    await main_module.handle_danger_confirm(update, MockContext())
+    assert send_to_admin.called
+    assert update.message.reply_text.call_args.args[0] == SAVE_FAILED_TEXT
+    print("✅ При сбое фиксации пользователь получает предупреждение")
+
+
+def test_partitioned_incident_archive(tmp_path):
+    """Тест месячного архива инцидентов"""
+    print("🧪 Тестируем месячный архив инцидентов...")
+    
+    archive_dir = tmp_path / 'incidents'
+    archive = PartitionedIncidentArchive(str(archive_dir), index_every=8, import_log=None)
+    for month in (8, 9, 10):
+        archive.append_many([
+            {'incident_id': f"{month}-{day}", 'user_id': day % 3,
+             'timestamp': f"2026-{month:02d}-{day:02d}T12:00:00", 'description': 'Описание'}
+            for day in range(1, 29)
+        ])
+    archive.close()
+    
+    # Закрытые месяцы сжаты, текущий - открыт
+    assert sorted(os.listdir(archive_dir)) == ['2026-08.jsonl.gz', '2026-09.jsonl.gz', '2026-10.jsonl']
+    
+    archive = PartitionedIncidentArchive(str(archive_dir), index_every=8, import_log=None)
+    assert archive._footer('2026-09')['stats']['count'] == 28
+    
+    in_range = archive.query_by_time(datetime(2026, 9, 20), datetime(2026, 10, 3))
+    assert [incident['incident_id'] for incident in in_range] == \
+        [f"9-{day}" for day in range(20, 29)] + ['10-1', '10-2']
+    assert archive.get('8-5')['timestamp'] == '2026-08-05T12:00:00'
+    # Последние инциденты пользователя читаются с конца архива до limit найденных
+    expected = [f"{month}-{day}" for month in (10, 9, 8) for day in range(28, 0, -1) if day % 3 == 1]
+    assert [incident['incident_id'] for incident in archive.query_by_user(1, limit=12)] == expected[:12]
+    assert [incident['incident_id'] for incident in archive.query_by_user(1)] == expected
+    archive.close()
+    
+    # Открытый сегмент читается с конца блоками; недописанная строка пропускается
+    from bot.utils.incident_log import iter_jsonl_entries, iter_jsonl_reversed
+    segment = archive_dir / '2026-10.jsonl'
+    forward = [incident for _, incident in iter_jsonl_entries(str(segment))]
+    torn = tmp_path / 'torn.jsonl'
+    torn.write_bytes(segment.read_bytes() + b'{"incident_id": "torn"')
+    for block_size in (1, 10, 64 * 1024):
+        assert list(iter_jsonl_reversed(str(segment), block_size)) == forward[::-1]
+        assert list(iter_jsonl_reversed(str(torn), block_size)) == forward[::-1]
+    print("✅ Месячный архив инцидентов работает")
+
+
+@pytest.mark.asyncio
+async def test_admin_incident_queries(tmp_path, monkeypatch):
+    """Тест админ-выборок инцидентов по индексу"""
+    print("🧪 Тестируем админ-выборки инцидентов...")
+    
+    # База старой схемы без колонки корпуса мигрирует при открытии
+    import sqlite3
+    db_file = tmp_path / 'incidents.db'
+    conn = sqlite3.connect(db_file)
+    conn.execute("CREATE TABLE incidents (id INTEGER PRIMARY KEY AUTOINCREMENT, incident_id TEXT UNIQUE, "
+                 "timestamp TEXT NOT NULL, user_id INTEGER NOT NULL, username TEXT, "
+                 "description TEXT NOT NULL DEFAULT '', location TEXT NOT NULL DEFAULT '', "
+                 "media_files TEXT NOT NULL DEFAULT '[]')")
+    conn.execute("INSERT INTO incidents (incident_id, timestamp, user_id, location) "
+                 "VALUES ('old', '2026-01-01T10:00:00', 1, 'корп. 7, склад')")
+    conn.commit()
+    conn.close()
+    
+    store = SQLiteIncidentStore(str(db_file), import_log=None)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    store.append_many({
+        'incident_id': f"id-{i}", 'user_id': i % 4, 'username': 'test_user',
+        'timestamp': today.replace(minute=i % 60, second=i // 60).isoformat(),
+        'description': f"Описание {i}", 'location': f"Корпус {i % 3}, этаж 2"
+    } for i in range(23))
+    
+    service = IncidentQueryService(store, page_size=5)
+    assert [i['incident_id'] for i in service.get_page('near', service.normalize_arg('near', 'корпус 7'))[0]] == ['old']
+    
+    # Листаем выборку пользователя вперед до конца и обратно
+    pages = []
+    incidents, has_prev, has_next = service.get_page('user', '1')
+    assert not has_prev
+    while True:
+        pages.append([incident['incident_id'] for incident in incidents])
+        if not has_next:
+            break
+        incidents, has_prev, has_next = service.get_page('user', '1', before_id=incidents[-1]['id'])
+    assert sum(pages, []) == ['id-21', 'id-17', 'id-13', 'id-9', 'id-5', 'id-1', 'old']
+    incidents, has_prev, has_next = service.get_page('user', '1', after_id=incidents[0]['id'])
+    assert [incident['incident_id'] for incident in incidents] == pages[0] and not has_prev
+    
+    today_arg = service.normalize_arg('today', '')
+    assert len(service.get_page('today', today_arg)[0]) == 5
+    # Запоздавшая запись прошлого дня (повтор из журнала) выбирается по времени, а не по id
+    from datetime import timedelta
+    yesterday = today - timedelta(days=1)
+    store.append({'incident_id': 'replayed', 'user_id': 9, 'timestamp': yesterday.replace(hour=23).isoformat(),
+                  'description': 'Повтор', 'location': 'Корпус 1'})
+    assert 'replayed' not in [i['incident_id'] for i in service.get_page('today', today_arg)[0]]
+    assert [i['incident_id'] for i in service.get_page('today', yesterday.strftime('%Y%m%d'))[0]] == ['replayed']
+    # Значения фильтров - параметры запроса, а не часть SQL
+    assert store.page(building="1' OR '1'='1") == []
+    assert service.get_incident('#1')['incident_id'] == 'old'
+    
+    # Не-админ получает отказ, админ - страницу с кнопками
+    handler = AdminIncidentsHandler(ActivityLogger(str(tmp_path / 'activity.csv')), StateManager(), KeyboardFactory(), service)
+    monkeypatch.setenv('ADMIN_USER_IDS', '42')
+    context = MockContext()
+    context.args = ['user', '1']
+    update = MockUpdate(user_id=7, text="/incidents user 1")
+    update.callback_query = update.effective_chat = None
+    await handler.handle(update, context)
+    assert 'администраторам' in update.message.reply_text.call_args[0][0]
+    
+    update = MockUpdate(user_id=42, text="/incidents user 1")
+    update.callback_query = update.effective_chat = None
+    await handler.handle(update, context)
+    markup = update.message.reply_text.call_args[1]['reply_markup']
+    callback_data = markup.inline_keyboard[0][0].callback_data
+    assert callback_data.startswith('inc|user|1|n') and len(callback_data.encode()) <= 64
+    store.close()
+    print("✅ Админ-выборки инцидентов работают")
+
+
+@pytest.mark.asyncio
+async def test_main_admin_incident_commands(main_module, monkeypatch):
+    """Тест админ-команд /incidents и /incident, зарегистрированных в bot.main"""
+    print("🧪 Тестируем админ-команды bot.main...")
+
+    from telegram.ext import CallbackQueryHandler, CommandHandler
+
+    # main() регистрирует обработчики в приложении; запуск опроса не нужен
+    application = Mock()
+    builder = Mock()
+    for method in ('token', 'post_init', 'post_shutdown', 'rate_limiter'):
+        getattr(builder, method).return_value = builder
+    builder.build.return_value = application
+    monkeypatch.setattr(main_module, 'Application', Mock(builder=Mock(return_value=builder)))
+    monkeypatch.setenv('BOT_TOKEN', 'test-token')
+    main_module.main()
+    handlers = [call.args[0] for call in application.add_handler.call_args_list]
+    commands = {command: handler.callback for handler in handlers if isinstance(handler, CommandHandler)
+                for command in handler.commands}
+    buttons = [handler for handler in handlers if isinstance(handler, CallbackQueryHandler)
+               and handler.pattern.match('inc|user|5|n1')]
+    assert application.run_polling.called and len(buttons) == 1
+
+    main_module.incident_store.append_many({
+        'incident_id': f"main-{i}", 'user_id': 5, 'username': 'reporter',
+        'timestamp': f"2026-10-01T10:{i:02d}:00", 'description': f"Дым {i}", 'location': "Корпус 2"
+    } for i in range(7))
+    monkeypatch.setenv('ADMIN_USER_IDS', '42')
+
+    async def run(command, args, user_id=42):
+        update = MockUpdate(user_id=user_id, text=f"/{command} {' '.join(args)}")
+        update.callback_query = update.effective_chat = None
+        context = MockContext()
+        context.args = args
+        await commands[command](update, context)
+        return update.message.reply_text.call_args
+
+    refused = await run('incidents', ['user', '5'], user_id=7)
+    assert 'администраторам' in refused.args[0]
+    page = await run('incidents', ['user', '5'])
+    assert page.args[0].startswith("📋 Инциденты пользователя 5") and "#7 " in page.args[0]
+    assert page.kwargs['reply_markup'].inline_keyboard[0][0].callback_data.startswith('inc|user|5|n')
+    card = await run('incident', ['#3'])
+    assert "Инцидент #3" in card.args[0] and "main-2" in card.args[0]
+    print("✅ Админ-команды bot.main работают")
+
+
+@pytest.mark.asyncio
+async def test_incident_dedup_admin_fanout(tmp_path):
+    """Тест группировки похожих сообщений для админ-чата"""
+    print("🧪 Тестируем группировку похожих сообщений...")
+    
+    store = SQLiteIncidentStore(str(tmp_path / 'incidents.db'), import_log=None)
+    service = DangerReportService(FileManager(), ActivityLogger(str(tmp_path / 'activity.csv')), incident_store=store,
+                                  deduplicator=IncidentDeduplicator(window_sec=120),
+                                  outbox=Outbox(str(tmp_path / 'outbox.db')))
+    service.cluster_cards.edit_interval = 1.0
+    context = MockContext()
+    context.bot_data['admin_chat_id'] = '-100'
+    context.bot.edit_message_caption = AsyncMock()
+    await service.dispatcher.start(context.bot)
+    
+    variants = ["Пожар в корпусе 3, сильный дым", "пожар корпус 3 дым", "В корпусе 3 пожар!!!",
+                "Горит корпус 3, много дыма"]
+    start = time.perf_counter()
+    for i in range(50):
+        update = MockUpdate(user_id=1000 + i, username=f"user{i}")
+        data = DangerReportData(variants[i % len(variants)], "Корпус 3",
+                                [{'file_id': f"f{i}", 'file_type': 'photo'}])
+        await service.send_to_admin(update, context, data)
+    elapsed = time.perf_counter() - start
+    # Другое событие - отдельная карточка
+    await service.send_to_admin(MockUpdate(), context, DangerReportData("Разлив кислоты на складе", "Склад 2"))
+    while service.outbox.pending_count():
+        await asyncio.sleep(0.01)
+    await service.flush_admin_updates()
+    await service.dispatcher.close()
+    
+    api_calls = (context.bot.send_message.call_count + context.bot.send_photo.call_count +
+                 context.bot.edit_message_caption.call_count)
+    # Первое сообщение - фото с текстом в подписи, второе событие без медиа - текстом
+    assert context.bot.send_photo.call_count == 1
+    assert context.bot.send_message.call_count == 1
+    assert 1 <= context.bot.edit_message_caption.call_count <= 3
+    assert api_calls * 10 <= 100  # без группировки: 50 сообщений + 50 фото
+    caption = context.bot.edit_message_caption.call_args[1]['caption']
+    assert "Похожих сообщений:** 49" in caption and len(caption) <= 1024
+    store.close()
+    print(f"✅ Группировка работает: {api_calls} вызовов API вместо 101, {elapsed / 50 * 1000:.2f} мс на обработку сообщения")
+
+
+def test_cluster_card_caption_limit():
+    """Тест подписи карточки события: строки отбрасываются целиком"""
+    print("🧪 Тестируем подпись карточки события...")
+
+    from bot.utils.cluster_cards import format_cluster_text
+    from bot.utils.paginator import utf16_len
+
+    deduplicator = IncidentDeduplicator(window_sec=120)
+    for i in range(5):
+        cluster, _ = deduplicator.add({
+            'timestamp': datetime.now().isoformat(), 'user_id': i, 'username': f"user{i}",
+            'description': "🔥 Пожар в корпусе 3, дым 🔥 " * 4, 'location': "Корпус 3 🏭"
+        })
+    report_text = "🚨 **НОВОЕ СООБЩЕНИЕ ОБ ОПАСНОСТИ**\n\n" + "📝 **Описание:** " + "🔥" * 150 + "\n\n"
+    full = format_cluster_text(cluster, report_text)
+    for limit in (utf16_len(full), 700, 560, utf16_len(report_text)):
+        caption = format_cluster_text(cluster, report_text, limit)
+        assert utf16_len(caption) <= limit and caption.endswith("\n")
+        assert caption.count("**") % 2 == 0 and full.startswith(caption.split("\n**Последние")[0])
+    assert format_cluster_text(cluster, report_text, utf16_len(report_text)) == report_text
+    print("✅ Подпись карточки события укладывается в лимит целыми строками")
+
+
+def _append_from_process(log_file, json_file, worker_no, count):
+    """Писатель для теста нескольких процессов (выполняется в дочернем процессе)"""
+    incident_log = IncidentLog(log_file, fsync_policy='never', legacy_file=None)
+    file_manager = FileManager()
+    for i in range(count):
+        incident = {'incident_id': f"{worker_no}-{i}", 'user_id': worker_no,
+                    'description': 'Описание ' * (i % 50)}
+        incident_log.append(incident)
+        if i % 10 == 0:
+            file_manager.append_json_array(json_file, incident)
+    incident_log.close()
+
+
+def test_multiprocess_incident_appends(tmp_path):
+    """Тест одновременной записи инцидентов из нескольких процессов"""
+    print("🧪 Тестируем запись инцидентов из нескольких процессов...")
+    
+    import multiprocessing
+    log_file = str(tmp_path / 'incidents.jsonl')
+    json_file = str(tmp_path / 'incidents.json')
+    workers, count = 4, 300
+    
+    context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    processes = [
+        context.Process(target=_append_from_process, args=(log_file, json_file, n, count))
+        for n in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    
+    # Ни одна запись не потеряна и не перемешана с чужой
+    ids = [incident['incident_id'] for incident in IncidentLog(log_file, legacy_file=None).iter_incidents()]
+    assert len(ids) == workers * count
+    assert set(ids) == {f"{n}-{i}" for n in range(workers) for i in range(count)}
+    json_ids = {incident['incident_id'] for incident in FileManager().load_json(json_file)}
+    assert json_ids == {f"{n}-{i}" for n in range(workers) for i in range(0, count, 10)}
+    print(f"✅ {workers} процесса записали {len(ids)} инцидентов без потерь")
+
+
+@pytest.mark.asyncio
+async def test_media_album_delivery():
+    """Тест отправки медиафайлов админу альбомами"""
+    print("🧪 Тестируем отправку медиа альбомами...")
+    
+    photos = [{'file_id': f"photo{i}", 'file_type': 'photo'} for i in range(8)]
+    bot = Mock()
+    bot.send_message = AsyncMock()
+    bot.send_photo = AsyncMock()
+    bot.send_media_group = AsyncMock(side_effect=lambda chat_id, media: [Mock(message_id=i) for i in range(len(media))])
+    
+    # Восемь фото - один альбом, текст в подписи первого
+    message, is_caption = await send_report_with_media(bot, '-100', "🚨 Сообщение", photos)
+    assert bot.send_media_group.call_count == 1 and bot.send_message.call_count == 0
+    assert bot.send_media_group.call_args[1]['media'][0].caption == "🚨 Сообщение"
+    assert is_caption and message.message_id == 0
+    
+    # Больше 10 файлов - альбомы поровну, без альбома из одного файла
+    assert [len(chunk) for chunk in split_media(photos * 2 + photos[:5])] == [7, 7, 7]
+    assert [len(chunk) for chunk in split_media(photos + photos[:3])] == [6, 5]
+    
+    # Длинный текст не помещается в подпись - отдельное сообщение + альбом
+    bot.send_media_group.reset_mock()
+    await send_report_with_media(bot, '-100', "x" * 2000, photos)
+    assert bot.send_message.call_count == 1 and bot.send_media_group.call_count == 1
+    
+    # Альбом отклонен - файлы отправляются по одному, испорченный пропускается
+    bot.send_media_group = AsyncMock(side_effect=Exception("Bad Request: wrong file identifier"))
+    bot.send_photo = AsyncMock(side_effect=[Exception("wrong file identifier")] + [Mock()] * 7)
+    message, is_caption = await send_report_with_media(bot, '-100', "🚨 Сообщение", photos)
+    assert bot.send_photo.call_count == 8
+    assert bot.send_photo.call_args_list[1][1]['caption'] == "🚨 Сообщение"
+    assert bot.send_photo.call_args_list[2][1]['caption'] is None
+    print("✅ Медиа уходят альбомами")
+
+
+@pytest.mark.asyncio
+async def test_admin_outbox(tmp_path):
+    """Тест персистентной очереди уведомлений админу"""
+    print("🧪 Тестируем outbox уведомлений...")
+    
+    from telegram.error import RetryAfter
+    outbox_file = str(tmp_path / 'outbox.db')
+    
+    # Запись, не доставленная до перезапуска, остается в outbox
+    Outbox(outbox_file).enqueue('admin_report', '-100', {'text': 'до перезапуска'})
+    outbox = Outbox(outbox_file)
+    
+    delivered = []
+    failures = {'network': 1, '429': 1}
+    async def deliver(bot, entry):
+        text = entry['payload']['text']
+        if text == 'сбой сети' and failures['network']:
+            failures['network'] -= 1
+            raise ConnectionError("сеть недоступна")
+        if text == 'лимит' and failures['429']:
+            failures['429'] -= 1
+            raise RetryAfter(1)
+        delivered.append(text)
+    
+    dispatcher = OutboxDispatcher(outbox, {'admin_report': deliver}, base_delay=0.05, max_delay=1)
+    assert await dispatcher.start(Mock()) == 1
+    for text in ('сбой сети', 'лимит', 'обычное'):
+        outbox.enqueue('admin_report', '-100', {'text': text})
+        dispatcher.wake()
+    
+    deadline = time.monotonic() + 5
+    while outbox.pending_count() and time.monotonic() < deadline:
+        await asyncio.sleep(0.02)
+    await dispatcher.close()
+    
+    assert sorted(delivered) == sorted(['до перезапуска', 'сбой сети', 'лимит', 'обычное'])
+    # После 429 запись ждала retry_after, после сбоя сети - короткий backoff
+    assert delivered[-1] == 'лимит'
+    outbox.close()
+    
+    # Пользователь не ждет доставки в медленный админ-чат
+    store = SQLiteIncidentStore(str(tmp_path / 'incidents.db'), import_log=None)
+    service = DangerReportService(FileManager(), ActivityLogger(str(tmp_path / 'activity.csv')), incident_store=store,
+                                  outbox=Outbox(str(tmp_path / 'outbox2.db')))
+    context = MockContext()
+    context.bot_data['admin_chat_id'] = '-100'
+    async def slow_send(**kwargs):
+        await asyncio.sleep(0.5)
+        return Mock(message_id=1)
+    context.bot.send_message = AsyncMock(side_effect=slow_send)
+    await service.dispatcher.start(context.bot)
+    
+    start = time.perf_counter()
+    await service.send_to_admin(MockUpdate(), context, DangerReportData("Описание", "Корпус 1"))
+    assert time.perf_counter() - start < 0.3
+    while service.outbox.pending_count():
+        await asyncio.sleep(0.02)
+    assert context.bot.send_message.call_count == 1
+    await service.dispatcher.close()
+    store.close()
+    print("✅ Outbox доставляет уведомления с повторами и после перезапуска")
+
+
+@pytest.mark.asyncio
+async def test_outbox_chat_lanes(tmp_path):
+    """Тест независимых полос доставки: медленный чат не задерживает остальные"""
+    print("🧪 Тестируем полосы доставки outbox...")
+
+    outbox = Outbox(str(tmp_path / 'outbox.db'))
+    delivered = []
+    async def deliver(bot, entry):
+        if entry['chat_id'] == '-slow':
+            await asyncio.sleep(1.0)  # альбом или долгая отправка
+        delivered.append((entry['chat_id'], time.perf_counter()))
+
+    dispatcher = OutboxDispatcher(outbox, {'admin_report': deliver}, base_delay=0.05)
+    await dispatcher.start(Mock())
+    start = time.perf_counter()
+    outbox.enqueue_many('admin_report', [('-slow', {}), ('-slow', {}), ('-fast', {})])
+    dispatcher.wake()
+    await asyncio.sleep(0.1)
+    # Запись, поставленная во время медленной отправки, тоже не ждет ее
+    outbox.enqueue('admin_report', '-other', {})
+    dispatcher.wake()
+    while outbox.pending_count() > 1:
+        await asyncio.sleep(0.02)
+    fast = {chat_id: sent_at - start for chat_id, sent_at in delivered if chat_id != '-slow'}
+    assert set(fast) == {'-fast', '-other'} and max(fast.values()) < 0.5
+    await dispatcher.close()
+    # Недоставленная запись медленного чата осталась в outbox
+    assert outbox.pending_count() == 1
+    outbox.close()
+    print(f"✅ Полосы доставки независимы: быстрые чаты за {max(fast.values()):.2f} с")
+
+
+@pytest.mark.asyncio
+async def test_thread_local_sqlite_close(tmp_path):
+    """Тест закрытия соединений SQLite, открытых потоками пула ввода-вывода"""
+    print("🧪 Тестируем закрытие соединений SQLite всех потоков...")
+
+    import sqlite3
+    from bot.utils.io_executor import run_io
+    outbox = Outbox(str(tmp_path / 'outbox.db'))
+    outbox.enqueue_many('admin_report', [('1', {'text': 'тест'})])
+    # Соединения рабочих потоков run_io (пул общий, потоки живут дальше)
+    connections = await asyncio.gather(*(run_io(outbox._connection) for _ in range(8)))
+    assert await run_io(outbox.pending_count) == 1
+    outbox.close()
+    for conn in set(connections):
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+    # После закрытия потоки открывают новые соединения
+    assert await run_io(outbox.pending_count) == 1
+    outbox.close()
+    print(f"✅ Закрыто соединений потоков пула: {len(set(connections))}")
+
+
+@pytest.mark.asyncio
+async def test_admin_routing_fanout(tmp_path):
+    """Тест рассылки сообщения по нескольким дежурным чатам"""
+    print("🧪 Тестируем маршрутизацию и параллельную рассылку...")
+    
+    router = AdminRouter({
+        'recipients': {'admin': {'chat_id': '-100'}, 'security': {'chat_id': '-200'},
+                       'labour_safety': {'chat_id': '-300'}, 'shift_supervisor': {'chat_id': '-400'},
+                       'nobody': {'chat_id': 'env:UNSET_TEST_CHAT_ID'}},
+        'categories': {'fire': {'title': 'Пожар', 'keywords': ['пожар', 'дым']},
+                       'injury': {'title': 'Травма', 'keywords': ['травм']}},
+        'rules': [{'categories': ['fire'], 'recipients': ['security', 'shift_supervisor', 'nobody']},
+                  {'categories': ['injury'], 'recipients': ['labour_safety', 'shift_supervisor']},
+                  {'buildings': ['1'], 'recipients': ['security']}],
+        'default': ['admin']
+    })
+    assert router.route({'description': 'Пожар и дым', 'location': 'Корпус 3'}) == \
+        [('security', '-200'), ('shift_supervisor', '-400')]
+    assert router.route({'description': 'Травма, пожар', 'location': 'Склад'}) == \
+        [('security', '-200'), ('shift_supervisor', '-400'), ('labour_safety', '-300')]
+    assert router.route({'description': 'Скользкий пол', 'location': 'корпус 1'}) == [('security', '-200')]
+    assert router.route({'description': 'Скользкий пол', 'location': 'Склад'}) == [('admin', '-100')]
+    assert AdminRouter().route({'description': 'x', 'location': 'y'}, fallback_chat_id='-1') == [('admin', '-1')]
+    assert AdminRouter().route({'description': 'x', 'location': 'y'}, fallback_chat_id='ADMIN_ID_PLACEHOLDER') == []
+    
+    store = SQLiteIncidentStore(str(tmp_path / 'incidents.db'), import_log=None)
+    service = DangerReportService(FileManager(), ActivityLogger(str(tmp_path / 'activity.csv')), incident_store=store,
+                                  deduplicator=IncidentDeduplicator(window_sec=120),
+                                  outbox=Outbox(str(tmp_path / 'outbox.db')), router=router)
+    service.cluster_cards.edit_interval = 0.1
+    context = MockContext()
+    context.bot_data['admin_chat_id'] = '-100'
+    sent, failed = [], set()
+    async def slow_send(chat_id, **kwargs):
+        await asyncio.sleep(0.3)
+        if chat_id == '-300' and chat_id not in failed:
+            # Первая попытка в один из чатов не проходит - остальные это не задерживает
+            failed.add(chat_id)
+            raise RuntimeError("Timed out")
+        sent.append((chat_id, time.perf_counter()))
+        return Mock(message_id=len(sent))
+    context.bot.send_message = AsyncMock(side_effect=slow_send)
+    service.dispatcher.base_delay = 0.05
+    await service.dispatcher.start(context.bot)
+    
+    start = time.perf_counter()
+    await service.send_to_admin(MockUpdate(), context, DangerReportData("Пожар, пострадал рабочий, травма", "Склад"))
+    await service.send_to_admin(MockUpdate(user_id=2), context, DangerReportData("Пожар, травма рабочего", "Склад"))
+    while service.outbox.pending_count():
+        await asyncio.sleep(0.02)
+    await service.flush_admin_updates()
+    await service.dispatcher.close()
+    
+    first_round = [chat_id for chat_id, sent_at in sent if sent_at - start < 0.5]
+    # Три получателя отправлены параллельно за время одной отправки, а не трех
+    assert sorted(first_round) == ['-200', '-400']
+    assert sorted(chat_id for chat_id, _ in sent) == ['-200', '-300', '-400']
+    # Похожее второе сообщение обновило карточку в каждом чате
+    edited = {call[1]['chat_id'] for call in context.bot.edit_message_text.call_args_list}
+    assert edited == {'-200', '-300', '-400'}
+    text = context.bot.send_message.call_args[1]['text']
+    assert "Пожар" in text and "Травма" in text
+    store.close()
+    print(f"✅ Рассылка в {len(edited)} чата заняла {sent[-1][1] - start:.2f} с, повтор - только для сбойного чата")
+
+
+@pytest.mark.asyncio
+async def test_priority_rate_limiter():
+    """Тест ограничения частоты запросов к Bot API с приоритетными полосами"""
+    print("🧪 Тестируем ограничитель частоты запросов...")
+    
+    from datetime import timedelta
+    from telegram.error import RetryAfter
+    
+    limiter = PriorityRateLimiter(overall_rate=100, chat_rate=1, burst=1)
+    await limiter.initialize()
+    sent = []
+    async def callback(endpoint, data):
+        sent.append((data['chat_id'], time.perf_counter()))
+        return True
+    
+    async def request(chat_id, priority=None):
+        start = time.perf_counter()
+        await limiter.process_request(callback, ('sendMessage', {'chat_id': chat_id}), {},
+                                      'sendMessage', {'chat_id': chat_id}, priority)
+        return time.perf_counter() - start
+    
+    # Всплеск: 150 ответов истории в разные чаты, через 0.1 с - подтверждения
+    with priority_lane(PRIORITY_LOW):
+        low = [asyncio.create_task(request(chat_id)) for chat_id in range(1, 151)]
+    await asyncio.sleep(0.1)
+    high = await asyncio.gather(*(request(chat_id, PRIORITY_HIGH) for chat_id in range(1001, 1006)))
+    low = await asyncio.gather(*low)
+    assert max(high) < 0.1        # высокая полоса не ждет хвост всплеска
+    assert max(low) > 0.4         # 150 запросов при 100/с - не меньше половины секунды
+    assert len(sent) == 155
+    await limiter.shutdown()
+    
+    # Ведро чата и группы, повтор после 429
+    limiter = PriorityRateLimiter(overall_rate=100, chat_rate=10, group_rate_per_minute=300, burst=1)
+    await limiter.initialize()
+    sent.clear()
+    await asyncio.gather(*(request(7) for _ in range(3)))
+    assert sent[2][1] - sent[0][1] >= 0.18
+    sent.clear()
+    await asyncio.gather(*(request(-100) for _ in range(2)))
+    assert sent[1][1] - sent[0][1] >= 0.18   # 300 в минуту для группы строже 10/с для чата
+    
+    attempts = []
+    async def flaky(endpoint, data):
+        attempts.append(time.perf_counter())
+        if len(attempts) == 1:
+            raise RetryAfter(timedelta(milliseconds=200))
+        return True
+    assert await limiter.process_request(flaky, ('sendMessage', {'chat_id': 8}), {},
+                                         'sendMessage', {'chat_id': 8}, None)
+    assert len(attempts) == 2 and attempts[1] - attempts[0] >= 0.19
+    await limiter.shutdown()
+    print(f"✅ Подтверждения при всплеске: до {max(high) * 1000:.0f} мс, хвост истории {max(low):.2f} с")
+
+
+@pytest.mark.asyncio
+async def test_admin_digest(tmp_path):
+    """Тест периодической сводки для админов"""
+    print("🧪 Тестируем сводку событий низкого приоритета...")
+    
+    router = AdminRouter({'recipients': {'admin': {'chat_id': '-100'}}, 'default': ['admin']})
+    outbox = Outbox(str(tmp_path / 'outbox.db'))
+    digest = AdminDigest(max_samples=3, max_users=2, spike_factor=3, spike_min=20,
+                         outbox=outbox, router=router)
+    assert digest.collect() is None  # пустой период - без сообщения
+    
+    base = 1_700_000_000 // 60 * 60
+    # Час спокойной активности (5 сообщений в минуту), затем всплеск 40 в минуту
+    for minute in range(60):
+        for i in range(5):
+            digest.record_message(i, now=base + minute * 60 + i)
+    for i in range(40):
+        digest.record_message(100 + i, now=base + 60 * 60 + i)
+    for i in range(5):
+        digest.record_unanswered(i, f"user{i}", f"Вопрос {i}", now=base)
+    for user in ["a", "b", "c", "a"]:
+        digest.record_spam_block(1, user)
+    
+    text = digest.collect(now=base + 61 * 60 + 1)
+    assert "Сообщений: 340 от 45 пользователей" in text
+    assert "40 сообщений/мин (обычно ~5)" in text
+    assert "Вопросы без ответа:** 5" in text and "Вопрос 4" in text and "Вопрос 1" not in text
+    assert "Блокировки спама:** 4" in text and "@a: 2" in text and "прочие: 1" in text
+    assert len(digest.unanswered) == 0 and digest.collect(now=base + 62 * 60) is None
+    
+    # Задача JobQueue ставит сводку в outbox, диспетчер доставляет ее в админ-чат
+    digest.record_spam_block(5, "spammer")
+    await digest.send_digest(MockContext())
+    entry = outbox.due()[0]
+    assert entry['kind'] == ADMIN_DIGEST and entry['chat_id'] == '-100'
+    dispatcher = OutboxDispatcher(outbox, {ADMIN_DIGEST: digest.deliver})
+    dispatcher.bot = bot = MockContext().bot
+    assert await dispatcher.deliver(entry)
+    assert "@spammer: 1" in bot.send_message.call_args[1]['text']
+    assert outbox.pending_count() == 0
+    
+    application = Mock()
+    assert digest.schedule(application, interval_min=30)
+    assert application.job_queue.run_repeating.call_args[1]['interval'] == 1800
+    outbox.close()
+    print("✅ Сводка собирается из счетчиков и уходит через outbox")
+
+
+def test_buffered_activity_logger(tmp_path, monkeypatch):
+    """Тест буферизованного лога активности"""
+    print("🧪 Тестируем буферизованный лог активности...")
+    
+    import csv
+    import threading
+    log_file = str(tmp_path / 'activity.csv')
+    def read_rows():
+        with open(log_file, encoding='utf-8') as f:
+            return list(csv.DictReader(f))
+    
+    # Сброс по интервалу: записи пачкой попадают в файл без close()
+    logger = ActivityLogger(log_file, flush_interval=0.1, layout='single')
+    writes = []
+    original_write_rows = ActivityLogger._write_rows
+    def counting_write_rows(self, rows):
+        writes.append(len(rows))
+        original_write_rows(self, rows)
+    monkeypatch.setattr(ActivityLogger, '_write_rows', counting_write_rows)
+    
+    start = time.perf_counter()
+    for i in range(10000):
+        logger.log_activity(i, f"user{i}", "text_message", "привет")
+    per_call = (time.perf_counter() - start) / 10000
+    time.sleep(0.5)
+    assert len(read_rows()) == 10000
+    assert len(writes) <= 40  # пачки, а не открытие файла на каждую запись
+    
+    # Сброс при остановке
+    logger.log_activity(1, "last", "stop_action")
+    logger.close()
+    rows = read_rows()
+    assert rows[-1]['action'] == 'stop_action' and rows[0]['username'] == 'user0'
+    
+    # Переполнение: пока поток записи занят, очередь на 10 записей заполняется
+    gate = threading.Event()
+    def stalled_write_rows(self, rows):
+        gate.wait()
+        original_write_rows(self, rows)
+    monkeypatch.setattr(ActivityLogger, '_write_rows', stalled_write_rows)
+    for policy in ('drop', 'count'):
+        gate.clear()
+        policy_file = str(tmp_path / f'{policy}.csv')
+        logger = ActivityLogger(policy_file, max_queue=10, flush_interval=0.01, batch_size=1, overflow=policy, layout='single')
+        logger.log_activity(0, "first", "action")
+        time.sleep(0.05)  # первая запись ушла в зависший поток
+        for i in range(30):
+            logger.log_activity(i, "user", "action")
+        assert logger.dropped == 20
+        gate.set()
+        logger.close()
+        with open(policy_file, encoding='utf-8') as f:
+            actions = [row['action'] for row in csv.DictReader(f)]
+        assert actions.count('action') == 11
+        assert ('log_overflow' in actions) == (policy == 'count')
+    
+    # Политика block: запись ждет места, ничего не теряется
+    gate.clear()
+    block_file = str(tmp_path / 'block.csv')
+    logger = ActivityLogger(block_file, max_queue=5, flush_interval=0.01, batch_size=1, overflow='block', layout='single')
+    assert not logger.nonblocking
+    threading.Timer(0.2, gate.set).start()
+    start = time.perf_counter()
+    for i in range(20):
+        logger.log_activity(i, "user", "action")
+    assert time.perf_counter() - start >= 0.15
+    logger.close()
+    with open(block_file, encoding='utf-8') as f:
+        assert len(list(csv.DictReader(f))) == 20
+    print(f"✅ Запись в лог активности: {per_call * 1e6:.1f} мкс на событие, {len(writes)} записей в файл на 10000 событий")
+
+
+def test_activity_archive(tmp_path):
+    """Тест лога активности по дням со сжатием и манифестом"""
+    print("🧪 Тестируем сегменты лога активности...")
+    
+    from datetime import timedelta
+    legacy = tmp_path / 'activity.csv'
+    legacy.write_text("timestamp,user_id,username,action,payload_summary,response_ref\r\n"
+                      "2024-01-01T10:00:00,1,old,start_command,,\r\n", encoding='utf-8')
+    archive = ActivityArchive(str(tmp_path / 'activity'), max_bytes=20000, import_log=str(legacy),
+                             retention_days=0)
+    
+    # Три дня: пользователи 100-199, 200-299, 300-399; строки с переводом строки внутри
+    day = datetime(2024, 3, 1, 8, 0)
+    for d in range(3):
+        rows = [[(day + timedelta(days=d, seconds=i)).isoformat(), 100 * (d + 1) + i % 100,
+                 f"user{i}", "text_message", f"сообщение {i}\nвторая строка", ""] for i in range(600)]
+        for start in range(0, len(rows), 100):
+            archive.write_rows(rows[start:start + 100])
+    archive.write_rows([[datetime(2024, 3, 3, 23, 0).isoformat(), 150, "late", "late_action", "", ""]])
+    archive.wait_for_compression()
+    
+    manifest = archive.load_manifest()
+    files = sorted(os.listdir(tmp_path / 'activity'))
+    parts_day1 = [name for name in manifest if name.startswith('2024-03-01')]
+    assert len(parts_day1) > 1  # ротация по размеру
+    assert all(manifest[name]['compressed'] for name in manifest if not name.startswith('2024-03-03'))
+    assert '2024-03-01.csv.gz' in files and '2024-03-01.csv' not in files
+    # Несжатым остается только открытый сегмент последнего дня
+    open_parts = [name for name, entry in manifest.items() if not entry['closed']]
+    assert [name for name in files if name.endswith('.csv')] == open_parts
+    assert len(open_parts) == 1 and open_parts[0].startswith('2024-03-03')
+    assert sum(entry['rows'] for entry in manifest.values()) == 1 + 1800 + 1
+    
+    # Пользователь 150: строки только за 1 марта и одна запоздавшая - в сегменте 3 марта
+    skipped = [name for name, _ in archive.partitions(user_id=150)]
+    assert not any(name.startswith('2024-03-02') for name in skipped)
+    rows = list(archive.iter_rows(user_id=150))
+    assert len(rows) == 7 and rows[0]['payload_summary'] == "сообщение 50\nвторая строка"
+    assert rows[-1]['action'] == 'late_action'
+    
+    # Период: 2 марта целиком, сегменты 1 и 3 марта пропускаются
+    march2 = list(archive.iter_rows(start=datetime(2024, 3, 2), end=datetime(2024, 3, 3)))
+    assert len(march2) == 600 and all(row['timestamp'].startswith('2024-03-02') for row in march2)
+    assert [row['username'] for row in archive.iter_rows(user_id=1)] == ['old']
+    archive.close()
+    
+    # Логгер: история читается из сегментов, включая еще не сброшенные записи
+    logger = ActivityLogger(str(tmp_path / 'activity.csv'), flush_interval=10)
+    logger.log_activity(77, "fresh", "history_requested")
+    assert [row['action'] for row in logger.iter_user_activities(77)] == ['history_requested']
+    logger.close()
+    print(f"✅ Сегменты по дням: {len(files)} файлов, для пользователя открыто {len(skipped)} из {len(manifest)}")
+
+
+def test_activity_binary_format(tmp_path):
+    """Тест двоичного формата лога активности и конвертера CSV"""
+    print("🧪 Тестируем двоичный лог активности...")
+    
+    import csv
+    from datetime import timedelta
+    buttons = ["🏠🛡️ Ближайшее укрытие", "❗ Сообщите об опасности", "📋 Моя история", "", ""]
+    actions = ["text_message", "start_command", "history_requested", "custom_action"]
+    start = datetime(2024, 3, 1, 8, 0)
+    source = tmp_path / 'activity.csv'
+    with open(source, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['timestamp', 'user_id', 'username', 'action', 'payload_summary', 'response_ref'])
+        for i in range(20000):
+            writer.writerow([(start + timedelta(seconds=i, milliseconds=i % 1000)).isoformat(),
+                             100000000 + i % 300, f"user_{i % 300}", actions[i % 4], buttons[i % 5], ""])
+    
+    assert csv_to_binary(str(source), str(tmp_path / 'activity')) == 20000
+    binary_size = sum(os.path.getsize(tmp_path / f"activity{ext}") for ext in ('.bin', '.heap', '.sym'))
+    ratio = os.path.getsize(source) / binary_size
+    assert ratio > 3
+    
+    # Полный просмотр с фильтром по пользователю: DictReader против mmap
+    started = time.perf_counter()
+    with open(source, newline='', encoding='utf-8') as f:
+        expected = [row for row in csv.DictReader(f) if row['user_id'] == '100000042']
+    csv_time = time.perf_counter() - started
+    started = time.perf_counter()
+    with BinaryActivityReader(str(tmp_path / 'activity')) as reader:
+        rows = list(reader.iter_rows(user_id=100000042))
+    binary_time = time.perf_counter() - started
+    assert len(rows) == len(expected) and binary_time * 5 < csv_time
+    for row, original in zip(rows, expected):
+        assert datetime.fromisoformat(row['timestamp']) == datetime.fromisoformat(original['timestamp'])
+        assert {k: row[k] for k in ('user_id', 'username', 'action', 'payload_summary')} == \
+            {k: original[k] for k in ('user_id', 'username', 'action', 'payload_summary')}
+    
+    # Обратный перевод в CSV
+    assert binary_to_csv(str(tmp_path / 'activity'), str(tmp_path / 'export.csv')) == 20000
+    with open(tmp_path / 'export.csv', newline='', encoding='utf-8') as f:
+        exported = list(csv.DictReader(f))
+    assert exported[4]['action'] == 'text_message' and exported[1]['payload_summary'] == buttons[1]
+    
+    # Логгер с двоичной раскладкой
+    logger = ActivityLogger(str(tmp_path / 'live.csv'), layout='binary', flush_interval=10)
+    logger.log_activity(77, "fresh", "history_requested", "история")
+    logger.log_activity(78, None, "text_message")
+    assert [(row['username'], row['payload_summary']) for row in logger.iter_user_activities(77)] == \
+        [("fresh", "история")]
+    logger.close()
+    assert os.path.getsize(tmp_path / 'live.bin') == 2 * 26
+    print(f"✅ Двоичный лог: в {ratio:.1f} раза меньше, просмотр в {csv_time / binary_time:.0f} раз быстрее")
+
+
+def test_activity_user_index(tmp_path):
+    """Тест индекса смещений строк пользователя в логе активности"""
+    print("🧪 Тестируем индекс истории пользователя...")
+    
+    from datetime import timedelta
+    archive = ActivityArchive(str(tmp_path / 'activity'), max_bytes=200000, retention_days=0)
+    start = datetime(2024, 3, 1, 8, 0)
+    rows = [[(start + timedelta(seconds=i)).isoformat(), 1000 + i % 50, f"user{i % 50}", "text_message",
+             f"сообщение {i}" if i % 7 else "две\nстроки", ""] for i in range(20000)]
+    rows += [[(start + timedelta(days=1, seconds=i)).isoformat(), 7, "rare", "history_requested", "", ""]
+             for i in range(3)]
+    for chunk_start in range(0, len(rows), 1000):
+        archive.write_rows(rows[chunk_start:chunk_start + 1000])
+    archive.wait_for_compression()
+    assert len(archive.load_manifest()) > 2  # часть сегментов уже сжата
+    
+    # Пользователь с тремя строками: читаются только они
+    started = time.perf_counter()
+    rare = list(archive.iter_rows(user_id=7))
+    indexed_time = time.perf_counter() - started
+    assert [row['username'] for row in rare] == ["rare"] * 3
+    frequent = list(archive.iter_rows(user_id=1007))
+    assert len(frequent) == 400 and frequent[0]['payload_summary'] == "две\nстроки"
+    assert frequent[1]['payload_summary'] == "сообщение 57"
+    started = time.perf_counter()
+    scanned = [row for row in archive.iter_rows() if row['user_id'] == '7']
+    scan_time = time.perf_counter() - started
+    assert scanned == rare and indexed_time * 10 < scan_time
+    archive.close()
+    
+    # Индекс удален - пересобирается при открытии; хвост, записанный без индекса, дочитывается
+    os.remove(tmp_path / 'activity' / 'index.db')
+    open_part = [name for name, entry in archive.load_manifest().items() if not entry['closed']][0]
+    with open(tmp_path / 'activity' / open_part, 'a', encoding='utf-8', newline='') as f:
+        f.write(f"{(start + timedelta(days=1, hours=1)).isoformat()},7,rare,start_command,,\r\n")
+    reopened = ActivityArchive(str(tmp_path / 'activity'), max_bytes=200000, retention_days=0)
+    assert [row['action'] for row in reopened.iter_rows(user_id=7)][-1] == "start_command"
+    assert len(list(reopened.iter_rows(user_id=1007))) == 400
+    reopened.close()
+    
+    # Один файл: индекс рядом с ним
+    logger = ActivityLogger(str(tmp_path / 'single.csv'), layout='single', flush_interval=10)
+    for i in range(100):
+        logger.log_activity(i % 10, f"user{i % 10}", "text_message", f"текст {i}")
+    assert [row['payload_summary'] for row in logger.iter_user_activities(3)][:2] == ["текст 3", "текст 13"]
+    logger.close()
+    os.remove(tmp_path / 'single_index.db')
+    logger = ActivityLogger(str(tmp_path / 'single.csv'), layout='single')
+    assert len(list(logger.iter_user_activities(3))) == 10
+    logger.close()
+    print(f"✅ Индекс истории: {indexed_time * 1000:.1f} мс против {scan_time * 1000:.0f} мс полного просмотра")
+
+
+def test_history_tail_and_counters(tmp_path):
+    """Тест чтения истории с конца и счетчиков действий"""
+    print("🧪 Тестируем последние записи и счетчики истории...")
+    
+    import tracemalloc
+    from bot.services.history_service import HistoryService
+    logger = ActivityLogger(str(tmp_path / 'activity.csv'), overflow='block', max_queue=50000)
+    actions = ["text_message", "shelter_finder_started", "question_asked", "history_requested"]
+    for i in range(20000):
+        logger.log_activity(5, "heavy", actions[i % 4], f"событие {i}")
+        if i % 10 == 0:
+            logger.log_activity(6, "light", "start_command")
+    
+    tracemalloc.start()
+    recent = logger.recent_user_activities(5, 10)
+    counts = logger.user_action_counts(5)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert [row['payload_summary'] for row in recent] == [f"событие {i}" for i in range(19990, 20000)]
+    assert counts == {action: 5000 for action in actions}
+    assert logger.user_action_counts(6) == {"start_command": 2000}
+    assert peak < 2 * 1024 * 1024  # не зависит от 20000 записей пользователя (все записи - ~9 МБ)
+    
+    # Счетчики пересчитываются вместе с индексом
+    logger.close()
+    os.remove(tmp_path / 'activity' / 'index.db')
+    logger = ActivityLogger(str(tmp_path / 'activity.csv'))
+    assert logger.user_action_counts(5)["question_asked"] == 5000
+    
+    service = HistoryService(Mock(), logger)
+    activities, action_counts = service.get_user_history(6, limit=3)
+    assert len(activities) == 3 and action_counts == {"start_command": 2000}
+    text = service.format_activity_history(activities, action_counts=action_counts)
+    assert "**Всего действий:** 2000" in text and "🚀 Запуск бота: 2000" in text
+    logger.close()
+    print(f"✅ Последние 10 из 20000 записей и счетчики: пик памяти {peak // 1024} КБ")
+
+
+def test_history_reverse_reader_without_index(tmp_path, monkeypatch):
+    """Тест чтения CSV лога с конца блоками (лог без индекса)"""
+    print("🧪 Тестируем чтение лога с конца без индекса...")
+
+    import csv
+    import io
+    import bot.services.history_service as history_service_module
+    from bot.services.history_service import HistoryService
+    from bot.utils.activity_archive import CSV_HEADER
+    from bot.utils.activity_index import iter_csv_rows_reversed
+
+    # Переводы строк и кавычки внутри полей не разрывают записи при любом размере блока
+    rows = [CSV_HEADER] + [
+        [f"2026-10-01T10:00:{i % 60:02d}", str(i % 3), "user", "text_message",
+         ["просто", 'в "кавычках"', "две\nстроки", '"\n"', "🔥\r\n,"][i % 5], ""]
+        for i in range(500)
+    ]
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    data = buffer.getvalue().encode('utf-8')
+    for block_size in (1, 7, 100, 64 * 1024):
+        assert list(iter_csv_rows_reversed(io.BytesIO(data), block_size)) == rows[::-1]
+    # Недописанная последняя строка пропускается
+    assert list(iter_csv_rows_reversed(io.BytesIO(data + b'1,2,u,x,"obo'), 7)) == rows[::-1]
+
+    # Логгер без индекса: HistoryService читает хвост его лога, весь лог не просматривается
+    log_file = tmp_path / 'activity.csv'
+    log_file.write_bytes(data)
+    file_manager = Mock()
+    file_manager.file_exists.return_value = True
+    logger = Mock(spec=['log_activity'], log_file=str(log_file))
+    service = HistoryService(file_manager, logger)
+    scanned = []
+    def counting_reader(f):
+        for row in iter_csv_rows_reversed(f):
+            scanned.append(row)
+            yield row
+    monkeypatch.setattr(history_service_module, 'iter_csv_rows_reversed', counting_reader)
+    activities, action_counts = service.get_user_history(1, limit=3)
+    assert [row['timestamp'] for row in activities] == [row[0] for row in rows[1:] if row[1] == '1'][-3:]
+    assert activities[-1]['payload_summary'] == rows[-1][4] and len(scanned) < 10
+    # Счетчиков у логгера нет - статистика только по прочитанным записям и помечена
+    assert action_counts is None
+    page = service.render_history_pages(activities, action_counts)[0]
+    assert "Статистика по последним действиям" in page and "💬 Сообщение: 3" in page
+    # Счетчики логгера используются, если он их ведет
+    logger.user_action_counts = Mock(return_value={"text_message": 167})
+    assert service.get_user_history(1, limit=3)[1] == {"text_message": 167}
+    print("✅ Лог без индекса читается с конца блоками")
+
+
+@pytest.mark.asyncio
+async def test_history_pagination(tmp_path):
+    """Тест разбиения истории на страницы и листания кнопками"""
+    print("🧪 Тестируем страницы истории...")
+    
+    from bot.services.history_service import HistoryService
+    from bot.utils.paginator import paginate, utf16_len
+    
+    # Длина считается в UTF-16: эмодзи вне BMP - две единицы
+    assert utf16_len("🏠") == 2 and utf16_len("дом") == 3
+    entries = [f"🚨 запись {i} " + "ж" * 300 + "\n\n" for i in range(60)]
+    pages = paginate(entries, header="📊 История\n\n", limit=4096)
+    assert all(utf16_len(page) <= 4096 for page in pages) and len(pages) > 1
+    assert ''.join(page[len("📊 История\n\n"):] for page in pages) == ''.join(entries)
+    assert [len(page) for page in paginate(["😀" * 3000], limit=4096)] == [2048, 952]  # пары не разрываются
+    assert len(paginate(["a\n"] * 25, max_entries=10)) == 3
+    
+    logger = ActivityLogger(str(tmp_path / 'activity.csv'), overflow='block')
+    for i in range(40):
+        logger.log_activity(12345, "test_user", "text_message", f"🚨 сообщение {i} " + "ы" * 90)
+    service = HistoryService(Mock(), logger, page_entries=10)
+    pages = service.get_history_pages(12345)
+    assert len(pages) == 4 and "**Всего действий:** 40" in pages[0]
+    assert "сообщение 39" in pages[0] and "сообщение 0 " in pages[-1]
+    
+    # Листание берет страницы из кэша, пока нет новых записей
+    reads = Mock(wraps=logger.recent_user_activities)
+    logger.recent_user_activities = reads
+    assert service.get_history_pages(12345) is pages and reads.call_count == 0
+    logger.log_activity(12345, "test_user", "start_command")
+    assert "**Всего действий:** 41" in service.get_history_pages(12345)[0] and reads.call_count == 1
+    
+    # Кнопки: первая страница отправляется, следующая - редактированием сообщения
+    app = BotApplication()
+    app.history_service = service
+    update = MockUpdate(text="/my_history")
+    await app.my_history_command(update, MockContext())
+    markup = update.message.reply_text.call_args.kwargs['reply_markup']
+    assert [button.callback_data for button in markup.inline_keyboard[0]] == ["hist|-", "hist|1"]
+    
+    update.callback_query = Mock()
+    update.callback_query.data = "hist|1"
+    update.callback_query.answer = AsyncMock()
+    update.callback_query.edit_message_text = AsyncMock()
+    await app.history_page_callback(update, MockContext())
+    text = update.callback_query.edit_message_text.call_args.args[0]
+    assert text == service.get_history_pages(12345)[1]
+    buttons = update.callback_query.edit_message_text.call_args.kwargs['reply_markup'].inline_keyboard[0]
+    assert [button.callback_data for button in buttons] == ["hist|0", "hist|-", "hist|2"]
+    logger.close()
+    print(f"✅ Страницы истории: {len(pages)} шт., листание из кэша")
+
+
+@pytest.mark.asyncio
+async def test_history_page_cache(tmp_path):
+    """Тест кэша отрисованной истории с версиями пользователей"""
+    print("🧪 Тестируем кэш страниц истории...")
+    
+    from bot.services.history_service import HistoryService
+    from bot.utils.paginator import PageCache
+    
+    # Бюджет памяти и вытеснение давно не использованных
+    cache = PageCache(max_bytes=22000)  # пять наборов по ~4 КБ
+    page = "ж" * 2000
+    for user_id in range(5):
+        cache.put(user_id, 1, [page])
+    assert cache.get(0, 1) is not None  # 0 стал недавно использованным
+    cache.put(5, 1, [page])
+    stats = cache.stats()
+    assert stats['bytes'] <= 22000 and stats['evictions'] >= 1
+    assert cache.get(0, 1) is not None and cache.get(1, 1) is None
+    assert cache.get(0, 2) is None and cache.stats()['stale'] == 1  # новая версия - промах
+    
+    # Версия меняется только от новых записей пользователя, не от просмотра истории
+    logger = ActivityLogger(str(tmp_path / 'activity.csv'))
+    version = logger.user_version(42)
+    logger.log_activity(42, "user", "text_message", "привет")
+    assert logger.user_version(42) == version + 1
+    logger.log_activity(42, "user", "history_requested")
+    assert logger.user_version(42) == version + 1
+    
+    service = HistoryService(Mock(), logger)
+    reads = Mock(wraps=logger.recent_user_activities)
+    logger.recent_user_activities = reads
+    first = await service.get_history_pages_async(42)
+    for _ in range(5):
+        logger.log_activity(42, "user", "history_requested")
+        assert await service.get_history_pages_async(42) is first
+    assert reads.call_count == 1 and service.page_cache.stats()['hits'] == 5
+    # Запросы истории версию не меняют, поэтому на страницы не попадают
+    assert not any("📊 Запрос истории" in page for page in first)
+    
+    # Новая запись пользователя сбрасывает только его страницы
+    logger.log_activity(43, "other", "start_command")
+    assert await service.get_history_pages_async(42) is first
+    logger.log_activity(42, "user", "shelter_finder_started")
+    updated = await service.get_history_pages_async(42)
+    assert updated is not first and "🏠 Поиск убежищ" in updated[0] and reads.call_count == 2
+    logger.close()
+    print(f"✅ Кэш истории: {service.page_cache.stats()}")
+
+
+@pytest.mark.asyncio
+async def test_main_history_cache(main_module):
+    """Тест /my_history в bot.main: повторный запрос из кэша без устаревших счетчиков"""
+    print("🧪 Тестируем кэш /my_history в bot.main...")
+
+    main_module.log_activity(77, "user", "text_message", "привет")
+    first, second = MockUpdate(user_id=77), MockUpdate(user_id=77)
+    await main_module.my_history(first, MockContext())
+    await main_module.my_history(second, MockContext())
+
+    page = first.message.reply_text.call_args.args[0]
+    assert "💬 Сообщение" in page and "📊 Запрос истории" not in page
+    # Второй запрос берет страницу из кэша, и она совпадает со свежей
+    assert second.message.reply_text.call_args.args[0] == page
+    assert main_module.history_service.page_cache.stats()['hits'] == 1
+    print("✅ Кэш /my_history в bot.main работает")
+
+
+def test_activity_retention_compaction(tmp_path):
+    """Тест сжатия старых сегментов лога активности (срок хранения)"""
+    print("🧪 Тестируем срок хранения лога активности...")
+
+    from datetime import timedelta
+    from bot.utils.block_gzip import write_blocks
+    archive_dir = tmp_path / 'activity'
+    archive = ActivityArchive(str(archive_dir), retention_days=90, compact_actions=['text_message'])
+    start = datetime(2024, 3, 1, 8, 0)
+    rows = []
+    for i in range(3000):
+        user_id = 1 + i % 5
+        action = "start_command" if i % 100 == 0 else "text_message"
+        rows.append([(start + timedelta(seconds=i)).isoformat(), user_id, f"user{user_id}", action,
+                     f"сообщение {i}", ""])
+    archive.write_rows(rows)
+    size_before = archive.load_manifest()['2024-03-01.csv']['size']
+    counts_before = archive.index.action_counts(1)
+    recent = (datetime.now() - timedelta(days=1)).replace(microsecond=0)
+    archive.write_rows([[recent.isoformat(), 1, "user1", "text_message", "вчера", ""]])
+    archive.wait_for_compression()
+
+    # Прошлый день переписан: вместо 2970 сообщений - по строке на пользователя
+    entry = archive.load_manifest()['2024-03-01.csv']
+    assert entry['compacted'] and entry['dropped'] == 2970
+    assert entry['rows'] == 30 + 5 and entry['size'] * 20 < size_before
+    history = list(archive.iter_user_rows(1))
+    aggregate = [row for row in history if row['action'] == "text_message"]
+    assert len(history) == 30 + 1 + 1 and aggregate[0]['response_ref'] == "aggregate:570"
+    assert aggregate[0]['payload_summary'] == "Всего за день: 570"
+    assert aggregate[0]['timestamp'] == (start + timedelta(seconds=2995)).isoformat()
+    assert aggregate[1]['payload_summary'] == "вчера"  # в пределах срока хранения
+    assert archive.index.action_counts(1) == {**counts_before, 'text_message': 571}
+    assert archive.compact() == 0
+    archive.close()
+
+    # Пересобранный индекс учитывает агрегированные строки с их числом событий
+    os.remove(archive_dir / 'index.db')
+    # Незавершенная подмена, до которой индекс не дошел, отбрасывается
+    write_blocks([b"timestamp\n"], str(archive_dir / '2024-03-01.csv.gz.compact'))
+    reopened = ActivityArchive(str(archive_dir), retention_days=90, compact_actions=['text_message'])
+    assert not (archive_dir / '2024-03-01.csv.gz.compact').exists()
+    assert reopened.index.action_counts(1) == {**counts_before, 'text_message': 571}
+    assert [row['response_ref'] for row in reopened.iter_user_rows(3)] == ["aggregate:600"]
+    reopened.close()
+    print(f"✅ Срок хранения: {size_before} -> {entry['size']} байт за старый день")
+
+
+def test_structured_logging(tmp_path):
+    """Тест логирования через очередь: JSON, ротация в потоке записи, выборка частых строк"""
+    print("🧪 Тестируем структурированное логирование...")
+
+    import json
+    import logging
+    import threading
+    from bot.utils.app_logging import SampledLog, build_queue_logging, parse_levels
+    log_file = tmp_path / 'app.log'
+    handler, listener = build_queue_logging(str(log_file), max_bytes=4000, backup_count=2, console=False)
+    writers = set()
+    original_emit = listener.handlers[0].emit
+    listener.handlers[0].emit = lambda record: (writers.add(threading.current_thread().name),
+                                                original_emit(record))
+    test_logger = logging.getLogger('test.structured')
+    test_logger.propagate = False
+    test_logger.setLevel(logging.INFO)
+    test_logger.addHandler(handler)
+    listener.start()
+    try:
+        for i in range(100):
+            test_logger.info("Пользователь %s отправил сообщение", i, extra={'chars': i * 2})
+        test_logger.debug("не попадет в лог %r", object())
+    finally:
+        listener.stop()
+        test_logger.removeHandler(handler)
+        listener.handlers[0].close()
+    assert threading.current_thread().name not in writers  # файл пишет поток очереди
+    assert (tmp_path / 'app.log.1').exists() and (tmp_path / 'app.log.2').exists()
+    assert not (tmp_path / 'app.log.3').exists()
+    last = [json.loads(line) for line in log_file.read_text(encoding='utf-8').splitlines()][-1]
+    assert last['msg'] == "Пользователь 99 отправил сообщение" and last['chars'] == 198
+    assert last['level'] == "INFO" and last['logger'] == 'test.structured'
+    assert parse_levels("httpx=warning, bot.main=DEBUG,bad=NOPE") == {'httpx': logging.WARNING,
+                                                                      'bot.main': logging.DEBUG}
+
+    # Частая строка: не больше 5 в секунду, отброшенные почти ничего не стоят
+    records = []
+    collector = logging.Handler()
+    collector.emit = records.append
+    hot_logger = logging.getLogger('test.hot')
+    hot_logger.propagate = False
+    hot_logger.setLevel(logging.INFO)
+    hot_logger.addHandler(collector)
+    hot = SampledLog(hot_logger, per_second=5)
+    started = time.perf_counter()
+    for i in range(10000):
+        hot.info("message", "Пользователь %s отправил сообщение", i, chars=10)
+    per_call = (time.perf_counter() - started) / 10000
+    assert len(records) == 5 and per_call < 20e-6
+    hot._windows["message"][0] -= 1.0  # прошла секунда
+    hot.info("message", "Пользователь %s отправил сообщение", 1, chars=10)
+    assert records[-1].chars == 10 and records[-1].suppressed == 9995
+    hot_logger.removeHandler(collector)
+    print(f"✅ Логирование: {per_call * 1e6:.2f} мкс на отброшенную строку")
+
+
+def test_activity_analytics(tmp_path):
+    """Тест аналитики лога активности по пачкам (NumPy)"""
+    print("🧪 Тестируем аналитику лога активности...")
+
+    import csv
+    import random
+    import tracemalloc
+    from datetime import timedelta
+    from bot.utils.activity_analytics import analyze, format_report, main as analytics_main
+    actions = ["start_command", "text_message", "text_message", "danger_report_started", "incident_saved",
+               "safety_consultant_started", "question_asked", "shelter_finder_started"]
+    random.seed(7)
+    start = datetime(2024, 1, 1)
+
+    def write_log(path, count):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['timestamp', 'user_id', 'username', 'action', 'payload_summary', 'response_ref'])
+            for i in range(count):
+                writer.writerow([(start + timedelta(seconds=i * 20)).isoformat(), random.randint(1, 500),
+                                 "user", random.choice(actions), "текст, с \"кавычками\"", ""])
+
+    log_file = tmp_path / 'activity.csv'
+    write_log(log_file, 60000)
+
+    # Построчный подсчет через csv.DictReader - эталон
+    started = time.perf_counter()
+    dau, by_hour, users = {}, {}, {"danger_report_started": set(), "incident_saved": set()}
+    for row in csv.DictReader(open(log_file, encoding='utf-8', newline='')):
+        moment = datetime.fromisoformat(row['timestamp'])
+        dau.setdefault(str(moment.date()), set()).add(int(row['user_id']))
+        by_hour.setdefault(row['action'], [0] * 24)[moment.hour] += 1
+        if row['action'] in users:
+            users[row['action']].add(int(row['user_id']))
+    reference_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    report = analyze(str(log_file), chunk_rows=8192)
+    csv_time = time.perf_counter() - started
+    assert report['rows'] == report['events'] == 60000
+    assert report['dau'] == {day: len(day_users) for day, day_users in dau.items()}
+    assert report['usage_by_hour'] == by_hour
+    funnel = report['funnel']
+    assert funnel['started'] == sum(by_hour['danger_report_started'])
+    assert funnel['started_users'] == len(users['danger_report_started'])
+    assert funnel['saved_users'] == len(users['danger_report_started'] & users['incident_saved'])
+    assert report['consultant']['questions'] == sum(by_hour['question_asked'])
+    assert analyze(str(log_file), start='2024-01-03', end='2024-01-05')['dau'] == \
+        {day: count for day, count in report['dau'].items() if '2024-01-03' <= day < '2024-01-05'}
+    assert "Воронка danger_report_started -> incident_saved" in format_report(report)
+
+    # Пачки не по порядку времени: день, встреченный снова после более поздних, не считается дважды
+    shuffled_file = tmp_path / 'shuffled.csv'
+    with open(shuffled_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['timestamp', 'user_id', 'username', 'action', 'payload_summary', 'response_ref'])
+        for moment, user_id in [(start, 1), (start + timedelta(days=3), 2), (start, 1), (start, 3)]:
+            writer.writerow([moment.isoformat(), user_id, "user", "text_message", "", ""])
+    assert analyze(str(shuffled_file), chunk_rows=1)['dau'] == {'2024-01-01': 2, '2024-01-04': 1}
+
+    # Двоичный лог: записи читаются из отображения файла без разбора текста
+    csv_to_binary(str(log_file), str(tmp_path / 'binary'))
+    started = time.perf_counter()
+    binary_report = analyze(str(tmp_path / 'binary'))
+    binary_time = time.perf_counter() - started
+    assert binary_report == report and binary_time * 5 < reference_time
+
+    # Сегменты по дням после сжатия старых: агрегированные строки считаются с их числом событий
+    archive = ActivityArchive(str(tmp_path / 'archive'), retention_days=90, compact_actions=['text_message'])
+    with open(log_file, encoding='utf-8', newline='') as f:
+        archive.write_rows([row for row in csv.reader(f)][1:])
+    archive.close()
+    archive_report = analyze(str(tmp_path / 'archive'))
+    assert archive_report['rows'] < 60000 and archive_report['events'] == 60000
+    assert archive_report['dau'] == report['dau'] and archive_report['funnel'] == report['funnel']
+    assert sum(archive_report['usage_by_hour']['text_message']) == sum(by_hour['text_message'])
+    assert analytics_main([str(tmp_path / 'archive'), '--json']) == 0
+
+    # Память зависит от размера пачки, а не от длины лога
+    peaks = []
+    for count in (20000, 80000):
+        write_log(tmp_path / f'log{count}.csv', count)
+        tracemalloc.start()
+        analyze(str(tmp_path / f'log{count}.csv'), chunk_rows=4096)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    assert peaks[1] < peaks[0] * 1.5
+    print(f"✅ Аналитика: эталон {reference_time:.2f} с, CSV {csv_time:.2f} с, двоичный {binary_time:.3f} с, "
+          f"пик памяти {peaks[0] // 1024} / {peaks[1] // 1024} КБ")
+
+
+def test_dialog_state_ttl():
+    """Тест удаления брошенных состояний диалога (колесо таймеров)"""
+    print("🧪 Тестируем время жизни состояний диалога...")
+
+    from bot.utils.ttl_store import TTLDict, TimingWheel
+    now = [1000.0]
+    expired = []
+    states = TTLDict(60, lambda key, value: expired.append((key, value)), clock=lambda: now[0])
+
+    # 100 тысяч пользователей написали по одному разу - через ttl в памяти никого
+    for user_id in range(100000):
+        states[user_id] = {'state': 'idle', 'data': {}}
+    now[0] += 30
+    states[7]['state'] = 'danger_description'  # обращение продлевает срок
+    states[8] = {'state': 'danger_location', 'data': {'description': "черновик"}}
+    now[0] += 31
+    assert 7 in states and 8 in states and 9 not in states
+    assert len(states) == 2 and len(expired) == 99998
+    now[0] += 61
+    assert len(states) == 0 and dict(expired[-2:])[8] == {'state': 'danger_location', 'data': {'description': "черновик"}}
+    assert len(states._wheel) == 0
+
+    # Удаленный ключ не истекает; долгий простой (больше оборота колеса) снимает все сроки
+    wheel = TimingWheel(tick=1.0, slots=8, clock=lambda: now[0])
+    wheel.schedule('a', 5)
+    wheel.schedule('b', 20)
+    wheel.schedule('c', 3)
+    wheel.cancel('c')
+    now[0] += 10
+    assert wheel.advance() == ['a'] and len(wheel) == 1
+    now[0] += 100
+    assert wheel.advance() == ['b'] and wheel.advance() == []
+
+    # StateManager: черновик брошенного сообщения передается обработчику
+    abandoned = []
+    manager = StateManager(state_ttl=0.2, on_expire=lambda user_id, state: abandoned.append(user_id))
+    manager.set_user_state(1, {'state': 'danger_description', 'data': {}})
+    assert manager.check_spam_protection(1)
+    time.sleep(0.4)
+    assert manager.get_user_state(1) is None and abandoned == [1]
+    print(f"✅ Состояния диалога: истекло {len(expired)} записей, брошенных черновиков {len(abandoned)}")
+
+
+def test_compact_dialog_state():
+    """Тест компактного хранения состояний (слоты, коды состояний, кольцо времен)"""
+    print("🧪 Тестируем компактные состояния диалога...")
+
+    from array import array
+    from bot.models.user_state import CompactUserState, DialogState
+    from bot.utils.state_manager import record_message
+    from bot.utils.state_benchmark import memory_benchmark
+    from bot.utils.ttl_store import GenerationDict
+
+    state = {'state': 'danger_media', 'data': {'description': "дым", 'location': "корпус 2",
+                                               'media_files': [{'type': 'photo'}], 'source': 'test'}}
+    compact = CompactUserState.from_dict(state)
+    assert compact.state is DialogState.DANGER_MEDIA and compact.extra == {'source': 'test'}
+    assert compact.to_dict() == state and not hasattr(compact, '__dict__')
+    assert CompactUserState.from_dict({'state': 'custom', 'data': {}}).to_dict() == {'state': 'custom', 'data': {}}
+
+    # Кольцо: не больше 3 сообщений за 60 секунд, освободившееся место занимает новое
+    times = array('d')
+    assert [record_message(times, t, 3, 60) for t in (0, 1, 2, 3)] == [True, True, True, False]
+    assert record_message(times, 60.5, 3, 60) and list(times) == [60.5, 1, 2]
+    assert not record_message(times, 60.9, 3, 60)
+    assert record_message(times, 61.5, 3, 60) and len(times) == 3
+
+    now = [0.0]
+    windows = GenerationDict(60, clock=lambda: now[0])
+    windows['a'] = 1
+    windows['b'] = 2
+    now[0] = 70
+    assert windows['a'] == 1  # обращение переносит запись в текущее поколение
+    now[0] = 140
+    assert 'a' in windows and 'b' not in windows and len(windows) == 1
+
+    # Компактные записи занимают меньше памяти, чем словари
+    result = memory_benchmark(20000)
+    assert result['after'] < result['before'] * 0.8
+    print(f"✅ Компактные состояния: {result['before']:.0f} -> {result['after']:.0f} байт на пользователя")
 
 
 async def run_all_tests():